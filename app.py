@@ -27,7 +27,7 @@ from config import (
 )
 from auth import auth_bp, login_manager
 from routes import main_bp, api_bp
-from models import save_data
+from models import save_data, begin_settings_session, end_settings_session
 
 
 def create_app():
@@ -44,6 +44,19 @@ def create_app():
     # Flask-Login初期化
     login_manager.init_app(app)
 
+    # 設定データはリクエストごとに1回だけ読み込み、変更は終了時にまとめて保存
+    app.before_request(begin_settings_session)
+
+    @app.after_request
+    def commit_settings_session(response):
+        # エラー（4xx・5xx）を返すときは途中の変更を保存しない
+        end_settings_session(commit=response.status_code < 400)
+        return response
+
+    @app.teardown_request
+    def discard_settings_session(exc):
+        end_settings_session(commit=False)
+
     # Blueprintを登録
     app.register_blueprint(auth_bp)
     app.register_blueprint(main_bp)
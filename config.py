@@ -16,6 +16,7 @@ BASE_DIR = Path(__file__).parent
 DATA_DIR = BASE_DIR / 'data'
 DATA_FILE = DATA_DIR / 'settings.json'
 SHIFTS_FILE = DATA_DIR / 'shifts.json'
+SHIFTS_DB_FILE = DATA_DIR / 'shifts.db'
 
 # Google Cloud Project ID
 GOOGLE_CLOUD_PROJECT = os.environ.get('GOOGLE_CLOUD_PROJECT', 'shiftmakerai')
@@ -46,6 +47,73 @@ try:
 except ImportError:
     print("Firestore SDKがインストールされていません")
 
+# Firestore接続プール設定
+# 連続でこの回数失敗したら接続を破棄し、一定時間Firestoreを使わない（サーキットブレーカー）
+FIRESTORE_FAILURE_THRESHOLD = int(os.environ.get('FIRESTORE_FAILURE_THRESHOLD', '3'))
+# サーキットブレーカー作動後、再接続を試みるまでの秒数
+FIRESTORE_RETRY_INTERVAL = float(os.environ.get('FIRESTORE_RETRY_INTERVAL', '30'))
+
+# 設定キャッシュの有効期限（秒）。変更通知が届かなかった場合の保険、0以下でキャッシュ無効
+SETTINGS_CACHE_TTL = float(os.environ.get('SETTINGS_CACHE_TTL', '300'))
+# キャッシュしておく月別ドキュメント（NG日・例外日）の最大数
+SETTINGS_CACHE_MONTH_DOCS = int(os.environ.get('SETTINGS_CACHE_MONTH_DOCS', '24'))
+
+# Firestore保存時のローカルバックアップ（data/ 以下のJSON）
+# async: バックグラウンドでまとめて書き込む / sync: リクエスト中に書き込む / off: 書き込まない
+# （Firestoreが使えないときはローカルが保存先になるため、設定に関係なく即時に書き込む）
+LOCAL_BACKUP_MODE = os.environ.get('LOCAL_BACKUP_MODE', 'async')
+# 最後の保存からこの秒数だけ待ってまとめて書き込む
+LOCAL_BACKUP_DELAY = float(os.environ.get('LOCAL_BACKUP_DELAY', '2'))
+# 保存が続いても、最初の保存からこの秒数以内には書き込む
+LOCAL_BACKUP_MAX_DELAY = float(os.environ.get('LOCAL_BACKUP_MAX_DELAY', '10'))
+
+# シフトの保存先
+# auto: Firestoreが使えればFirestore、使えなければSQLite / firestore / sqlite / json（従来の shifts.json）
+SHIFT_STORAGE = os.environ.get('SHIFT_STORAGE', 'auto')
+# シフト最適化（mode="optimize"）の制限時間（秒）と、リクエストで指定できる上限
+SHIFT_OPTIMIZE_TIME_BUDGET = float(os.environ.get('SHIFT_OPTIMIZE_TIME_BUDGET', '2'))
+SHIFT_OPTIMIZE_MAX_TIME_BUDGET = float(os.environ.get('SHIFT_OPTIMIZE_MAX_TIME_BUDGET', '30'))
+
+# シフト生成に使うプロセス数（1以下なら並列化しない）
+SHIFT_WORKERS = int(os.environ.get('SHIFT_WORKERS', str(min(4, os.cpu_count() or 1))))
+# 候補生成（mode="candidates"）で作る候補の数と、リクエストで指定できる上限
+SHIFT_CANDIDATES = int(os.environ.get('SHIFT_CANDIDATES', '8'))
+SHIFT_CANDIDATES_MAX = int(os.environ.get('SHIFT_CANDIDATES_MAX', '32'))
+# 一括生成（/api/generate_shift_range）で指定できる最大月数
+SHIFT_RANGE_MAX_MONTHS = int(os.environ.get('SHIFT_RANGE_MAX_MONTHS', '12'))
+# カレンダーの期間指定（/api/calendar?from=&to=）で指定できる最大月数
+CALENDAR_RANGE_MAX_MONTHS = int(os.environ.get('CALENDAR_RANGE_MAX_MONTHS', '120'))
+# 複数月のExcel出力（/api/export_excel_range）で指定できる最大月数
+EXPORT_RANGE_MAX_MONTHS = int(os.environ.get('EXPORT_RANGE_MAX_MONTHS', '36'))
+
+# シフト生成結果のキャッシュ
+# メモリに保持する件数（0でメモリキャッシュ無効）
+GENERATION_CACHE_SIZE = int(os.environ.get('GENERATION_CACHE_SIZE', '64'))
+# ディスクキャッシュの保存先（空なら使わない）と最大件数
+GENERATION_CACHE_DIR = os.environ.get('GENERATION_CACHE_DIR', '')
+GENERATION_CACHE_DISK_ENTRIES = int(os.environ.get('GENERATION_CACHE_DISK_ENTRIES', '256'))
+
+# 出力ファイル（Excel・PDF）のディスクキャッシュ
+# 保存先（空なら一時ディレクトリ）と合計サイズの上限（MB、0でディスクキャッシュ無効）
+EXPORT_CACHE_DIR = os.environ.get('EXPORT_CACHE_DIR', '')
+EXPORT_CACHE_MAX_MB = float(os.environ.get('EXPORT_CACHE_MAX_MB', '100'))
+
+# 出力ジョブ（/api/export_jobs）
+# 同時に作成する件数・待ちを含めて受け付ける件数・終わったジョブとファイルを残す秒数
+EXPORT_JOB_WORKERS = int(os.environ.get('EXPORT_JOB_WORKERS', '2'))
+EXPORT_JOB_MAX_PENDING = int(os.environ.get('EXPORT_JOB_MAX_PENDING', '16'))
+EXPORT_JOB_TTL = int(os.environ.get('EXPORT_JOB_TTL', '600'))
+
+# スタッフごとのカレンダー配信（/api/ics/<スタッフID>.ics）
+# URLのトークンを作る秘密鍵（空ならSECRET_KEY）・保存済みシフトの変更を確認する間隔（秒）・
+# 何か月前までのシフトを含めるか
+ICS_TOKEN_SECRET = os.environ.get('ICS_TOKEN_SECRET', '')
+ICS_REFRESH_SECONDS = float(os.environ.get('ICS_REFRESH_SECONDS', '60'))
+ICS_PAST_MONTHS = int(os.environ.get('ICS_PAST_MONTHS', '12'))
+
+# 保存済みシフト一覧の1ページあたりの件数
+SHIFT_LIST_PAGE_SIZE = int(os.environ.get('SHIFT_LIST_PAGE_SIZE', '24'))
+
 # デフォルトデータ
 DEFAULT_DATA = {
     "locations": [
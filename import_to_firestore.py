@@ -1,6 +1,11 @@
 # -*- coding: utf-8 -*-
 """
 ローカルJSONデータをFirestoreにインポートするスクリプト
+
+拠点・スタッフは1件1ドキュメント、NG日・例外日は月ごとの1ドキュメントに分けて保存する
+  python import_to_firestore.py            settings.json をインポート
+  python import_to_firestore.py --migrate  Firestoreの旧形式（settings/main）を新しい構成に移行
+  python import_to_firestore.py --verify   インポート結果を確認
 """
 
 import json
@@ -13,6 +18,8 @@ load_dotenv()
 
 from google.cloud import firestore
 
+from models import split_settings_document, migrate_legacy_settings
+
 # 設定
 PROJECT_ID = 'shiftmakerai'
 DATA_FILE = Path(__file__).parent / 'data' / 'settings.json'
@@ -43,23 +50,44 @@ def import_settings():
         return False
 
     # 既存データを確認
-    doc_ref = db.collection('settings').document('main')
-    existing_doc = doc_ref.get()
+    existing_locations = list(db.collection('locations').stream())
+    existing_staff = list(db.collection('staff').stream())
 
-    if existing_doc.exists:
+    if existing_locations or existing_staff:
         print("\n既存のデータが見つかりました:")
-        existing_data = existing_doc.to_dict()
-        print(f"  - 拠点数: {len(existing_data.get('locations', []))}")
-        print(f"  - スタッフ数: {len(existing_data.get('staff', []))}")
+        print(f"  - 拠点数: {len(existing_locations)}")
+        print(f"  - スタッフ数: {len(existing_staff)}")
 
         response = input("\n既存データを上書きしますか？ (y/n): ")
         if response.lower() != 'y':
             print("インポートをキャンセルしました")
             return False
 
-    # Firestoreに保存
+    # Firestoreに保存（1バッチ最大500件）
     try:
-        doc_ref.set(data)
+        split = split_settings_document(data)
+        writes = []
+        for name in ('locations', 'staff'):
+            for item in split[name]:
+                writes.append(("set", db.collection(name).document(str(item['id'])), item))
+        for kind in ('ng_days', 'exceptions'):
+            for month_key, value in split[kind].items():
+                writes.append(("set", db.collection(kind).document(month_key), value))
+
+        # インポートするデータにない拠点・スタッフは削除
+        new_paths = {ref.path for _, ref, _ in writes}
+        for doc in existing_locations + existing_staff:
+            if doc.reference.path not in new_paths:
+                writes.append(("delete", doc.reference, None))
+
+        for start in range(0, len(writes), 500):
+            batch = db.batch()
+            for op, ref, value in writes[start:start + 500]:
+                if op == "set":
+                    batch.set(ref, value)
+                else:
+                    batch.delete(ref)
+            batch.commit()
         print("\nFirestoreへのインポートが完了しました！")
         return True
     except Exception as e:
@@ -67,21 +95,40 @@ def import_settings():
         return False
 
 
+def migrate_settings():
+    """Firestoreの settings/main を新しい構成に移行"""
+    try:
+        db = firestore.Client(project=PROJECT_ID)
+        print(f"Firestore接続成功: プロジェクト={PROJECT_ID}")
+    except Exception as e:
+        print(f"Firestore接続エラー: {e}")
+        return False
+
+    if migrate_legacy_settings(db, force=True):
+        return True
+    print("settings/main が見つかりません")
+    return False
+
+
 def verify_import():
     """インポートされたデータを確認"""
     try:
         db = firestore.Client(project=PROJECT_ID)
-        doc = db.collection('settings').document('main').get()
+        locations = sorted((doc.to_dict() for doc in db.collection('locations').stream()),
+                           key=lambda loc: loc['id'])
+        staff_list = sorted((doc.to_dict() for doc in db.collection('staff').stream()),
+                            key=lambda staff: staff['id'])
 
-        if doc.exists:
-            data = doc.to_dict()
+        if locations or staff_list:
             print("\n=== Firestoreのデータ確認 ===")
             print(f"拠点:")
-            for loc in data.get('locations', []):
+            for loc in locations:
                 print(f"  - {loc['name']} (ID: {loc['id']})")
             print(f"\nスタッフ:")
-            for staff in data.get('staff', []):
+            for staff in staff_list:
                 print(f"  - {staff['name']} ({staff['type']})")
+            print(f"\nNG日設定: {len(list(db.collection('ng_days').list_documents()))}か月")
+            print(f"例外日設定: {len(list(db.collection('exceptions').list_documents()))}か月")
             return True
         else:
             print("Firestoreにデータが見つかりません")
@@ -96,6 +143,9 @@ if __name__ == '__main__':
 
     if len(sys.argv) > 1 and sys.argv[1] == '--verify':
         verify_import()
+    elif len(sys.argv) > 1 and sys.argv[1] == '--migrate':
+        if migrate_settings():
+            verify_import()
     else:
         if import_settings():
             verify_import()
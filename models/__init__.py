@@ -3,8 +3,21 @@
 モデル（データ管理）
 """
 
-from .data_store import (
+from .firestore_client import (
     get_firestore_client,
+    get_firestore_stats,
+    reset_firestore_client,
+)
+from .shift_storage import (
+    get_shift_storage,
+    get_local_shift_storage,
+)
+from .data_store import (
+    begin_settings_session,
+    end_settings_session,
+    invalidate_settings_cache,
+    get_settings_cache_stats,
+    get_local_backup_stats,
     load_data,
     save_data,
     get_locations,
@@ -13,10 +26,19 @@ from .data_store import (
     set_staff,
     get_ng_days,
     set_ng_days,
+    get_month_ng_days,
+    set_month_ng_days,
     get_exceptions,
     set_exceptions,
+    get_month_exceptions,
+    set_month_exceptions,
+    split_settings_document,
+    migrate_legacy_settings,
     save_shift,
+    save_shifts,
     load_shift,
     delete_shift,
     list_shifts,
+    list_shifts_page,
+    add_shift_change_listener,
 )
@@ -4,39 +4,29 @@
 """
 
 import json
-from datetime import datetime
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextvars import ContextVar
 from copy import deepcopy
 
-from pathlib import Path
-
 from config import (
-    DATA_DIR, DATA_FILE, SHIFTS_FILE,
-    FIRESTORE_AVAILABLE, FIREBASE_KEY_FILE, DEFAULT_DATA,
-    GOOGLE_CLOUD_PROJECT
+    DATA_DIR, DATA_FILE,
+    FIRESTORE_AVAILABLE, DEFAULT_DATA,
+    SETTINGS_CACHE_TTL, SETTINGS_CACHE_MONTH_DOCS,
+    LOCAL_BACKUP_MODE, LOCAL_BACKUP_DELAY, LOCAL_BACKUP_MAX_DELAY
+)
+from .firestore_client import (
+    get_firestore_client, report_firestore_error, report_firestore_success
 )
+from .local_backup import LocalBackupQueue, register_local_backup_queue
+from .shift_storage import get_shift_storage, get_local_shift_storage
 
 if FIRESTORE_AVAILABLE:
     from google.cloud import firestore
 
 
-def get_firestore_client():
-    """Firestoreクライアントを取得"""
-    if not FIRESTORE_AVAILABLE:
-        return None
-    try:
-        # サービスアカウントキーファイルがあれば使用
-        key_path = Path(FIREBASE_KEY_FILE)
-        if key_path.exists():
-            return firestore.Client.from_service_account_json(str(key_path))
-        # プロジェクトIDを明示的に指定（ADC使用時）
-        if GOOGLE_CLOUD_PROJECT:
-            return firestore.Client(project=GOOGLE_CLOUD_PROJECT)
-        return firestore.Client()
-    except Exception as e:
-        print(f"Firestore接続エラー: {e}")
-        return None
-
-
 def ensure_data_dir():
     """データディレクトリを作成"""
     DATA_DIR.mkdir(exist_ok=True)
@@ -45,97 +35,796 @@ def ensure_data_dir():
 # =============================================================================
 # 設定データ管理
 # =============================================================================
+#
+# Firestoreの構成:
+#   locations/{id}        拠点（1拠点1ドキュメント）
+#   staff/{id}            スタッフ（1人1ドキュメント）
+#   ng_days/{YYYY-MM}     月ごとのNG日   {スタッフID: [日付, ...]}
+#   exceptions/{YYYY-MM}  月ごとの例外日 {拠点ID: {"add": [...], "remove": [...]}}
+#
+# ローカル:
+#   data/settings.json              {"locations": [...], "staff": [...]}
+#   data/ng_days/{YYYY-MM}.json
+#   data/exceptions/{YYYY-MM}.json
+#
+# 内部では上記を「パート」という単位で扱う
+#   "locations" / "staff"                     … 一覧（list）
+#   "ng_days/YYYY-MM" / "exceptions/YYYY-MM"  … 月別データ（dict）
+
+ENTITY_PARTS = ('locations', 'staff')
+MONTH_KINDS = ('ng_days', 'exceptions')
+
+
+def _month_key(year, month):
+    return f"{year}-{month:02d}"
+
+
+def _month_part(kind, month_key):
+    return f"{kind}/{month_key}"
+
+
+def _split_part(name):
+    """パート名を(種類, 年月)に分解（一覧パートの年月はNone）"""
+    kind, _, month_key = name.partition('/')
+    return kind, month_key or None
+
+
+def _empty_part(name):
+    return [] if name in ENTITY_PARTS else {}
+
+
+def split_settings_document(data):
+    """旧形式の設定ドキュメント（settings/main）を新しい構成に分割
+
+    Returns:
+        {"locations": [...], "staff": [...],
+         "ng_days": {"YYYY-MM": {...}}, "exceptions": {"YYYY-MM": {...}}}
+    """
+    ng_days_by_month = {}
+    for staff_id, dates in (data.get('ng_days') or {}).items():
+        for date_str in dates:
+            month_days = ng_days_by_month.setdefault(date_str[:7], {})
+            month_days.setdefault(str(staff_id), []).append(date_str)
+
+    return {
+        "locations": list(data.get('locations', [])),
+        "staff": list(data.get('staff', [])),
+        "ng_days": ng_days_by_month,
+        "exceptions": {k: v for k, v in (data.get('exceptions') or {}).items() if v},
+    }
 
-def load_data():
-    """データを読み込む（Firestore優先、ローカルフォールバック）"""
-    db = get_firestore_client()
-    if db:
-        try:
-            doc = db.collection('settings').document('main').get()
+
+# -----------------------------------------------------------------------------
+# リクエスト単位の設定スナップショット
+# {"parts": 読み込んだパート（リクエスト内で変更してよい複製）,
+#  "base": 読み込み時点のパート（差分計算用、変更しない）,
+#  "dirty": 変更したパート名}
+# -----------------------------------------------------------------------------
+
+_settings_session = ContextVar('settings_session', default=None)
+
+
+def begin_settings_session():
+    """設定スナップショットを開始（リクエスト開始時に呼ぶ）"""
+    _settings_session.set({"parts": {}, "base": {}, "dirty": set()})
+
+
+def end_settings_session(commit=True):
+    """設定スナップショットを終了し、変更があれば1回の書き込みで保存"""
+    session = _settings_session.get()
+    _settings_session.set(None)
+    if not session or not commit or not session['dirty']:
+        return
+    names = session['dirty']
+    _write_parts(
+        {name: session['parts'][name] for name in names},
+        {name: session['base'][name] for name in names},
+    )
+
+
+def _load_part(name):
+    """パートを読み込む（スナップショット中は1リクエストにつき1回だけ）"""
+    session = _settings_session.get()
+    if session is not None and name in session['parts']:
+        return session['parts'][name]
+    base = _read_part(name)
+    value = deepcopy(base)
+    if session is not None:
+        session['base'][name] = base
+        session['parts'][name] = value
+    return value
+
+
+def _save_part(name, value, base=None):
+    """パートを保存（スナップショット中はリクエスト終了時にまとめて保存）
+
+    base: 読み込み済みの現在の内容（省略時はキャッシュ経由で読む）
+    """
+    session = _settings_session.get()
+    if session is None:
+        _write_parts({name: value}, {name: _read_part(name) if base is None else base})
+        return
+    if name not in session['base']:
+        session['base'][name] = _read_part(name) if base is None else base
+    session['parts'][name] = value
+    session['dirty'].add(name)
+
+
+# -----------------------------------------------------------------------------
+# プロセス内の設定キャッシュ
+# パートごとに {"data", "version", "source", "loaded_at"} を持つ
+# version: Firestoreは更新時刻、ローカルはファイルのmtime_ns
+# 月別パートは件数に上限を設け、古いものから捨てる
+# -----------------------------------------------------------------------------
+
+_settings_cache = OrderedDict()
+_settings_cache_lock = threading.Lock()
+_settings_listener_lock = threading.Lock()
+_settings_cache_stats = {"hits": 0, "misses": 0, "invalidations": 0, "listener_updates": 0}
+_settings_listeners = {}
+_settings_listener_pid = None
+
+
+def _local_part_path(name):
+    """パートのローカルファイルパス"""
+    kind, month_key = _split_part(name)
+    if month_key is None:
+        return DATA_FILE
+    return DATA_DIR / kind / f"{month_key}.json"
+
+
+def _local_part_version(name):
+    """ローカルファイルのバージョン（mtime）"""
+    try:
+        return _local_part_path(name).stat().st_mtime_ns
+    except OSError:
+        return None
+
+
+def _unsubscribe(listener):
+    try:
+        listener.unsubscribe()
+    except Exception:
+        pass
+
+
+def _store_part_cache(name, data, version, source):
+    """キャッシュを更新（同じ取得元の古いバージョンでは上書きしない）"""
+    evicted = []
+    with _settings_cache_lock:
+        current = _settings_cache.get(name)
+        if (current is not None and current['source'] == source
+                and current['version'] is not None and version is not None
+                and version < current['version']):
+            return
+        _settings_cache[name] = {
+            "data": deepcopy(data),
+            "version": version,
+            "source": source,
+            "loaded_at": time.monotonic(),
+        }
+        _settings_cache.move_to_end(name)
+        month_names = [n for n in _settings_cache if n not in ENTITY_PARTS]
+        for old_name in month_names[:max(0, len(month_names) - SETTINGS_CACHE_MONTH_DOCS)]:
+            del _settings_cache[old_name]
+            evicted.append(old_name)
+    for old_name in evicted:
+        listener = _settings_listeners.pop(old_name, None)
+        if listener is not None:
+            _unsubscribe(listener)
+
+
+def invalidate_settings_cache(name=None):
+    """設定キャッシュを破棄（次回読み込み時に取り直す）"""
+    with _settings_cache_lock:
+        if name is None:
+            _settings_cache.clear()
+        else:
+            _settings_cache.pop(name, None)
+        _settings_cache_stats['invalidations'] += 1
+
+
+def _part_cache_is_fresh(name, entry):
+    """キャッシュがそのまま使えるか"""
+    if entry is None or SETTINGS_CACHE_TTL <= 0:
+        return False
+    if time.monotonic() - entry['loaded_at'] > SETTINGS_CACHE_TTL:
+        return False
+    if entry['source'] == 'firestore':
+        # 変更はリスナーが反映する
+        return True
+    # ローカル読み込み中にFirestoreが復帰したら読み直す
+    if get_firestore_client() is not None:
+        return False
+    return _local_part_version(name) == entry['version']
+
+
+def _entity_list(docs):
+    """拠点・スタッフのドキュメント群を一覧（ID順）に変換"""
+    items = [doc.to_dict() for doc in docs if doc.exists]
+    items.sort(key=lambda item: item.get('id', 0))
+    return items
+
+
+def _on_entity_snapshot(name):
+    """locations / staff コレクションの変更通知"""
+    def callback(doc_snapshots, changes, read_time):
+        _settings_cache_stats['listener_updates'] += 1
+        _store_part_cache(name, _entity_list(doc_snapshots), read_time, 'firestore')
+    return callback
+
+
+def _on_month_snapshot(name):
+    """ng_days / exceptions の月別ドキュメントの変更通知"""
+    def callback(doc_snapshots, changes, read_time):
+        _settings_cache_stats['listener_updates'] += 1
+        data = {}
+        for doc in doc_snapshots:
             if doc.exists:
-                return doc.to_dict()
+                data = doc.to_dict()
+        _store_part_cache(name, data, read_time, 'firestore')
+    return callback
+
+
+def _ensure_part_listener(db, name):
+    """パートの変更リスナーを開始（プロセスごとに1つ）"""
+    global _settings_listener_pid
+    pid = os.getpid()
+    if _settings_listener_pid == pid and name in _settings_listeners:
+        return
+    with _settings_listener_lock:
+        if _settings_listener_pid != pid:
+            _settings_listeners.clear()
+            _settings_listener_pid = pid
+        if name in _settings_listeners:
+            return
+        try:
+            kind, month_key = _split_part(name)
+            if month_key is None:
+                listener = db.collection(kind).on_snapshot(_on_entity_snapshot(name))
+            else:
+                listener = db.collection(kind).document(month_key).on_snapshot(
+                    _on_month_snapshot(name))
+            _settings_listeners[name] = listener
         except Exception as e:
-            print(f"Firestore読み込みエラー: {e}")
+            print(f"設定変更リスナー開始エラー: {e}")
 
-    # ローカルファイルにフォールバック
-    ensure_data_dir()
-    if DATA_FILE.exists():
+
+def _fetch_part_firestore(db, name):
+    """Firestoreからパートを読み込む
+
+    Returns:
+        (data, version)
+    """
+    _migrate_legacy_settings(db)
+    kind, month_key = _split_part(name)
+    if month_key is None:
+        docs = list(db.collection(kind).stream())
+        version = max((doc.read_time for doc in docs if doc.read_time), default=None)
+        return _entity_list(docs), version
+
+    doc = db.collection(kind).document(month_key).get()
+    return (doc.to_dict() if doc.exists else {}), doc.read_time
+
+
+def _fetch_part_local(name):
+    """ローカルファイルからパートを読み込む
+
+    Returns:
+        (data, version)
+    """
+    _migrate_legacy_local_settings()
+    kind, month_key = _split_part(name)
+    path = _local_part_path(name)
+    version = _local_part_version(name)
+    if version is not None:
         try:
-            with open(DATA_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            return (data.get(kind, []) if month_key is None else data), version
         except (json.JSONDecodeError, IOError):
             pass
-    return deepcopy(DEFAULT_DATA)
+    if month_key is None:
+        return deepcopy(DEFAULT_DATA[kind]), version
+    return {}, version
 
 
-def save_data(data):
-    """データを保存（Firestoreとローカル両方）"""
+def _read_part(name):
+    """パートを読み込む（キャッシュ経由）
+
+    戻り値はキャッシュと共有しているため変更しないこと
+    """
+    entry = _settings_cache.get(name)
+    if _part_cache_is_fresh(name, entry):
+        _settings_cache_stats['hits'] += 1
+        return entry['data']
+
+    _settings_cache_stats['misses'] += 1
     db = get_firestore_client()
     if db:
         try:
-            db.collection('settings').document('main').set(data)
+            data, version = _fetch_part_firestore(db, name)
+            report_firestore_success()
+            _ensure_part_listener(db, name)
+            _store_part_cache(name, data, version, 'firestore')
+            return _settings_cache[name]['data'] if name in _settings_cache else data
+        except Exception as e:
+            print(f"Firestore読み込みエラー: {e}")
+            report_firestore_error()
+
+    # ローカルファイルにフォールバック（未書き込みのバックアップを先に反映）
+    _local_backup.flush()
+    data, version = _fetch_part_local(name)
+    _store_part_cache(name, data, version, 'local')
+    return data
+
+
+def _part_write_ops(db, name, value, base):
+    """パートの差分をFirestoreの書き込み操作に変換
+
+    Returns:
+        [("set", ドキュメント参照, データ) | ("delete", ドキュメント参照, None)]
+    """
+    kind, month_key = _split_part(name)
+    collection = db.collection(kind)
+    if month_key is not None:
+        if value == base:
+            return []
+        if not value:
+            return [("delete", collection.document(month_key), None)]
+        return [("set", collection.document(month_key), value)]
+
+    ops = []
+    base_by_id = {str(item['id']): item for item in base}
+    new_ids = set()
+    for item in value:
+        doc_id = str(item['id'])
+        new_ids.add(doc_id)
+        if base_by_id.get(doc_id) != item:
+            ops.append(("set", collection.document(doc_id), item))
+    for doc_id in base_by_id:
+        if doc_id not in new_ids:
+            ops.append(("delete", collection.document(doc_id), None))
+    return ops
+
+
+def _commit_ops(db, ops):
+    """書き込み操作をバッチでコミット（1バッチ最大500件）
+
+    Returns:
+        最後のコミット時刻
+    """
+    commit_time = None
+    for start in range(0, len(ops), 500):
+        batch = db.batch()
+        for op, ref, data in ops[start:start + 500]:
+            if op == "set":
+                batch.set(ref, data)
+            else:
+                batch.delete(ref)
+        results = batch.commit()
+        if results:
+            commit_time = results[-1].update_time
+    return commit_time
+
+
+def _write_json_file(path, data):
+    """JSONファイルを書き込む（一時ファイル経由で置き換え）"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(path.name + '.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+    os.replace(tmp_path, path)
+
+
+def _write_local_parts(parts):
+    """パートをローカルファイルに書き込む"""
+    ensure_data_dir()
+    entity_parts = {name: value for name, value in parts.items() if name in ENTITY_PARTS}
+    if entity_parts:
+        core = {}
+        if DATA_FILE.exists():
+            try:
+                with open(DATA_FILE, 'r', encoding='utf-8') as f:
+                    core = json.load(f)
+            except (json.JSONDecodeError, IOError):
+                core = {}
+        for name in ENTITY_PARTS:
+            core.setdefault(name, deepcopy(DEFAULT_DATA[name]))
+        core.update(entity_parts)
+        _write_json_file(DATA_FILE, core)
+
+    for name, value in parts.items():
+        if name in ENTITY_PARTS:
+            continue
+        path = _local_part_path(name)
+        if value:
+            _write_json_file(path, value)
+        elif path.exists():
+            path.unlink()
+
+
+_local_backup = LocalBackupQueue(_write_local_parts, LOCAL_BACKUP_DELAY, LOCAL_BACKUP_MAX_DELAY)
+register_local_backup_queue(_local_backup)
+
+
+def _should_cache_written_part(name):
+    """保存したパートをキャッシュに入れるか
+
+    月別パートはキャッシュにある月だけを更新する（まとめて保存した月でキャッシュを入れ替えない）
+    """
+    return name in ENTITY_PARTS or name in _settings_cache
+
+
+def _write_parts(parts, bases):
+    """変更したパートを保存（Firestoreには差分だけを1回のバッチで送る）"""
+    db = get_firestore_client()
+    if db:
+        try:
+            ops = []
+            for name, value in parts.items():
+                ops.extend(_part_write_ops(db, name, value, bases.get(name, _empty_part(name))))
+            commit_time = _commit_ops(db, ops) if ops else None
+            report_firestore_success()
+            for name, value in parts.items():
+                if _should_cache_written_part(name):
+                    _store_part_cache(name, value, commit_time, 'firestore')
+
+            # ローカルのバックアップは設定に従って書き込む
+            if LOCAL_BACKUP_MODE == 'async':
+                _local_backup.enqueue(deepcopy(parts))
+            elif LOCAL_BACKUP_MODE == 'sync':
+                _local_backup.write_now(parts)
+            return
         except Exception as e:
             print(f"Firestore保存エラー: {e}")
+            report_firestore_error()
+            for name in parts:
+                invalidate_settings_cache(name)
 
-    # ローカルにも保存（バックアップ）
-    ensure_data_dir()
-    with open(DATA_FILE, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    # Firestoreに保存できなければローカルが保存先
+    _local_backup.write_now(parts)
+    for name, value in parts.items():
+        entry = _settings_cache.get(name)
+        if _should_cache_written_part(name) and (entry is None or entry['source'] != 'firestore'):
+            _store_part_cache(name, value, _local_part_version(name), 'local')
+
+
+def _list_months(kind):
+    """保存されている月（YYYY-MM）の一覧"""
+    db = get_firestore_client()
+    if db:
+        try:
+            months = [ref.id for ref in db.collection(kind).list_documents()]
+            report_firestore_success()
+            return sorted(months)
+        except Exception as e:
+            print(f"Firestore読み込みエラー: {e}")
+            report_firestore_error()
+    kind_dir = DATA_DIR / kind
+    if not kind_dir.exists():
+        return []
+    return sorted(path.stem for path in kind_dir.glob('*.json'))
+
+
+def _scan_months(kind, months=None):
+    """月別パートをまとめて読み込む {"YYYY-MM": データ}（保存されている月のみ）
+
+    全期間・範囲の読み込みで月別キャッシュ（上限 SETTINGS_CACHE_MONTH_DOCS 件）を入れ替えたり
+    リスナーを開始・停止したりしないよう、キャッシュを通さず1回の問い合わせで読む。
+    months（[(年, 月), ...]、calendar_service.month_range の結果）を指定するとその月だけを読む。
+    リクエスト内で読み込み・変更した月はその内容を返す
+    """
+    month_keys = None if months is None else [_month_key(year, month) for year, month in months]
+    found = None
+    db = get_firestore_client()
+    if db:
+        try:
+            _migrate_legacy_settings(db)
+            collection = db.collection(kind)
+            if month_keys is None:
+                docs = collection.stream()
+            else:
+                docs = db.get_all([collection.document(key) for key in month_keys])
+            found = {doc.id: doc.to_dict() for doc in docs if doc.exists}
+            report_firestore_success()
+        except Exception as e:
+            print(f"Firestore読み込みエラー: {e}")
+            report_firestore_error()
+
+    if found is None:
+        _local_backup.flush()
+        _migrate_legacy_local_settings()
+        keys = _list_months(kind) if month_keys is None else month_keys
+        found = {}
+        for month_key in keys:
+            data, version = _fetch_part_local(_month_part(kind, month_key))
+            if version is not None and data:
+                found[month_key] = data
+
+    session = _settings_session.get()
+    if session is not None:
+        for name, value in session['parts'].items():
+            part_kind, month_key = _split_part(name)
+            if part_kind != kind or (month_keys is not None and month_key not in month_keys):
+                continue
+            if value:
+                found[month_key] = value
+            else:
+                found.pop(month_key, None)
+    return dict(sorted(found.items()))
+
+
+def _replace_months(kind, by_month, months=None):
+    """月別パートを by_month {"YYYY-MM": データ} で置き換え（内容が変わった月だけを保存）
+
+    months（[(年, 月), ...]）を指定するとその月だけを置き換える（ほかの月は by_month にあっても無視）
+    """
+    current = _scan_months(kind, months)
+    if months is not None:
+        month_keys = {_month_key(year, month) for year, month in months}
+        by_month = {k: v for k, v in by_month.items() if k in month_keys}
+    for month_key in set(current) | set(by_month):
+        value = by_month.get(month_key) or {}
+        base = current.get(month_key, {})
+        if value != base:
+            _save_part(_month_part(kind, month_key), value, base)
+
+
+# -----------------------------------------------------------------------------
+# 旧形式（settings/main 1ドキュメント）からの移行
+# -----------------------------------------------------------------------------
+
+def _legacy_split_ops(db, split):
+    """分割済みの設定を書き込み操作に変換"""
+    ops = []
+    for name in ENTITY_PARTS:
+        for item in split[name]:
+            ops.append(("set", db.collection(name).document(str(item['id'])), item))
+    for kind in MONTH_KINDS:
+        for month_key, value in split[kind].items():
+            ops.append(("set", db.collection(kind).document(month_key), value))
+    return ops
+
+
+def migrate_legacy_settings(db=None, force=False):
+    """Firestoreの settings/main を新しい構成に移行
+
+    Args:
+        force: 移行済みでも再度移行する
+
+    Returns:
+        移行したかどうか
+    """
+    db = db or get_firestore_client()
+    if db is None:
+        return False
+    legacy_ref = db.collection('settings').document('main')
+    legacy = legacy_ref.get()
+    if not legacy.exists:
+        return False
+    data = legacy.to_dict()
+    if data.get('migrated_at') and not force:
+        return False
+
+    _commit_ops(db, _legacy_split_ops(db, split_settings_document(data)))
+    legacy_ref.update({"migrated_at": firestore.SERVER_TIMESTAMP})
+    invalidate_settings_cache()
+    print("設定データを新しい構成に移行しました")
+    return True
+
+
+_legacy_checked_pid = None
+
+
+def _migrate_legacy_settings(db):
+    """旧形式が残っていれば移行する（確認はプロセスごとに1回）"""
+    global _legacy_checked_pid
+    if _legacy_checked_pid == os.getpid():
+        return
+    _legacy_checked_pid = os.getpid()
+    try:
+        migrate_legacy_settings(db)
+    except Exception as e:
+        print(f"設定データ移行エラー: {e}")
+        _legacy_checked_pid = None
+
+
+_legacy_local_checked = False
+
+
+def _migrate_legacy_local_settings():
+    """settings.json に残っているNG日・例外日を月別ファイルに移す（確認はプロセスごとに1回）"""
+    global _legacy_local_checked
+    if _legacy_local_checked:
+        return
+    if not DATA_FILE.exists():
+        _legacy_local_checked = True
+        return
+    try:
+        with open(DATA_FILE, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except (json.JSONDecodeError, IOError):
+        return
+    _legacy_local_checked = True
+    if 'ng_days' not in data and 'exceptions' not in data:
+        return
+
+    split = split_settings_document(data)
+    for kind in MONTH_KINDS:
+        for month_key, value in split[kind].items():
+            path = _local_part_path(_month_part(kind, month_key))
+            if not path.exists():
+                _write_json_file(path, value)
+    _write_json_file(DATA_FILE, {name: split[name] for name in ENTITY_PARTS})
+
+
+# -----------------------------------------------------------------------------
+# 状態確認・fork対応
+# -----------------------------------------------------------------------------
+
+def get_local_backup_stats():
+    """ローカルバックアップのキューの状態を取得"""
+    stats = _local_backup.get_stats()
+    stats['mode'] = LOCAL_BACKUP_MODE
+    return stats
+
+
+def get_settings_cache_stats():
+    """設定キャッシュの状態・ヒット率を取得"""
+    stats = dict(_settings_cache_stats)
+    total = stats['hits'] + stats['misses']
+    entries = dict(_settings_cache)
+    stats.update({
+        "hit_rate": round(stats['hits'] / total, 3) if total else 0.0,
+        "ttl_seconds": SETTINGS_CACHE_TTL,
+        "listening": len(_settings_listeners) if _settings_listener_pid == os.getpid() else 0,
+        "parts": {
+            name: {
+                "source": entry['source'],
+                "version": str(entry['version']) if entry['version'] is not None else None,
+                "age_seconds": round(time.monotonic() - entry['loaded_at'], 1),
+            }
+            for name, entry in entries.items()
+        },
+    })
+    return stats
+
+
+def _reset_settings_cache_after_fork():
+    """fork後の子プロセスでキャッシュとリスナーを初期化"""
+    global _settings_cache_lock, _settings_listener_lock, _settings_listener_pid, _legacy_local_checked
+    _settings_cache_lock = threading.Lock()
+    _settings_listener_lock = threading.Lock()
+    _settings_listeners.clear()
+    _settings_listener_pid = None
+    _settings_cache.clear()
+    _legacy_local_checked = False
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_settings_cache_after_fork)
+
+
+# -----------------------------------------------------------------------------
+# 公開API
+# -----------------------------------------------------------------------------
+
+def load_data():
+    """全設定を旧形式（1つの辞書）で読み込む（エクスポート用）"""
+    data = {name: _load_part(name) for name in ENTITY_PARTS}
+    data['ng_days'] = get_ng_days()
+    data['exceptions'] = get_exceptions()
+    return data
+
+
+def save_data(data):
+    """全設定を旧形式（1つの辞書）から保存（インポート・リセット用）"""
+    split = split_settings_document(data)
+    for name in ENTITY_PARTS:
+        _save_part(name, split[name])
+    for kind in MONTH_KINDS:
+        _replace_months(kind, split[kind])
 
 
 def get_locations():
-    data = load_data()
-    return data.get('locations', [])
+    return _load_part('locations')
 
 
 def set_locations(locations):
-    data = load_data()
-    data['locations'] = locations
-    save_data(data)
+    _save_part('locations', locations)
 
 
 def get_staff():
-    data = load_data()
-    return data.get('staff', [])
+    return _load_part('staff')
 
 
 def set_staff(staff):
-    data = load_data()
-    data['staff'] = staff
-    save_data(data)
+    _save_part('staff', staff)
+
 
+def get_month_ng_days(year, month):
+    """指定年月のNG日 {スタッフID: [日付]}"""
+    return _load_part(_month_part('ng_days', _month_key(year, month)))
 
-def get_ng_days():
-    data = load_data()
-    return data.get('ng_days', {})
 
+def set_month_ng_days(year, month, ng_days):
+    """指定年月のNG日だけを更新"""
+    name = _month_part('ng_days', _month_key(year, month))
+    if _load_part(name) != ng_days:
+        _save_part(name, ng_days)
 
-def set_ng_days(ng_days):
-    data = load_data()
-    data['ng_days'] = ng_days
-    save_data(data)
 
+def get_ng_days(months=None):
+    """全期間（months [(年, 月), ...] を指定するとその月）のNG日 {スタッフID: [日付]}"""
+    ng_days = {}
+    for month_days in _scan_months('ng_days', months).values():
+        for staff_id, dates in month_days.items():
+            ng_days.setdefault(staff_id, []).extend(dates)
+    return ng_days
 
-def get_exceptions():
-    data = load_data()
-    return data.get('exceptions', {})
 
+def set_ng_days(ng_days, months=None):
+    """全期間（months を指定するとその月）のNG日を置き換え（変わった月だけを保存）"""
+    by_month = split_settings_document({"ng_days": ng_days})['ng_days']
+    _replace_months('ng_days', by_month, months)
 
-def set_exceptions(exceptions):
-    data = load_data()
-    data['exceptions'] = exceptions
-    save_data(data)
+
+def get_month_exceptions(year, month):
+    """指定年月の例外日 {拠点ID: {"add": [], "remove": []}}"""
+    return _load_part(_month_part('exceptions', _month_key(year, month)))
+
+
+def set_month_exceptions(year, month, month_exceptions):
+    """指定年月の例外日だけを更新"""
+    name = _month_part('exceptions', _month_key(year, month))
+    if _load_part(name) != month_exceptions:
+        _save_part(name, month_exceptions)
+
+
+def get_exceptions(months=None):
+    """全期間（months [(年, 月), ...] を指定するとその月）の例外日 {"YYYY-MM": {...}}（保存されている月のみ）"""
+    return _scan_months('exceptions', months)
+
+
+def set_exceptions(exceptions, months=None):
+    """全期間（months を指定するとその月）の例外日を置き換え（変わった月だけを保存）"""
+    _replace_months('exceptions', exceptions or {}, months)
 
 
 # =============================================================================
 # シフトデータ管理
 # =============================================================================
 
+def _report_storage_result(storage, ok):
+    """Firestoreの成否を接続管理に伝える"""
+    if not storage.remote:
+        return
+    if ok:
+        report_firestore_success()
+    else:
+        report_firestore_error()
+
+
+_shift_change_listeners = []
+
+
+def add_shift_change_listener(listener):
+    """シフトの保存・削除の後に listener([(年, 月), ...]) を呼ぶ（このプロセス内の変更のみ）"""
+    _shift_change_listeners.append(listener)
+
+
+def _notify_shift_change(months):
+    for listener in _shift_change_listeners:
+        try:
+            listener(months)
+        except Exception as e:
+            print(f"シフト変更通知エラー: {e}")
+
+
 def save_shift(year, month, shift_data, staff_counts, ng_days_data, exceptions_data):
     """シフトを保存"""
-    db = get_firestore_client()
-    doc_id = f"{year}-{month:02d}"
-
+    storage = get_shift_storage()
     shift_doc = {
         "year": year,
         "month": month,
@@ -143,130 +832,109 @@ def save_shift(year, month, shift_data, staff_counts, ng_days_data, exceptions_d
         "staff_counts": staff_counts,
         "ng_days": ng_days_data,
         "exceptions": exceptions_data,
-        "created_at": firestore.SERVER_TIMESTAMP if db else datetime.now().isoformat(),
-        "updated_at": firestore.SERVER_TIMESTAMP if db else datetime.now().isoformat()
     }
+    try:
+        storage.save(year, month, shift_doc)
+        _report_storage_result(storage, True)
+        _notify_shift_change([(year, month)])
+        return True
+    except Exception as e:
+        print(f"シフト保存エラー: {e}")
+        _report_storage_result(storage, False)
+        return False
 
-    if db:
-        try:
-            db.collection('shifts').document(doc_id).set(shift_doc)
-            return True
-        except Exception as e:
-            print(f"シフト保存エラー: {e}")
-            return False
 
-    # ローカルフォールバック
-    ensure_data_dir()
-    shifts = {}
-    if SHIFTS_FILE.exists():
-        try:
-            with open(SHIFTS_FILE, 'r', encoding='utf-8') as f:
-                shifts = json.load(f)
-        except:
-            pass
-
-    shift_doc['created_at'] = datetime.now().isoformat()
-    shift_doc['updated_at'] = datetime.now().isoformat()
-    shifts[doc_id] = shift_doc
+def save_shifts(shift_docs):
+    """複数月のシフトを1回のバッチで保存
 
-    with open(SHIFTS_FILE, 'w', encoding='utf-8') as f:
-        json.dump(shifts, f, ensure_ascii=False, indent=2)
-    return True
+    Args:
+        shift_docs: [{year, month, shift_data, staff_counts, ng_days, exceptions}, ...]
+    """
+    storage = get_shift_storage()
+    try:
+        storage.save_many(shift_docs)
+        _report_storage_result(storage, True)
+        _notify_shift_change([(doc['year'], doc['month']) for doc in shift_docs])
+        return True
+    except Exception as e:
+        print(f"シフト保存エラー: {e}")
+        _report_storage_result(storage, False)
+        return False
 
 
 def load_shift(year, month):
     """シフトを読み込み"""
-    db = get_firestore_client()
-    doc_id = f"{year}-{month:02d}"
-
-    if db:
-        try:
-            doc = db.collection('shifts').document(doc_id).get()
-            if doc.exists:
-                data = doc.to_dict()
-                if data.get('created_at') and hasattr(data['created_at'], 'isoformat'):
-                    data['created_at'] = data['created_at'].isoformat()
-                if data.get('updated_at') and hasattr(data['updated_at'], 'isoformat'):
-                    data['updated_at'] = data['updated_at'].isoformat()
-                return data
-        except Exception as e:
-            print(f"シフト読み込みエラー: {e}")
+    storage = get_shift_storage()
+    try:
+        data = storage.load(year, month)
+        _report_storage_result(storage, True)
+        if data is not None or not storage.remote:
+            return data
+    except Exception as e:
+        print(f"シフト読み込みエラー: {e}")
+        _report_storage_result(storage, False)
+        if not storage.remote:
+            return None
 
     # ローカルフォールバック
-    if SHIFTS_FILE.exists():
-        try:
-            with open(SHIFTS_FILE, 'r', encoding='utf-8') as f:
-                shifts = json.load(f)
-                return shifts.get(doc_id)
-        except:
-            pass
-    return None
+    try:
+        return get_local_shift_storage().load(year, month)
+    except Exception as e:
+        print(f"シフト読み込みエラー: {e}")
+        return None
 
 
 def delete_shift(year, month):
     """シフトを削除"""
-    db = get_firestore_client()
-    doc_id = f"{year}-{month:02d}"
-
-    if db:
-        try:
-            db.collection('shifts').document(doc_id).delete()
-            return True
-        except Exception as e:
-            print(f"シフト削除エラー: {e}")
-            return False
-
-    # ローカルフォールバック
-    if SHIFTS_FILE.exists():
-        try:
-            with open(SHIFTS_FILE, 'r', encoding='utf-8') as f:
-                shifts = json.load(f)
-            if doc_id in shifts:
-                del shifts[doc_id]
-                with open(SHIFTS_FILE, 'w', encoding='utf-8') as f:
-                    json.dump(shifts, f, ensure_ascii=False, indent=2)
-                return True
-        except:
-            pass
-    return False
+    storage = get_shift_storage()
+    try:
+        deleted = storage.delete(year, month)
+        _report_storage_result(storage, True)
+        if deleted:
+            _notify_shift_change([(year, month)])
+        return deleted
+    except Exception as e:
+        print(f"シフト削除エラー: {e}")
+        _report_storage_result(storage, False)
+        return False
 
 
-def list_shifts():
-    """保存済みシフト一覧を取得"""
-    db = get_firestore_client()
-    shifts_list = []
+def list_shifts(limit=None, before=None):
+    """保存済みシフト一覧を取得（年月の降順）
 
-    if db:
-        try:
-            # インデックス不要のシンプルなクエリを使用し、クライアント側でソート
-            docs = db.collection('shifts').stream()
-            for doc in docs:
-                data = doc.to_dict()
-                shifts_list.append({
-                    "id": doc.id,
-                    "year": data.get('year'),
-                    "month": data.get('month'),
-                    "updated_at": data.get('updated_at').isoformat() if hasattr(data.get('updated_at'), 'isoformat') else data.get('updated_at')
-                })
-            # クライアント側で年月の降順にソート
-            shifts_list.sort(key=lambda x: (x['year'], x['month']), reverse=True)
-            return shifts_list
-        except Exception as e:
-            print(f"シフト一覧取得エラー: {e}")
+    Args:
+        limit: 最大件数（Noneなら全件）
+        before: このID（YYYY-MM）より前の月だけを返す
+    """
+    storage = get_shift_storage()
+    try:
+        shifts_list = storage.list(limit=limit, before=before)
+        _report_storage_result(storage, True)
+        return shifts_list
+    except Exception as e:
+        print(f"シフト一覧取得エラー: {e}")
+        _report_storage_result(storage, False)
+        if not storage.remote:
+            return []
 
     # ローカルフォールバック
-    if SHIFTS_FILE.exists():
-        try:
-            with open(SHIFTS_FILE, 'r', encoding='utf-8') as f:
-                shifts = json.load(f)
-            for doc_id, data in shifts.items():
-                shifts_list.append({
-                    "id": doc_id,
-                    "year": data.get('year'),
-                    "month": data.get('month'),
-                    "updated_at": data.get('updated_at')
-                })
-            shifts_list.sort(key=lambda x: (x['year'], x['month']), reverse=True)
-        except:
-            pass
-    return shifts_list
+    try:
+        return get_local_shift_storage().list(limit=limit, before=before)
+    except Exception as e:
+        print(f"シフト一覧取得エラー: {e}")
+        return []
+
+
+def list_shifts_page(limit, cursor=None):
+    """保存済みシフト一覧を1ページ分取得
+
+    Returns:
+        {"shifts": [...], "next_cursor": 次のページのカーソル（最後のページならNone）}
+    """
+    shifts_list = list_shifts(limit=limit + 1, before=cursor)
+    has_more = len(shifts_list) > limit
+    shifts_list = shifts_list[:limit]
+    return {
+        "shifts": shifts_list,
+        "next_cursor": shifts_list[-1]['id'] if has_more else None
+    }
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+Firestoreクライアント管理（プロセス内で1つのクライアントを共有）
+
+- 初回利用時に接続を作成し、以後は全スレッドで使い回す
+- 連続で失敗したら接続を破棄し、一定時間はFirestoreを使わない（サーキットブレーカー）
+- fork後の子プロセスでは親の接続を使わずに作り直す
+"""
+
+import os
+import threading
+import time
+from pathlib import Path
+
+from config import (
+    FIRESTORE_AVAILABLE, FIREBASE_KEY_FILE, GOOGLE_CLOUD_PROJECT,
+    FIRESTORE_FAILURE_THRESHOLD, FIRESTORE_RETRY_INTERVAL
+)
+
+if FIRESTORE_AVAILABLE:
+    from google.cloud import firestore
+
+
+_lock = threading.Lock()
+_client = None
+_client_pid = None
+_consecutive_failures = 0
+_circuit_open_until = 0.0
+
+_stats = {
+    "clients_created": 0,
+    "clients_closed": 0,
+    "connect_errors": 0,
+    "request_errors": 0,
+    "circuit_trips": 0,
+    "fork_resets": 0,
+}
+
+
+def _create_client():
+    """Firestoreクライアントを新規作成"""
+    # サービスアカウントキーファイルがあれば使用
+    key_path = Path(FIREBASE_KEY_FILE)
+    if key_path.exists():
+        return firestore.Client.from_service_account_json(str(key_path))
+    # プロジェクトIDを明示的に指定（ADC使用時）
+    if GOOGLE_CLOUD_PROJECT:
+        return firestore.Client(project=GOOGLE_CLOUD_PROJECT)
+    return firestore.Client()
+
+
+def _has_channel(client):
+    """クライアントがgRPCチャネルを開いているか"""
+    return getattr(client, '_firestore_api_internal', None) is not None
+
+
+def _close_client(client):
+    """クライアントのgRPCチャネルを閉じる（失敗しても無視）"""
+    api = getattr(client, '_firestore_api_internal', None)
+    if api is not None:
+        try:
+            api.transport.close()
+        except Exception:
+            pass
+    _stats['clients_closed'] += 1
+
+
+def _discard_client_locked(close=True):
+    """現在のクライアントを破棄（_lockを保持した状態で呼ぶ）"""
+    global _client, _client_pid
+    if _client is not None and close:
+        _close_client(_client)
+    _client = None
+    _client_pid = None
+
+
+def _record_failure_locked():
+    """失敗を記録し、閾値を超えたらサーキットブレーカーを作動させる"""
+    global _consecutive_failures, _circuit_open_until
+    _consecutive_failures += 1
+    if _consecutive_failures >= FIRESTORE_FAILURE_THRESHOLD:
+        _discard_client_locked()
+        _circuit_open_until = time.monotonic() + FIRESTORE_RETRY_INTERVAL
+        _consecutive_failures = 0
+        _stats['circuit_trips'] += 1
+        print(f"Firestore接続を一時停止します（{FIRESTORE_RETRY_INTERVAL:.0f}秒後に再接続）")
+
+
+def get_firestore_client():
+    """Firestoreクライアントを取得（プロセス内で共有）"""
+    global _client, _client_pid
+    if not FIRESTORE_AVAILABLE:
+        return None
+
+    pid = os.getpid()
+    client = _client
+    if client is not None and _client_pid == pid:
+        return client
+
+    with _lock:
+        if _client is not None and _client_pid != pid:
+            # fork前の接続は子プロセスでは使えないため閉じずに捨てる
+            _discard_client_locked(close=False)
+            _stats['fork_resets'] += 1
+        if _client is not None:
+            return _client
+        if time.monotonic() < _circuit_open_until:
+            return None
+        try:
+            _client = _create_client()
+            _client_pid = pid
+            _stats['clients_created'] += 1
+            return _client
+        except Exception as e:
+            print(f"Firestore接続エラー: {e}")
+            _stats['connect_errors'] += 1
+            _record_failure_locked()
+            return None
+
+
+def report_firestore_error():
+    """Firestore操作の失敗を記録"""
+    _stats['request_errors'] += 1
+    with _lock:
+        _record_failure_locked()
+
+
+def report_firestore_success():
+    """Firestore操作の成功を記録（連続失敗数をリセット）"""
+    global _consecutive_failures
+    _consecutive_failures = 0
+
+
+def reset_firestore_client():
+    """クライアントを破棄し、次回利用時に再接続させる"""
+    global _consecutive_failures, _circuit_open_until
+    with _lock:
+        _discard_client_locked()
+        _consecutive_failures = 0
+        _circuit_open_until = 0.0
+
+
+def get_firestore_stats():
+    """接続状態・カウンターを取得"""
+    client = _client
+    alive = client is not None and _client_pid == os.getpid()
+    stats = dict(_stats)
+    stats.update({
+        "available": FIRESTORE_AVAILABLE,
+        "clients_alive": 1 if alive else 0,
+        "channels_open": 1 if alive and _has_channel(client) else 0,
+        "consecutive_failures": _consecutive_failures,
+        "circuit_open": time.monotonic() < _circuit_open_until,
+        "pid": os.getpid(),
+    })
+    return stats
+
+
+def _after_fork_in_child():
+    """fork後の子プロセスで状態を初期化"""
+    global _lock, _client, _client_pid, _consecutive_failures, _circuit_open_until
+    _lock = threading.Lock()
+    if _client is not None:
+        _stats['fork_resets'] += 1
+    _client = None
+    _client_pid = None
+    _consecutive_failures = 0
+    _circuit_open_until = 0.0
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""
+ローカルバックアップの書き込みキュー（write-behind）
+
+Firestoreへの保存に成功したあとのローカルファイル書き込みを
+リクエストのスレッドから切り離し、バックグラウンドでまとめて行う
+
+- 同じパートへの連続した保存は最後の1回だけを書き込む
+- 最後の保存から delay 秒、最初の保存から最大 max_lag 秒で書き込む
+- 終了時（atexit）に残りを書き込む
+"""
+
+import atexit
+import os
+import threading
+import time
+
+
+class LocalBackupQueue:
+    """パート単位のローカル書き込みキュー
+
+    writer は {パート名: 値} を受け取ってファイルに書き込む関数
+    """
+
+    def __init__(self, writer, delay, max_lag):
+        self.writer = writer
+        self.delay = delay
+        self.max_lag = max_lag
+        self._init_state()
+        self._stats = {
+            "enqueued": 0,
+            "coalesced": 0,
+            "flushes": 0,
+            "parts_written": 0,
+            "errors": 0,
+            "last_lag_seconds": 0.0,
+            "max_lag_seconds": 0.0,
+        }
+
+    def _init_state(self):
+        self._cond = threading.Condition()
+        # 書き込み順序を保つため、ファイルへの書き込みは常にこのロックの中で行う
+        self._io_lock = threading.Lock()
+        self._pending = {}
+        self._first_enqueued = None
+        self._last_enqueued = None
+        self._stopping = False
+        self._thread = None
+        self._pid = None
+
+    def _ensure_worker(self):
+        """ワーカースレッドを起動（_condを保持した状態で呼ぶ）"""
+        if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run, name='local-backup', daemon=True)
+        self._pid = os.getpid()
+        self._thread.start()
+
+    def enqueue(self, parts):
+        """パートの書き込みを予約（同じパートの未書き込み分は置き換える）"""
+        now = time.monotonic()
+        with self._cond:
+            for name, value in parts.items():
+                if name in self._pending:
+                    self._stats['coalesced'] += 1
+                self._pending[name] = value
+                self._stats['enqueued'] += 1
+            if self._first_enqueued is None:
+                self._first_enqueued = now
+            self._last_enqueued = now
+            if self._stopping:
+                return
+            self._ensure_worker()
+            self._cond.notify()
+
+    def write_now(self, parts):
+        """すぐに書き込む（同じパートの未書き込み分は破棄）"""
+        with self._io_lock:
+            with self._cond:
+                for name in parts:
+                    self._pending.pop(name, None)
+                if not self._pending:
+                    self._first_enqueued = None
+            self.writer(parts)
+
+    def flush(self):
+        """未書き込みのパートをすべて書き込む"""
+        with self._io_lock:
+            with self._cond:
+                batch = self._pending
+                first_enqueued = self._first_enqueued
+                self._pending = {}
+                self._first_enqueued = None
+            if not batch:
+                return
+            try:
+                self.writer(batch)
+            except Exception as e:
+                print(f"ローカルバックアップ書き込みエラー: {e}")
+                self._stats['errors'] += 1
+                # 新しい値が予約されていなければ次回に再試行
+                with self._cond:
+                    for name, value in batch.items():
+                        self._pending.setdefault(name, value)
+                    if self._first_enqueued is None:
+                        self._first_enqueued = first_enqueued
+                return
+            lag = time.monotonic() - first_enqueued
+            self._stats['flushes'] += 1
+            self._stats['parts_written'] += len(batch)
+            self._stats['last_lag_seconds'] = round(lag, 3)
+            self._stats['max_lag_seconds'] = round(max(self._stats['max_lag_seconds'], lag), 3)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._stopping:
+                    self._cond.wait()
+                if self._stopping:
+                    return
+                # 保存が落ち着くまで待つ（最初の保存から max_lag 秒を上限とする）
+                while self._pending and not self._stopping:
+                    deadline = min(self._last_enqueued + self.delay,
+                                   self._first_enqueued + self.max_lag)
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+            self.flush()
+            if self._pending:
+                # 書き込みに失敗した場合は少し待ってから再試行
+                time.sleep(self.delay)
+
+    def stop(self, timeout=5.0):
+        """ワーカーを止めて残りを書き込む"""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+            thread = self._thread if self._pid == os.getpid() else None
+        if thread is not None:
+            thread.join(timeout)
+        self.flush()
+
+    def get_stats(self):
+        """キューの深さ・遅延などを取得"""
+        with self._cond:
+            depth = len(self._pending)
+            first_enqueued = self._first_enqueued
+            alive = (self._thread is not None and self._pid == os.getpid()
+                     and self._thread.is_alive())
+        stats = dict(self._stats)
+        stats.update({
+            "depth": depth,
+            "lag_seconds": round(time.monotonic() - first_enqueued, 3) if first_enqueued else 0.0,
+            "delay_seconds": self.delay,
+            "max_delay_seconds": self.max_lag,
+            "worker_alive": alive,
+        })
+        return stats
+
+    def reset_after_fork(self):
+        """fork後の子プロセスで状態を初期化（未書き込み分は親プロセスが書き込む）"""
+        self._init_state()
+
+
+def register_local_backup_queue(queue):
+    """終了時とfork時の処理を登録"""
+    atexit.register(queue.stop)
+    if hasattr(os, 'register_at_fork'):
+        os.register_at_fork(after_in_child=queue.reset_after_fork)
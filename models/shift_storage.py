@@ -0,0 +1,348 @@
+# -*- coding: utf-8 -*-
+"""
+シフトデータの保存先（Firestore / SQLite / JSON）
+
+保存先は設定 SHIFT_STORAGE で選ぶ
+- auto:      Firestoreが使えればFirestore、使えなければSQLite
+- firestore: Firestore（接続できないときはSQLite）
+- sqlite:    data/shifts.db（WALモード、年月でインデックス）
+- json:      data/shifts.json（従来の1ファイル形式）
+"""
+
+import json
+import os
+import sqlite3
+import threading
+from datetime import datetime
+
+from config import (
+    DATA_DIR, SHIFTS_FILE, SHIFTS_DB_FILE, SHIFT_STORAGE, FIRESTORE_AVAILABLE
+)
+from .firestore_client import get_firestore_client
+
+if FIRESTORE_AVAILABLE:
+    from google.cloud import firestore
+
+
+def shift_doc_id(year, month):
+    return f"{year}-{month:02d}"
+
+
+def _isoformat(value):
+    """Firestoreのタイムスタンプを文字列に変換"""
+    return value.isoformat() if hasattr(value, 'isoformat') else value
+
+
+def _sort_shift_list(shifts_list):
+    """年月の降順に並べる"""
+    shifts_list.sort(key=lambda x: (x['year'], x['month']), reverse=True)
+    return shifts_list
+
+
+class ShiftStorage:
+    """シフト保存先のインターフェース
+
+    shift_doc は year, month, shift_data, staff_counts, ng_days, exceptions を持つ辞書
+    （created_at / updated_at は保存先が付ける）
+    """
+
+    # Firestoreなどネットワーク越しの保存先か（失敗時にローカルへフォールバックする）
+    remote = False
+
+    def save(self, year, month, shift_doc):
+        raise NotImplementedError
+
+    def load(self, year, month):
+        """シフトを取得（なければNone）"""
+        raise NotImplementedError
+
+    def save_many(self, shift_docs):
+        """複数月のシフトをまとめて保存"""
+        for shift_doc in shift_docs:
+            self.save(shift_doc['year'], shift_doc['month'], shift_doc)
+
+    def delete(self, year, month):
+        """シフトを削除（削除したらTrue）"""
+        raise NotImplementedError
+
+    def list(self, limit=None, before=None):
+        """保存済みシフトの一覧 [{id, year, month, updated_at}]（年月の降順）
+
+        Args:
+            limit: 最大件数（Noneなら全件）
+            before: このID（YYYY-MM）より前の月だけを返す（ページ送り用）
+        """
+        raise NotImplementedError
+
+
+class FirestoreShiftStorage(ShiftStorage):
+    """Firestore（shifts/{YYYY-MM}）"""
+
+    remote = True
+
+    def __init__(self, db):
+        self.db = db
+
+    def _doc(self, year, month):
+        return self.db.collection('shifts').document(shift_doc_id(year, month))
+
+    def save(self, year, month, shift_doc):
+        shift_doc = dict(shift_doc)
+        shift_doc['created_at'] = firestore.SERVER_TIMESTAMP
+        shift_doc['updated_at'] = firestore.SERVER_TIMESTAMP
+        self._doc(year, month).set(shift_doc)
+
+    def save_many(self, shift_docs):
+        batch = self.db.batch()
+        for shift_doc in shift_docs:
+            shift_doc = dict(shift_doc)
+            shift_doc['created_at'] = firestore.SERVER_TIMESTAMP
+            shift_doc['updated_at'] = firestore.SERVER_TIMESTAMP
+            batch.set(self._doc(shift_doc['year'], shift_doc['month']), shift_doc)
+        batch.commit()
+
+    def load(self, year, month):
+        doc = self._doc(year, month).get()
+        if not doc.exists:
+            return None
+        data = doc.to_dict()
+        data['created_at'] = _isoformat(data.get('created_at'))
+        data['updated_at'] = _isoformat(data.get('updated_at'))
+        return data
+
+    def delete(self, year, month):
+        self._doc(year, month).delete()
+        return True
+
+    def list(self, limit=None, before=None):
+        # ドキュメントID（YYYY-MM）の降順 = 年月の降順。単一フィールドなので複合インデックス不要
+        # 一覧に必要なフィールドだけを取得し、shift_data などは読み込まない
+        query = (self.db.collection('shifts')
+                 .select(['year', 'month', 'updated_at'])
+                 .order_by('__name__', direction=firestore.Query.DESCENDING))
+        if before:
+            query = query.start_after({'__name__': before})
+        if limit:
+            query = query.limit(limit)
+
+        shifts_list = []
+        for doc in query.stream():
+            data = doc.to_dict()
+            shifts_list.append({
+                "id": doc.id,
+                "year": data.get('year'),
+                "month": data.get('month'),
+                "updated_at": _isoformat(data.get('updated_at'))
+            })
+        return shifts_list
+
+
+class JsonShiftStorage(ShiftStorage):
+    """data/shifts.json（全月を1ファイルに保存）"""
+
+    def __init__(self, path=SHIFTS_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _read(self):
+        if not self.path.exists():
+            return {}
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (json.JSONDecodeError, IOError):
+            return {}
+
+    def _write(self, shifts):
+        DATA_DIR.mkdir(exist_ok=True)
+        with open(self.path, 'w', encoding='utf-8') as f:
+            json.dump(shifts, f, ensure_ascii=False, indent=2)
+
+    def save(self, year, month, shift_doc):
+        now = datetime.now().isoformat()
+        shift_doc = dict(shift_doc, created_at=now, updated_at=now)
+        with self._lock:
+            shifts = self._read()
+            shifts[shift_doc_id(year, month)] = shift_doc
+            self._write(shifts)
+
+    def save_many(self, shift_docs):
+        now = datetime.now().isoformat()
+        with self._lock:
+            shifts = self._read()
+            for shift_doc in shift_docs:
+                shift_doc = dict(shift_doc, created_at=now, updated_at=now)
+                shifts[shift_doc_id(shift_doc['year'], shift_doc['month'])] = shift_doc
+            self._write(shifts)
+
+    def load(self, year, month):
+        return self._read().get(shift_doc_id(year, month))
+
+    def delete(self, year, month):
+        with self._lock:
+            shifts = self._read()
+            if shift_doc_id(year, month) not in shifts:
+                return False
+            del shifts[shift_doc_id(year, month)]
+            self._write(shifts)
+            return True
+
+    def list(self, limit=None, before=None):
+        shifts_list = _sort_shift_list([
+            {
+                "id": doc_id,
+                "year": data.get('year'),
+                "month": data.get('month'),
+                "updated_at": data.get('updated_at')
+            }
+            for doc_id, data in self._read().items()
+            if not before or doc_id < before
+        ])
+        return shifts_list[:limit] if limit else shifts_list
+
+
+class SqliteShiftStorage(ShiftStorage):
+    """data/shifts.db（1か月1行、年月でインデックス）
+
+    一覧は年月・更新日時の列だけを読み、shift_data のJSONは読み込まない
+    接続はスレッドごとに作り、fork後は作り直す
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS shifts (
+            id TEXT PRIMARY KEY,
+            year INTEGER NOT NULL,
+            month INTEGER NOT NULL,
+            doc TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            updated_at TEXT NOT NULL
+        );
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_shifts_year_month ON shifts (year, month);
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+    """
+
+    def __init__(self, path=SHIFTS_DB_FILE, json_path=SHIFTS_FILE):
+        self.path = path
+        self.json_path = json_path
+        self._local = threading.local()
+        self._init_lock = threading.Lock()
+        self._initialized_pid = None
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+        DATA_DIR.mkdir(exist_ok=True)
+        conn = sqlite3.connect(str(self.path), timeout=30)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        self._ensure_schema(conn)
+        return conn
+
+    def _ensure_schema(self, conn):
+        if self._initialized_pid == os.getpid():
+            return
+        with self._init_lock:
+            if self._initialized_pid == os.getpid():
+                return
+            with conn:
+                conn.executescript(self.SCHEMA)
+            self._import_json(conn)
+            self._initialized_pid = os.getpid()
+
+    def _import_json(self, conn):
+        """従来の shifts.json があれば初回だけ取り込む"""
+        if conn.execute("SELECT 1 FROM meta WHERE key = 'json_imported'").fetchone():
+            return
+        shifts = JsonShiftStorage(self.json_path)._read()
+        with conn:
+            for doc_id, data in shifts.items():
+                conn.execute(
+                    "INSERT OR IGNORE INTO shifts (id, year, month, doc, created_at, updated_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (doc_id, data.get('year'), data.get('month'),
+                     json.dumps(data, ensure_ascii=False),
+                     data.get('created_at') or '', data.get('updated_at') or '')
+                )
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('json_imported', ?)",
+                         (datetime.now().isoformat(),))
+        if shifts:
+            print(f"shifts.json から {len(shifts)} 件のシフトを取り込みました")
+
+    def save(self, year, month, shift_doc):
+        self.save_many([dict(shift_doc, year=year, month=month)])
+
+    def save_many(self, shift_docs):
+        now = datetime.now().isoformat()
+        rows = []
+        for shift_doc in shift_docs:
+            shift_doc = dict(shift_doc, created_at=now, updated_at=now)
+            year, month = shift_doc['year'], shift_doc['month']
+            rows.append((shift_doc_id(year, month), year, month,
+                         json.dumps(shift_doc, ensure_ascii=False, separators=(',', ':')), now, now))
+        conn = self._connect()
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO shifts (id, year, month, doc, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                rows
+            )
+
+    def load(self, year, month):
+        row = self._connect().execute(
+            "SELECT doc FROM shifts WHERE year = ? AND month = ?", (year, month)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def delete(self, year, month):
+        conn = self._connect()
+        with conn:
+            cursor = conn.execute("DELETE FROM shifts WHERE year = ? AND month = ?", (year, month))
+        return cursor.rowcount > 0
+
+    def list(self, limit=None, before=None):
+        sql = "SELECT id, year, month, updated_at FROM shifts"
+        params = []
+        if before:
+            sql += " WHERE id < ?"
+            params.append(before)
+        sql += " ORDER BY id DESC"
+        if limit:
+            sql += " LIMIT ?"
+            params.append(limit)
+        rows = self._connect().execute(sql, params).fetchall()
+        return [
+            {"id": row[0], "year": row[1], "month": row[2], "updated_at": row[3]}
+            for row in rows
+        ]
+
+
+_local_storage = None
+_local_storage_lock = threading.Lock()
+
+
+def get_local_shift_storage():
+    """ローカルの保存先（SHIFT_STORAGE=json のときはJSON、それ以外はSQLite）"""
+    global _local_storage
+    if _local_storage is None:
+        with _local_storage_lock:
+            if _local_storage is None:
+                if SHIFT_STORAGE == 'json':
+                    _local_storage = JsonShiftStorage()
+                else:
+                    _local_storage = SqliteShiftStorage()
+    return _local_storage
+
+
+def get_shift_storage():
+    """設定に応じたシフトの保存先を取得"""
+    if SHIFT_STORAGE in ('auto', 'firestore'):
+        db = get_firestore_client()
+        if db:
+            return FirestoreShiftStorage(db)
+    return get_local_shift_storage()
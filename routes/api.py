@@ -4,27 +4,60 @@ APIルーティング
 """
 
 import json
+import math
+import os
+import tempfile
 from datetime import datetime
 from io import BytesIO
 from copy import deepcopy
 
-from flask import Blueprint, request, jsonify, send_file
+from flask import Blueprint, Response, current_app, request, jsonify, send_file, url_for
 from flask_login import login_required
+from werkzeug.utils import secure_filename
 
-from config import DEFAULT_DATA
+from config import (
+    DEFAULT_DATA, SHIFT_LIST_PAGE_SIZE, SHIFT_OPTIMIZE_MAX_TIME_BUDGET, SHIFT_RANGE_MAX_MONTHS,
+    SHIFT_CANDIDATES_MAX, CALENDAR_RANGE_MAX_MONTHS, EXPORT_RANGE_MAX_MONTHS
+)
 from models import (
     load_data, save_data,
     get_locations, set_locations,
     get_staff, set_staff,
-    get_ng_days, set_ng_days,
-    get_exceptions, set_exceptions,
-    save_shift, load_shift, delete_shift, list_shifts
+    get_ng_days, set_ng_days, get_month_ng_days,
+    get_exceptions, set_exceptions, get_month_exceptions, set_month_exceptions,
+    save_shift, load_shift, delete_shift, list_shifts_page,
+    get_firestore_stats, get_settings_cache_stats, get_local_backup_stats
 )
 from services import (
     get_calendar_data,
+    iter_calendar_range,
     generate_shift,
-    create_excel_shift,
-    create_pdf_shift
+    regenerate_shift,
+    generate_shift_range,
+    generate_shift_candidates,
+    iter_month_shifts,
+    month_range,
+    write_excel_range,
+    iter_staff_pdf_zip,
+    get_generation_cache_stats,
+    get_pdf_font_stats,
+    export_key,
+    open_cached_export,
+    store_export,
+    record_not_modified,
+    get_export_cache_stats,
+    EXPORT_KINDS,
+    render_export,
+    submit_export_job,
+    get_export_job,
+    get_export_job_file,
+    cancel_export_job,
+    get_export_job_stats,
+    ics_token,
+    verify_ics_token,
+    get_staff_feed,
+    record_ics_not_modified,
+    get_ics_feed_stats
 )
 
 api_bp = Blueprint('api', __name__, url_prefix='/api')
@@ -154,42 +187,71 @@ def api_delete_staff(staff_id):
 # NG日・例外日管理
 # =============================================================================
 
+def _settings_month_range():
+    """?from=YYYY-MM&to=YYYY-MM の月の一覧 [(年, 月), ...]（省略時は全期間としてNone）
+
+    Raises:
+        ValueError: 形式が不正・片方だけ指定
+    """
+    start = request.args.get('from')
+    end = request.args.get('to')
+    if start is None and end is None:
+        return None
+    try:
+        months = month_range(start, end)
+    except (AttributeError, ValueError):
+        raise ValueError("from・toは YYYY-MM 形式で両方指定してください")
+    if not months:
+        raise ValueError("toはfrom以降を指定してください")
+    return months
+
+
 @api_bp.route('/ng_days', methods=['GET'])
 @login_required
 def api_get_ng_days():
-    return jsonify(get_ng_days())
+    """NG日（?from=YYYY-MM&to=YYYY-MM でその範囲の月だけ）"""
+    try:
+        months = _settings_month_range()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify(get_ng_days(months))
 
 
 @api_bp.route('/ng_days', methods=['POST'])
 @login_required
 def api_set_ng_days():
+    """NG日を置き換え（?from=YYYY-MM&to=YYYY-MM でその範囲の月だけ）"""
+    try:
+        months = _settings_month_range()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     data = request.json
-    set_ng_days(data)
+    set_ng_days(data, months)
     return jsonify({"success": True})
 
 
 @api_bp.route('/exceptions', methods=['GET'])
 @login_required
 def api_get_exceptions():
-    return jsonify(get_exceptions())
+    """例外日（?from=YYYY-MM&to=YYYY-MM でその範囲の月だけ）"""
+    try:
+        months = _settings_month_range()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify(get_exceptions(months))
 
 
 @api_bp.route('/exceptions/<int:year>/<int:month>', methods=['GET'])
 @login_required
 def api_get_month_exceptions(year, month):
-    exceptions = get_exceptions()
-    key = f"{year}-{month:02d}"
-    return jsonify(exceptions.get(key, {}))
+    return jsonify(get_month_exceptions(year, month))
 
 
 @api_bp.route('/exceptions/<int:year>/<int:month>', methods=['POST'])
 @login_required
 def api_set_month_exceptions(year, month):
     data = request.json
-    exceptions = get_exceptions()
-    key = f"{year}-{month:02d}"
-    exceptions[key] = data
-    set_exceptions(exceptions)
+    set_month_exceptions(year, month, data)
     return jsonify({"success": True})
 
 
@@ -229,17 +291,15 @@ def api_import_settings():
         content = file.read().decode('utf-8')
         settings = json.loads(content)
 
-        data = load_data()
+        # ファイルにある項目だけを置き換える（NG日・例外日は変わった月だけを保存）
         if 'locations' in settings:
-            data['locations'] = settings['locations']
+            set_locations(settings['locations'])
         if 'staff' in settings:
-            data['staff'] = settings['staff']
+            set_staff(settings['staff'])
         if 'ng_days' in settings:
-            data['ng_days'] = settings['ng_days']
+            set_ng_days(settings['ng_days'])
         if 'exceptions' in settings:
-            data['exceptions'] = settings['exceptions']
-
-        save_data(data)
+            set_exceptions(settings['exceptions'])
         return jsonify({"success": True, "message": "設定をインポートしました"})
     except json.JSONDecodeError:
         return jsonify({"error": "無効なJSONファイルです"}), 400
@@ -254,6 +314,21 @@ def api_reset():
     return jsonify({"success": True, "message": "設定をリセットしました"})
 
 
+@api_bp.route('/system/status', methods=['GET'])
+@login_required
+def api_system_status():
+    return jsonify({
+        "firestore": get_firestore_stats(),
+        "settings_cache": get_settings_cache_stats(),
+        "local_backup": get_local_backup_stats(),
+        "generation_cache": get_generation_cache_stats(),
+        "pdf_fonts": get_pdf_font_stats(),
+        "export_cache": get_export_cache_stats(),
+        "export_jobs": get_export_job_stats(),
+        "ics_feed": get_ics_feed_stats()
+    })
+
+
 # =============================================================================
 # シフト保存・管理
 # =============================================================================
@@ -261,8 +336,10 @@ def api_reset():
 @api_bp.route('/shifts', methods=['GET'])
 @login_required
 def api_list_shifts():
-    shifts = list_shifts()
-    return jsonify(shifts)
+    # ?limit=件数（最大100）&cursor=前ページの next_cursor
+    limit = min(max(request.args.get('limit', SHIFT_LIST_PAGE_SIZE, type=int), 1), 100)
+    cursor = request.args.get('cursor') or None
+    return jsonify(list_shifts_page(limit, cursor))
 
 
 @api_bp.route('/shifts/<int:year>/<int:month>', methods=['GET'])
@@ -309,21 +386,131 @@ def api_get_calendar(year, month):
     return jsonify(cal_data)
 
 
+@api_bp.route('/calendar', methods=['GET'])
+@login_required
+def api_get_calendar_range():
+    """複数月のカレンダー（1か月ずつ書き出す）
+
+    ?from=YYYY-MM&to=YYYY-MM&format=json|ndjson
+    json: [{"year", "month", "days": [...]}, ...] / ndjson: 1行に1か月
+    """
+    start = request.args.get('from')
+    end = request.args.get('to')
+    fmt = request.args.get('format')
+    if fmt is None:
+        fmt = 'ndjson' if request.accept_mimetypes.best == 'application/x-ndjson' else 'json'
+    if fmt not in ('json', 'ndjson'):
+        return jsonify({"error": "formatは json / ndjson を指定してください"}), 400
+    try:
+        months = month_range(start, end)
+    except (AttributeError, ValueError):
+        return jsonify({"error": "from・toは YYYY-MM 形式で指定してください"}), 400
+    if not months:
+        return jsonify({"error": "toはfrom以降を指定してください"}), 400
+    if len(months) > CALENDAR_RANGE_MAX_MONTHS:
+        return jsonify({"error": f"一度に取得できるのは{CALENDAR_RANGE_MAX_MONTHS}か月までです"}), 400
+
+    # 拠点・例外日はここで読み込み、書き出し中はリクエストの外でも動くようにする
+    calendars = iter_calendar_range(start, end)
+    dumps = current_app.json.dumps
+
+    def generate_json():
+        yield '['
+        for i, (year, month, cal_data) in enumerate(calendars):
+            yield (',' if i else '') + dumps({"year": year, "month": month, "days": cal_data})
+        yield ']'
+
+    def generate_ndjson():
+        for year, month, cal_data in calendars:
+            yield dumps({"year": year, "month": month, "days": cal_data}) + '\n'
+
+    if fmt == 'ndjson':
+        return Response(generate_ndjson(), mimetype='application/x-ndjson')
+    return Response(generate_json(), mimetype='application/json')
+
+
 @api_bp.route('/generate_shift', methods=['POST'])
 @login_required
 def api_generate_shift():
     data = request.json
+
+    # mode: "greedy"（既定）/ "optimize"（time_budget 秒まで改善）
+    #       "incremental"（shift_data を元に、変更の影響を受けた枠だけ割り当て直す）
+    #       "candidates"（並び順を変えた候補を candidates 件作り、評価の良い top_k 件を返す）
+    # 入力の確認は例外日を保存する前に済ませる
+    mode = data.get('mode', 'greedy')
+    if mode not in ('greedy', 'optimize', 'incremental', 'candidates'):
+        return jsonify({"error": "modeは greedy / optimize / incremental / candidates を指定してください"}), 400
+
+    if mode == 'candidates':
+        try:
+            count = data.get('candidates')
+            count = min(max(int(count), 1), SHIFT_CANDIDATES_MAX) if count is not None else None
+            top_k = max(int(data.get('top_k', 3)), 1)
+        except (TypeError, ValueError):
+            return jsonify({"error": "candidates・top_kは整数で指定してください"}), 400
+
+    shift_data = data.get('shift_data')
+    if mode == 'incremental' and not shift_data:
+        return jsonify({"error": "shift_dataがありません"}), 400
+
+    time_budget = data.get('time_budget')
+    if time_budget is not None:
+        try:
+            time_budget = float(time_budget)
+        except (TypeError, ValueError):
+            time_budget = math.nan
+        if not math.isfinite(time_budget):
+            return jsonify({"error": "time_budgetは秒数で指定してください"}), 400
+        time_budget = min(max(time_budget, 0), SHIFT_OPTIMIZE_MAX_TIME_BUDGET)
+
     year = data.get('year', datetime.now().year)
     month = data.get('month', datetime.now().month)
-    ng_days_data = data.get('ng_days', get_ng_days())
+    ng_days_data = data.get('ng_days')
+    if ng_days_data is None:
+        ng_days_data = get_month_ng_days(year, month)
     month_exceptions = data.get('exceptions', {})
 
-    exceptions = get_exceptions()
-    key = f"{year}-{month:02d}"
-    exceptions[key] = month_exceptions
-    set_exceptions(exceptions)
+    set_month_exceptions(year, month, month_exceptions)
 
-    result = generate_shift(year, month, ng_days_data, month_exceptions)
+    if mode == 'candidates':
+        result = generate_shift_candidates(year, month, ng_days_data, month_exceptions, count, top_k)
+        return jsonify(result)
+
+    if mode == 'incremental':
+        # pinned: [{"date": "YYYY-MM-DD", "location_id": 1}, ...]
+        # changed_dates: 例外日などを変えた日 / changed_staff: NG日などを変えたスタッフID
+        pinned = [(cell.get('date'), cell.get('location_id')) for cell in data.get('pinned', [])]
+        result = regenerate_shift(year, month, shift_data, ng_days_data, month_exceptions,
+                                  pinned, data.get('changed_dates', []), data.get('changed_staff', []))
+        return jsonify(result)
+
+    result = generate_shift(year, month, ng_days_data, month_exceptions, mode, time_budget)
+    return jsonify(result)
+
+
+@api_bp.route('/generate_shift_range', methods=['POST'])
+@login_required
+def api_generate_shift_range():
+    """複数月の一括生成
+
+    {"start": "YYYY-MM", "end": "YYYY-MM",
+     "ng_days": {"YYYY-MM": {...}}, "exceptions": {"YYYY-MM": {...}}, "persist": false}
+    """
+    data = request.json
+    start = data.get('start')
+    end = data.get('end')
+    try:
+        months = month_range(start, end)
+    except (AttributeError, ValueError):
+        return jsonify({"error": "start・endは YYYY-MM 形式で指定してください"}), 400
+    if not months:
+        return jsonify({"error": "endはstart以降を指定してください"}), 400
+    if len(months) > SHIFT_RANGE_MAX_MONTHS:
+        return jsonify({"error": f"一度に生成できるのは{SHIFT_RANGE_MAX_MONTHS}か月までです"}), 400
+
+    result = generate_shift_range(start, end, data.get('ng_days'), data.get('exceptions'),
+                                  bool(data.get('persist')))
     return jsonify(result)
 
 
@@ -331,9 +518,8 @@ def api_generate_shift():
 # エクスポート
 # =============================================================================
 
-@api_bp.route('/export_excel', methods=['POST'])
-@login_required
-def api_export_excel():
+def _export_request():
+    """出力リクエストから (年, 月, シフト, 例外日) を取得（シフトがなければ生成）"""
     data = request.json
     year = data.get('year', datetime.now().year)
     month = data.get('month', datetime.now().month)
@@ -341,17 +527,119 @@ def api_export_excel():
 
     shift_data = data.get('shift_data')
     if not shift_data:
-        ng_days_data = data.get('ng_days', get_ng_days())
+        ng_days_data = data.get('ng_days')
+        if ng_days_data is None:
+            ng_days_data = get_month_ng_days(year, month)
         result = generate_shift(year, month, ng_days_data, month_exceptions)
         shift_data = result['shift']
+    return year, month, shift_data, month_exceptions
+
+
+def _export_url(kind, key, filename):
+    """出力キャッシュのファイルを取得するURL（GET /api/exports/<kind>/<key>）"""
+    return url_for('api.api_download_export', kind=kind, key=key, filename=filename)
+
+
+def _send_export(kind, key, filename, render=None):
+    """出力ファイルを返す
+
+    内容のハッシュ（key）を弱いETagにする（作り直すとファイル内の作成日時が変わるため、
+    強いETagにはしない）。If-None-Match が一致すれば、GET・HEADには304を、
+    それ以外（POST）には412を返す（RFC 9110）。
+    同じ内容を出力済みならディスクのキャッシュから返し、なければ render() で作って保存する
+    （render がなければ404）。キャッシュにあるファイルは Content-Location で
+    GET /api/exports/<kind>/<key> を知らせ、以降はそちらで304を使えるようにする
+    """
+    if request.if_none_match.contains_weak(key):
+        if request.method not in ('GET', 'HEAD'):
+            return jsonify({"error": "出力内容は変わっていません（If-None-Match が一致しました）"}), 412
+        record_not_modified()
+        response = current_app.response_class(status=304)
+    else:
+        mimetype = EXPORT_KINDS[kind][0]
+        cached = open_cached_export(key)
+        if cached is not None:
+            response = send_file(cached, mimetype=mimetype, as_attachment=True,
+                                 download_name=filename, etag=False, conditional=False)
+            response.content_length = os.fstat(cached.fileno()).st_size
+            stored = True
+        elif render is None:
+            return jsonify({"error": "ファイルが見つかりません（キャッシュから削除された可能性があります）"}), 404
+        else:
+            content = render()
+            stored = store_export(key, content)
+            response = send_file(BytesIO(content), mimetype=mimetype, as_attachment=True,
+                                 download_name=filename, etag=False, conditional=False)
+        if stored:
+            response.headers['Content-Location'] = _export_url(kind, key, filename)
+    response.set_etag(key, weak=True)
+    response.headers['X-Content-Type-Options'] = 'nosniff'
+    # 毎回ETagで確認させる（変わっていなければ304）
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
 
-    wb = create_excel_shift(year, month, shift_data, month_exceptions)
 
-    output = BytesIO()
-    wb.save(output)
+@api_bp.route('/exports/<kind>/<key>', methods=['GET'])
+@login_required
+def api_download_export(kind, key):
+    """出力キャッシュにあるファイル（Excel・PDF）を返す
+
+    ?filename= 保存するファイル名。If-None-Match が一致すれば304
+    """
+    if kind not in ('excel', 'pdf'):
+        return jsonify({"error": "kindは excel・pdf のいずれかを指定してください"}), 404
+    ext = EXPORT_KINDS[kind][1]
+    filename = secure_filename(request.args.get('filename', '')) or f"shift.{ext}"
+    return _send_export(kind, key, filename)
+
+
+@api_bp.route('/export_excel', methods=['POST'])
+@login_required
+def api_export_excel():
+    year, month, shift_data, month_exceptions = _export_request()
+
+    return _send_export(
+        'excel',
+        export_key('excel', year, month, shift_data, month_exceptions),
+        f"shift_{year}_{month:02d}.xlsx",
+        lambda: render_export('excel', year, month, shift_data, month_exceptions)
+    )
+
+
+def _export_range_error(start, end):
+    """複数月の出力の期間が正しくなければエラーメッセージ"""
+    try:
+        months = month_range(start, end)
+    except (AttributeError, ValueError):
+        return "start・endは YYYY-MM 形式で指定してください"
+    if not months:
+        return "endはstart以降を指定してください"
+    if len(months) > EXPORT_RANGE_MAX_MONTHS:
+        return f"一度に出力できるのは{EXPORT_RANGE_MAX_MONTHS}か月までです"
+    return None
+
+
+@api_bp.route('/export_excel_range', methods=['POST'])
+@login_required
+def api_export_excel_range():
+    """複数月のExcel出力（月ごとのシート＋拠点ごとのシート）
+
+    {"start": "YYYY-MM", "end": "YYYY-MM", "per_location": true}
+    各月は保存済みのシフト、なければ保存済みのNG日・例外日から生成したシフトを使う
+    """
+    data = request.json
+    start = data.get('start')
+    end = data.get('end')
+    error = _export_range_error(start, end)
+    if error:
+        return jsonify({"error": error}), 400
+
+    # 一時ファイルに書き出し、レスポンスでは少しずつ送る（送信後に削除される）
+    output = tempfile.TemporaryFile(suffix='.xlsx')
+    write_excel_range(iter_month_shifts(start, end), output, bool(data.get('per_location', True)))
     output.seek(0)
 
-    filename = f"shift_{year}_{month:02d}.xlsx"
+    filename = f"shift_{start}_{end}.xlsx"
 
     response = send_file(
         output,
@@ -367,27 +655,155 @@ def api_export_excel():
 @api_bp.route('/export_pdf', methods=['POST'])
 @login_required
 def api_export_pdf():
-    data = request.json
-    year = data.get('year', datetime.now().year)
-    month = data.get('month', datetime.now().month)
-    month_exceptions = data.get('exceptions', {})
+    year, month, shift_data, month_exceptions = _export_request()
 
-    shift_data = data.get('shift_data')
-    if not shift_data:
-        ng_days_data = data.get('ng_days', get_ng_days())
-        result = generate_shift(year, month, ng_days_data, month_exceptions)
-        shift_data = result['shift']
+    return _send_export(
+        'pdf',
+        export_key('pdf', year, month, shift_data, month_exceptions),
+        f"shift_{year}_{month:02d}.pdf",
+        lambda: render_export('pdf', year, month, shift_data, month_exceptions)
+    )
 
-    output = create_pdf_shift(year, month, shift_data, month_exceptions)
 
-    filename = f"shift_{year}_{month:02d}.pdf"
+@api_bp.route('/shifts/<int:year>/<int:month>/staff_pdfs', methods=['GET'])
+@login_required
+def api_export_staff_pdfs(year, month):
+    """保存済みのシフトから、スタッフごとのPDFをまとめたZIPを返す
 
-    response = send_file(
-        output,
-        mimetype='application/pdf',
-        as_attachment=True,
-        download_name=filename
-    )
+    PDFはできた順にZIPへ追加して送るため、人数が多くても最初のデータはすぐに届く
+    """
+    shift = load_shift(year, month)
+    if not shift or not shift.get('shift_data'):
+        return jsonify({"error": "シフトが見つかりません"}), 404
+    month_exceptions = shift.get('exceptions')
+    if month_exceptions is None:
+        month_exceptions = get_month_exceptions(year, month)
+
+    chunks = iter_staff_pdf_zip(year, month, shift['shift_data'], month_exceptions)
+    filename = f"shift_{year}_{month:02d}_staff.zip"
+    response = Response(chunks, mimetype='application/zip')
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
     response.headers['X-Content-Type-Options'] = 'nosniff'
     response.headers['Cache-Control'] = 'no-cache'
     return response
+
+
+@api_bp.route('/export_jobs', methods=['POST'])
+@login_required
+def api_submit_export_job():
+    """出力ジョブを受け付ける（作成はバックグラウンド）
+
+    {"kind": "excel" | "pdf", "year", "month", "shift_data", "ng_days", "exceptions"}
+    {"kind": "excel_range", "start": "YYYY-MM", "end": "YYYY-MM", "per_location": true}
+    → 202 {"id", "status", ...}。GET /api/export_jobs/<id> で状態を確認し、
+      "done" になったら GET /api/export_jobs/<id>/download で取得する
+    """
+    data = request.json
+    kind = data.get('kind')
+    if kind == 'excel_range':
+        start = data.get('start')
+        end = data.get('end')
+        error = _export_range_error(start, end)
+        if error:
+            return jsonify({"error": error}), 400
+        params = {"start": start, "end": end, "per_location": bool(data.get('per_location', True))}
+    elif kind in ('excel', 'pdf'):
+        year = data.get('year', datetime.now().year)
+        month = data.get('month', datetime.now().month)
+        shift_data = data.get('shift_data')
+        ng_days_data = data.get('ng_days')
+        if not shift_data and ng_days_data is None:
+            ng_days_data = get_month_ng_days(year, month)
+        params = {
+            "year": year,
+            "month": month,
+            "shift_data": shift_data,
+            "ng_days": ng_days_data,
+            "exceptions": data.get('exceptions', {}),
+        }
+    else:
+        return jsonify({"error": "kindは excel・pdf・excel_range のいずれかを指定してください"}), 400
+
+    job = submit_export_job(kind, params)
+    if job is None:
+        response = jsonify({"error": "出力待ちが多いため、しばらくしてからやり直してください"})
+        response.headers['Retry-After'] = '5'
+        return response, 429
+    return jsonify(job), 202
+
+
+@api_bp.route('/export_jobs/<job_id>', methods=['GET'])
+@login_required
+def api_get_export_job(job_id):
+    job = get_export_job(job_id)
+    if job is None:
+        return jsonify({"error": "ジョブが見つかりません（期限切れの可能性があります）"}), 404
+    if job.get('export_key'):
+        # 出力キャッシュに残っている間は、ETagで確認できるURLからも取得できる
+        job['export_url'] = _export_url(job['kind'], job['export_key'], job['filename'])
+    return jsonify(job)
+
+
+@api_bp.route('/export_jobs/<job_id>/download', methods=['GET'])
+@login_required
+def api_download_export_job(job_id):
+    result = get_export_job_file(job_id)
+    if result is None:
+        return jsonify({"error": "ジョブが見つかりません（期限切れの可能性があります）"}), 404
+    if isinstance(result, dict):
+        # まだできていない・失敗した・取り消された
+        return jsonify(dict(result, error=result.get('error') or "ファイルはまだ作成されていません")), 409
+
+    path, mimetype, filename = result
+    response = send_file(path, mimetype=mimetype, as_attachment=True, download_name=filename)
+    response.headers['X-Content-Type-Options'] = 'nosniff'
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+@api_bp.route('/export_jobs/<job_id>', methods=['DELETE'])
+@login_required
+def api_cancel_export_job(job_id):
+    """作成中・待ちのジョブは取り消し、終わったジョブはファイルごと削除する"""
+    job = cancel_export_job(job_id)
+    if job is None:
+        return jsonify({"error": "ジョブが見つかりません（期限切れの可能性があります）"}), 404
+    return jsonify(job)
+
+
+# =============================================================================
+# カレンダー配信
+# =============================================================================
+
+@api_bp.route('/ics/<staff_id>/url', methods=['GET'])
+@login_required
+def api_ics_url(staff_id):
+    """スタッフのカレンダー配信URL（カレンダーアプリに登録する）"""
+    if not any(str(s['id']) == staff_id for s in get_staff()):
+        return jsonify({"error": "スタッフが見つかりません"}), 404
+    url = url_for('api.api_ics_feed', staff_id=staff_id, token=ics_token(staff_id), _external=True)
+    return jsonify({"url": url})
+
+
+@api_bp.route('/ics/<staff_id>.ics', methods=['GET'])
+def api_ics_feed(staff_id):
+    """スタッフのカレンダー（ログイン不要、URLのトークンで確認）
+
+    ETag・Last-Modified を付け、変わっていなければ304を返す
+    """
+    if not verify_ics_token(staff_id, request.args.get('token')):
+        return jsonify({"error": "見つかりません"}), 404
+    feed = get_staff_feed(staff_id)
+    if feed is None:
+        return jsonify({"error": "見つかりません"}), 404
+
+    response = Response(feed['body'], mimetype='text/calendar')
+    response.charset = 'utf-8'
+    response.set_etag(feed['etag'])
+    response.last_modified = feed['last_modified']
+    response.headers['Content-Disposition'] = f'inline; filename="shift_{staff_id}.ics"'
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.make_conditional(request)
+    if response.status_code == 304:
+        record_ics_not_modified()
+    return response
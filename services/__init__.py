@@ -3,7 +3,20 @@
 サービス（ビジネスロジック）
 """
 
-from .calendar_service import get_calendar_data
-from .shift_generator import generate_shift
-from .excel_export import create_excel_shift
-from .pdf_export import create_pdf_shift
+from .calendar_service import get_calendar_data, get_calendar_columns, iter_calendar_range, month_range
+from .shift_generator import (
+    generate_shift, regenerate_shift, generate_shift_range, generate_shift_candidates, iter_month_shifts
+)
+from .excel_export import create_excel_shift, write_excel_range
+from .pdf_export import create_pdf_shift, iter_staff_pdf_zip, get_pdf_fonts, get_pdf_font_stats
+from .generation_cache import get_generation_cache_stats, clear_generation_cache
+from .export_cache import (
+    export_key, open_cached_export, store_export, record_not_modified, get_export_cache_stats
+)
+from .export_jobs import (
+    EXPORT_KINDS, render_export, submit_export_job, get_export_job, get_export_job_file, cancel_export_job,
+    get_export_job_stats
+)
+from .ics_feed import (
+    ics_token, verify_ics_token, get_staff_feed, record_ics_not_modified, get_ics_feed_stats
+)
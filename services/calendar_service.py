@@ -1,77 +1,227 @@
 # -*- coding: utf-8 -*-
 """
 カレンダー生成サービス
+
+- 祝日は年ごとにまとめて求め、プロセス内でキャッシュする
+- 日付・曜日・祝日からなる月の骨組みもキャッシュし、拠点と例外日はその上に重ねる
+- シフト生成・出力用に、拠点ごとの勤務日をビットマスクで表した列形式も返す
+- 複数月は拠点と例外日を最初にまとめて読み込み、1か月ずつ返す
 """
 
 import calendar
 from datetime import date
+from functools import lru_cache
+
 import jpholiday
 
-from models import get_locations, get_exceptions
+from models import get_locations, get_month_exceptions, get_exceptions
 
+WEEKDAY_NAMES = ('月', '火', '水', '木', '金', '土', '日')
 
-def get_calendar_data(year, month, month_exceptions=None):
-    """指定年月のカレンダーデータを生成"""
-    locations = get_locations()
-    if month_exceptions is None:
-        exceptions = get_exceptions()
-        key = f"{year}-{month:02d}"
-        month_exceptions = exceptions.get(key, {})
 
-    cal_data = []
-    _, num_days = calendar.monthrange(year, month)
+@lru_cache(maxsize=None)
+def get_holiday_table(year):
+    """その年の祝日 {date: 祝日名}（振替休日・国民の休日を含む）"""
+    return dict(jpholiday.year_holidays(year))
+
+
+@lru_cache(maxsize=120)
+def get_month_skeleton(year, month):
+    """月の骨組み（変更しないこと）
 
+    Returns:
+        ((日付文字列, 日, 曜日, 曜日名, 祝日か, 祝日名), ...)
+    """
+    holidays = get_holiday_table(year)
+    _, num_days = calendar.monthrange(year, month)
+    days = []
     for day in range(1, num_days + 1):
         d = date(year, month, day)
         weekday = d.weekday()
-        is_holiday = jpholiday.is_holiday(d)
-        holiday_name = jpholiday.is_holiday_name(d)
-        date_str = d.isoformat()
+        holiday_name = holidays.get(d)
+        days.append((d.isoformat(), day, weekday, WEEKDAY_NAMES[weekday],
+                     holiday_name is not None, holiday_name))
+    return tuple(days)
 
-        day_info = {
-            "date": date_str,
-            "day": day,
-            "weekday": weekday,
-            "weekday_name": ['月', '火', '水', '木', '金', '土', '日'][weekday],
-            "is_holiday": is_holiday,
-            "holiday_name": holiday_name,
-            "locations": []
+
+@lru_cache(maxsize=120)
+def _month_masks(year, month):
+    """曜日ごと・祝日の日のビットマスク（ビット i = i+1 日）と、日付 → ビット位置"""
+    weekday_masks = [0] * 7
+    holiday_mask = 0
+    date_index = {}
+    for i, (date_str, _, weekday, _, is_holiday, _) in enumerate(get_month_skeleton(year, month)):
+        weekday_masks[weekday] |= 1 << i
+        if is_holiday:
+            holiday_mask |= 1 << i
+        date_index[date_str] = i
+    return tuple(weekday_masks), holiday_mask, date_index
+
+
+def _dates_mask(dates, date_index):
+    """日付の一覧をビットマスクに変換（その月以外の日付は無視）"""
+    mask = 0
+    for date_str in dates:
+        i = date_index.get(date_str)
+        if i is not None:
+            mask |= 1 << i
+    return mask
+
+
+def _weekdays_mask(weekdays, weekday_masks):
+    mask = 0
+    for weekday in weekdays:
+        if isinstance(weekday, int) and 0 <= weekday < 7:
+            mask |= weekday_masks[weekday]
+    return mask
+
+
+def get_calendar_columns(year, month, month_exceptions=None, locations=None):
+    """指定年月のカレンダーを列形式で取得（シフト生成・出力用）
+
+    日ごとの値は日付順のタプル、拠点ごとの勤務日・定休日はビットマスク（ビット i = i+1 日）
+
+    Returns:
+        {
+            "dates", "days", "weekdays", "weekday_names", "holidays", "holiday_names": 日ごとの値,
+            "full_mask": 全日のビット,
+            "all_closed_mask": 全拠点が定休日の日,
+            "locations": [{id, name, min_staff, max_staff, part_time_priority, flexible_staffing,
+                           working_mask, closed_mask}, ...],
+            "min_staff", "max_staff": 拠点ごとの人数（locations と同じ順）
         }
+    """
+    if locations is None:
+        locations = get_locations()
+    if month_exceptions is None:
+        month_exceptions = get_month_exceptions(year, month)
 
-        for loc in locations:
-            loc_id_str = str(loc['id'])
-            loc_exceptions = month_exceptions.get(loc_id_str, {"add": [], "remove": []})
-            add_dates = loc_exceptions.get("add", [])
-            remove_dates = loc_exceptions.get("remove", [])
-
-            # 定休日チェック
-            closed_days = loc.get('closed_days', [])
-            is_closed_day = weekday in closed_days
-
-            is_working = False
-            if is_closed_day:
-                is_working = False
-            elif is_holiday:
-                is_working = loc.get('work_on_holidays', True)
-            else:
-                is_working = weekday in loc.get('working_days', [5, 6])
-
-            if date_str in add_dates:
-                is_working = True
-            if date_str in remove_dates:
-                is_working = False
-
-            day_info['locations'].append({
-                "id": loc['id'],
-                "name": loc['name'],
-                "is_working": is_working,
-                "is_closed_day": is_closed_day,
-                "min_staff": loc.get('min_staff', 1),
-                "max_staff": loc.get('max_staff', 2),
-                "part_time_priority": loc.get('part_time_priority', False),
-                "flexible_staffing": loc.get('flexible_staffing', False)
-            })
-
-        cal_data.append(day_info)
+    skeleton = get_month_skeleton(year, month)
+    weekday_masks, holiday_mask, date_index = _month_masks(year, month)
+    full_mask = (1 << len(skeleton)) - 1
+    workday_mask = full_mask & ~holiday_mask
+
+    columns = []
+    all_closed_mask = full_mask
+    for loc in locations:
+        loc_exceptions = month_exceptions.get(str(loc['id']), {"add": [], "remove": []})
+        closed_mask = _weekdays_mask(loc.get('closed_days', []), weekday_masks)
+        working_mask = _weekdays_mask(loc.get('working_days', [5, 6]), weekday_masks) & workday_mask
+        if loc.get('work_on_holidays', True):
+            working_mask |= holiday_mask
+        working_mask &= ~closed_mask
+        working_mask |= _dates_mask(loc_exceptions.get("add", []), date_index)
+        working_mask &= ~_dates_mask(loc_exceptions.get("remove", []), date_index)
+        all_closed_mask &= closed_mask
+
+        columns.append({
+            "id": loc['id'],
+            "name": loc['name'],
+            "min_staff": loc.get('min_staff', 1),
+            "max_staff": loc.get('max_staff', 2),
+            "part_time_priority": loc.get('part_time_priority', False),
+            "flexible_staffing": loc.get('flexible_staffing', False),
+            "working_mask": working_mask,
+            "closed_mask": closed_mask,
+        })
+
+    dates, days, weekdays, weekday_names, holidays, holiday_names = zip(*skeleton)
+    return {
+        "year": year,
+        "month": month,
+        "dates": dates,
+        "days": days,
+        "weekdays": weekdays,
+        "weekday_names": weekday_names,
+        "holidays": holidays,
+        "holiday_names": holiday_names,
+        "full_mask": full_mask,
+        "all_closed_mask": all_closed_mask,
+        "locations": columns,
+        "min_staff": [loc['min_staff'] for loc in columns],
+        "max_staff": [loc['max_staff'] for loc in columns],
+    }
+
+
+def group_weeks(columns):
+    """日を週（日曜始まり）ごとにまとめる
+
+    Returns:
+        [[日の添字 または None] * 7, ...]
+    """
+    weeks = []
+    current_week = [None] * 7
+    for i, weekday in enumerate(columns['weekdays']):
+        weekday_jp = (weekday + 1) % 7
+        current_week[weekday_jp] = i
+        if weekday_jp == 6:
+            weeks.append(current_week)
+            current_week = [None] * 7
+    if any(i is not None for i in current_week):
+        weeks.append(current_week)
+    return weeks
+
+
+def get_calendar_data(year, month, month_exceptions=None, locations=None):
+    """指定年月のカレンダーデータを生成"""
+    columns = get_calendar_columns(year, month, month_exceptions, locations)
+    cal_data = []
+
+    for i, date_str in enumerate(columns['dates']):
+        bit = 1 << i
+        cal_data.append({
+            "date": date_str,
+            "day": columns['days'][i],
+            "weekday": columns['weekdays'][i],
+            "weekday_name": columns['weekday_names'][i],
+            "is_holiday": columns['holidays'][i],
+            "holiday_name": columns['holiday_names'][i],
+            "locations": [
+                {
+                    "id": loc['id'],
+                    "name": loc['name'],
+                    "is_working": bool(loc['working_mask'] & bit),
+                    "is_closed_day": bool(loc['closed_mask'] & bit),
+                    "min_staff": loc['min_staff'],
+                    "max_staff": loc['max_staff'],
+                    "part_time_priority": loc['part_time_priority'],
+                    "flexible_staffing": loc['flexible_staffing']
+                }
+                for loc in columns['locations']
+            ]
+        })
 
     return cal_data
+
+
+def month_range(start, end):
+    """start〜end（"YYYY-MM"、両端を含む）の (年, 月) の一覧"""
+    year, month = (int(v) for v in start.split('-'))
+    end_year, end_month = (int(v) for v in end.split('-'))
+    if not (1 <= month <= 12 and 1 <= end_month <= 12):
+        raise ValueError(f"不正な年月です: {start}〜{end}")
+    months = []
+    while (year, month) <= (end_year, end_month):
+        months.append((year, month))
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return months
+
+
+def iter_calendar_range(start, end):
+    """start〜end の各月のカレンダーデータを1か月ずつ返す
+
+    拠点と例外日は呼び出した時点でまとめて読み込む（返したイテレータはリクエスト外でも使える）
+
+    Returns:
+        (年, 月, カレンダーデータ) のイテレータ
+    """
+    months = month_range(start, end)
+    locations = get_locations()
+    exceptions = get_exceptions(months) if months else {}
+
+    def generate():
+        for year, month in months:
+            month_exceptions = exceptions.get(f"{year}-{month:02d}", {})
+            yield year, month, get_calendar_data(year, month, month_exceptions, locations)
+
+    return generate()
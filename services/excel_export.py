@@ -1,183 +1,305 @@
 # -*- coding: utf-8 -*-
 """
 Excel出力サービス
+
+- セルの書式は名前付きスタイルとして1回だけ登録し、セルには名前で指定する
+- 担当者名は (日付, 拠点) ごとに最初にまとめて求めておく
+- 表の行は _month_rows() で作り、1か月のブック・複数月のブックで同じレイアウトを使う
+- 複数月のブックは書き込み専用モードで1か月ずつ書き出す（月数が増えてもメモリは増えない）
 """
 
 from openpyxl import Workbook
-from openpyxl.styles import Font, Alignment, Border, Side, PatternFill
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font, Alignment, Border, Side, PatternFill, NamedStyle
+from openpyxl.styles.fonts import DEFAULT_FONT
 from openpyxl.utils import get_column_letter
+from openpyxl.worksheet.cell_range import CellRange
 
 from models import get_locations, get_staff
-from .calendar_service import get_calendar_data
+from .calendar_service import get_calendar_columns, group_weeks
 
 
-def create_excel_shift(year, month, shift_data, month_exceptions):
-    """Excel形式のシフト表を作成"""
-    locations = get_locations()
-    staff_list = get_staff()
-    staff_dict = {s['id']: s['name'] for s in staff_list}
-    num_locations = len(locations)
+def _fill(color):
+    return PatternFill(start_color=color, end_color=color, fill_type='solid')
+
+
+_THIN_BORDER = Border(
+    left=Side(style='thin'),
+    right=Side(style='thin'),
+    top=Side(style='thin'),
+    bottom=Side(style='thin')
+)
+_CENTER = Alignment(horizontal='center', vertical='center')
+_CENTER_WRAP = Alignment(horizontal='center', vertical='center', wrap_text=True)
+
+_HEADER_FONT = Font(color='FFFFFF', bold=True)
+_SUNDAY_FONT = Font(color='FF0000', bold=True)
+_SATURDAY_FONT = Font(color='0000FF', bold=True)
+_CLOSED_DAY_FILL = _fill('F0F0F0')
+
+# スタイル名 → (フォント, 塗りつぶし, 配置)。罫線はすべて細線
+STYLES = {
+    "shift_blank": (DEFAULT_FONT, None, None),
+    "shift_header": (_HEADER_FONT, _fill('4472C4'), _CENTER),
+    "shift_header_sunday": (_HEADER_FONT, _fill('dc3545'), _CENTER),
+    "shift_header_saturday": (_HEADER_FONT, _fill('0d6efd'), _CENTER),
+    "shift_month": (Font(size=12, bold=True), None, _CENTER),
+    "shift_month_blank": (DEFAULT_FONT, None, _CENTER),
+    "shift_date": (Font(bold=True), None, _CENTER_WRAP),
+    "shift_date_saturday": (_SATURDAY_FONT, _fill('DEEAF6'), _CENTER_WRAP),
+    "shift_date_sunday": (_SUNDAY_FONT, _fill('FCE4D6'), _CENTER_WRAP),
+    "shift_date_holiday": (_SUNDAY_FONT, _fill('FFCCCC'), _CENTER_WRAP),
+    "shift_location": (Font(size=9, bold=True), _fill('E8E8E8'), _CENTER),
+    "shift_cell": (DEFAULT_FONT, None, _CENTER_WRAP),
+    "shift_names": (Font(size=9, bold=True), None, _CENTER_WRAP),
+    "shift_unassigned": (DEFAULT_FONT, _fill('E0E0E0'), _CENTER_WRAP),
+    "shift_closed": (DEFAULT_FONT, _CLOSED_DAY_FILL, _CENTER_WRAP),
+    "shift_closed_all": (Font(size=11, bold=True), _CLOSED_DAY_FILL, _CENTER_WRAP),
+}
+
+WEEKDAY_HEADERS = ['日', '月', '火', '水', '木', '金', '土']
+HEADER_STYLES = ['shift_header_sunday'] + ['shift_header'] * 5 + ['shift_header_saturday']
+
+# シート名に使えない文字
+_INVALID_TITLE_CHARS = str.maketrans({c: '_' for c in '[]:*?/\\'})
+
+
+def _register_styles(wb):
+    """名前付きスタイルをブックに登録"""
+    for name, (font, fill, alignment) in STYLES.items():
+        wb.add_named_style(NamedStyle(name=name, font=font, fill=fill,
+                                      border=_THIN_BORDER, alignment=alignment))
 
-    wb = Workbook()
-    ws = wb.active
-    ws.title = f"{year}年{month}月シフト表"
 
-    # スタイル定義
-    thin_border = Border(
-        left=Side(style='thin'),
-        right=Side(style='thin'),
-        top=Side(style='thin'),
-        bottom=Side(style='thin')
-    )
-
-    header_fill = PatternFill(start_color='4472C4', end_color='4472C4', fill_type='solid')
-    header_font = Font(color='FFFFFF', bold=True)
-    saturday_fill = PatternFill(start_color='DEEAF6', end_color='DEEAF6', fill_type='solid')
-    sunday_fill = PatternFill(start_color='FCE4D6', end_color='FCE4D6', fill_type='solid')
-    holiday_fill = PatternFill(start_color='FFCCCC', end_color='FFCCCC', fill_type='solid')
-    closed_day_fill = PatternFill(start_color='F0F0F0', end_color='F0F0F0', fill_type='solid')
-    loc_name_fill = PatternFill(start_color='E8E8E8', end_color='E8E8E8', fill_type='solid')
-    empty_fill = PatternFill(start_color='E0E0E0', end_color='E0E0E0', fill_type='solid')
-
-    saturday_font = Font(color='0000FF', bold=True)
-    sunday_font = Font(color='FF0000', bold=True)
-
-    cal_data = get_calendar_data(year, month, month_exceptions)
-    weekday_headers = ['日', '月', '火', '水', '木', '金', '土']
-
-    # カレンダーデータを週単位でグループ化
-    weeks = []
-    current_week = [None] * 7
-    for day_info in cal_data:
-        weekday_jp = (day_info['weekday'] + 1) % 7
-        current_week[weekday_jp] = day_info
-        if weekday_jp == 6:
-            weeks.append(current_week)
-            current_week = [None] * 7
-    if any(d is not None for d in current_week):
-        weeks.append(current_week)
-
-    # 列幅設定
+def _staff_names(staff_list):
+    """スタッフID（数値・文字列のどちらでも）→ 名前"""
+    staff_names = {}
+    for s in staff_list:
+        staff_names[s['id']] = staff_names[str(s['id'])] = s['name']
+    return staff_names
+
+
+def _assigned_names(shift_data, staff_names):
+    """(日付, 拠点ID文字列) → 担当者名の改行区切り（担当者のいない枠は含めない）"""
+    index = {}
+    for date_str, locs in shift_data.items():
+        for loc_key, assigned_ids in locs.items():
+            names = [staff_names.get(sid, '?') for sid in assigned_ids if sid]
+            if names:
+                index[(date_str, str(loc_key))] = "\n".join(names)
+    return index
+
+
+def _setup_columns(ws):
+    """列幅設定（書き込み専用モードでは行を書く前に呼ぶ）"""
     ws.column_dimensions['A'].width = 6
     for col in range(2, 9):
         ws.column_dimensions[get_column_letter(col)].width = 12
 
-    # ヘッダー行
-    ws.cell(row=1, column=1, value="").border = thin_border
-    for col, day_name in enumerate(weekday_headers, start=2):
-        cell = ws.cell(row=1, column=col, value=day_name)
-        cell.fill = header_fill
-        cell.font = header_font
-        cell.border = thin_border
-        cell.alignment = Alignment(horizontal='center', vertical='center')
-        if col == 2:
-            cell.fill = PatternFill(start_color='dc3545', end_color='dc3545', fill_type='solid')
-        elif col == 8:
-            cell.fill = PatternFill(start_color='0d6efd', end_color='0d6efd', fill_type='solid')
-    ws.row_dimensions[1].height = 20
-
-    current_row = 2
-
-    for week_idx, week in enumerate(weeks):
-        # 全拠点が定休日かチェック
-        all_closed_days = []
-        for day_info in week:
-            if day_info:
-                all_closed = all(loc_info.get('is_closed_day', False) for loc_info in day_info['locations'])
-                all_closed_days.append(all_closed)
-            else:
-                all_closed_days.append(False)
 
+def _header_row(label=""):
+    """曜日の見出し行"""
+    cells = [(label, 'shift_blank')] + list(zip(WEEKDAY_HEADERS, HEADER_STYLES))
+    return 20, cells, []
+
+
+def _month_rows(calendar, locations, assigned_names):
+    """1か月分の表の行を順に返す
+
+    Yields:
+        (行の高さ, [(値, スタイル名), ...], 結合するセル [(列, 行数), ...])
+    """
+    all_closed_mask = calendar['all_closed_mask']
+    num_locations = len(locations)
+
+    for week_idx, week in enumerate(group_weeks(calendar)):
         # 日付行
-        date_row = current_row
-        month_cell = ws.cell(row=date_row, column=1)
         if week_idx == 0:
-            month_cell.value = f"{month}月"
-            month_cell.font = Font(size=12, bold=True)
+            cells = [(f"{calendar['month']}月", 'shift_month')]
         else:
-            month_cell.value = ""
-        month_cell.alignment = Alignment(horizontal='center', vertical='center')
-        month_cell.border = thin_border
-
-        for col_idx, day_info in enumerate(week):
-            col = col_idx + 2
-            cell = ws.cell(row=date_row, column=col)
-            cell.border = thin_border
-            cell.alignment = Alignment(horizontal='center', vertical='center', wrap_text=True)
-
-            if day_info:
-                day = day_info['day']
-                weekday_jp = (day_info['weekday'] + 1) % 7
-                is_holiday = day_info['is_holiday']
-                holiday_name = day_info['holiday_name']
-
-                if is_holiday and holiday_name:
-                    cell.value = f"{day}\n{holiday_name}"
-                else:
-                    cell.value = day
-
-                if is_holiday or weekday_jp == 0:
-                    cell.font = sunday_font
-                    cell.fill = sunday_fill if not is_holiday else holiday_fill
-                elif weekday_jp == 6:
-                    cell.font = saturday_font
-                    cell.fill = saturday_fill
-                else:
-                    cell.font = Font(bold=True)
+            cells = [("", 'shift_month_blank')]
+
+        for col_idx, i in enumerate(week):
+            if i is None:
+                cells.append((None, 'shift_cell'))
+                continue
+
+            day = calendar['days'][i]
+            is_holiday = calendar['holidays'][i]
+            holiday_name = calendar['holiday_names'][i]
+            value = f"{day}\n{holiday_name}" if is_holiday and holiday_name else day
+
+            if is_holiday:
+                style = 'shift_date_holiday'
+            elif col_idx == 0:
+                style = 'shift_date_sunday'
+            elif col_idx == 6:
+                style = 'shift_date_saturday'
+            else:
+                style = 'shift_date'
+            cells.append((value, style))
 
-        ws.row_dimensions[date_row].height = 30
+        yield 30, cells, []
 
         # 各拠点行
         for loc_idx, loc in enumerate(locations):
-            loc_row = date_row + 1 + loc_idx
-
-            loc_name_cell = ws.cell(row=loc_row, column=1, value=loc['name'])
-            loc_name_cell.font = Font(size=9, bold=True)
-            loc_name_cell.alignment = Alignment(horizontal='center', vertical='center')
-            loc_name_cell.border = thin_border
-            loc_name_cell.fill = loc_name_fill
-
-            for col_idx, day_info in enumerate(week):
-                col = col_idx + 2
-                cell = ws.cell(row=loc_row, column=col)
-                cell.border = thin_border
-                cell.alignment = Alignment(horizontal='center', vertical='center', wrap_text=True)
-
-                if day_info:
-                    date_str = day_info['date']
-                    loc_info = next((l for l in day_info['locations'] if l['id'] == loc['id']), None)
-
-                    if all_closed_days[col_idx]:
-                        if loc_idx == 0:
-                            if num_locations > 1:
-                                ws.merge_cells(start_row=loc_row, start_column=col,
-                                             end_row=loc_row + num_locations - 1, end_column=col)
-                            cell.value = "定休日"
-                            cell.font = Font(size=11, bold=True)
-                            cell.fill = closed_day_fill
-                    elif loc_info and loc_info.get('is_closed_day', False):
-                        cell.value = "休"
-                        cell.fill = closed_day_fill
-                    elif loc_info and not loc_info['is_working']:
-                        cell.value = ""
+            loc_key = str(loc['id'])
+            cells = [(loc['name'], 'shift_location')]
+            merges = []
+
+            for col_idx, i in enumerate(week):
+                if i is None:
+                    cells.append((None, 'shift_cell'))
+                    continue
+
+                bit = 1 << i
+                if all_closed_mask & bit:
+                    if loc_idx == 0:
+                        cells.append(("定休日", 'shift_closed_all'))
+                        if num_locations > 1:
+                            merges.append((col_idx + 2, num_locations))
+                    else:
+                        cells.append((None, 'shift_cell'))
+                elif loc['closed_mask'] & bit:
+                    cells.append(("休", 'shift_closed'))
+                elif not loc['working_mask'] & bit:
+                    cells.append(("", 'shift_cell'))
+                else:
+                    names = assigned_names.get((calendar['dates'][i], loc_key))
+                    if names:
+                        cells.append((names, 'shift_names'))
                     else:
-                        shift_for_day = shift_data.get(date_str, {})
-                        assigned_ids = shift_for_day.get(str(loc['id']), [])
-                        if assigned_ids:
-                            names = [staff_dict.get(int(sid) if isinstance(sid, str) else sid, '?')
-                                   for sid in assigned_ids if sid]
-                            if names:
-                                cell.value = "\n".join(names)
-                                cell.font = Font(size=9, bold=True)
-                            else:
-                                cell.value = "-"
-                                cell.fill = empty_fill
-                        else:
-                            cell.value = "-"
-                            cell.fill = empty_fill
-
-            ws.row_dimensions[loc_row].height = 26
-
-        current_row = date_row + 1 + num_locations
+                        cells.append(("-", 'shift_unassigned'))
+
+            yield 26, cells, merges
+
+
+def create_excel_shift(year, month, shift_data, month_exceptions):
+    """Excel形式のシフト表を作成"""
+    calendar = get_calendar_columns(year, month, month_exceptions)
+    assigned_names = _assigned_names(shift_data, _staff_names(get_staff()))
+
+    wb = Workbook()
+    _register_styles(wb)
+    ws = wb.active
+    ws.title = f"{year}年{month}月シフト表"
+    _setup_columns(ws)
+
+    rows = [_header_row()]
+    rows.extend(_month_rows(calendar, calendar['locations'], assigned_names))
+    for row_idx, (height, cells, merges) in enumerate(rows, start=1):
+        for col, (value, style) in enumerate(cells, start=1):
+            cell = ws.cell(row=row_idx, column=col)
+            if value is not None:
+                cell.value = value
+            cell.style = style
+        for col, row_span in merges:
+            ws.merge_cells(start_row=row_idx, start_column=col,
+                           end_row=row_idx + row_span - 1, end_column=col)
+        ws.row_dimensions[row_idx].height = height
 
     return wb
+
+
+class _StreamSheet:
+    """書き込み専用シートに行を追加していく"""
+
+    def __init__(self, wb, title):
+        self.ws = wb.create_sheet(title)
+        self.row_idx = 0
+        _setup_columns(self.ws)
+
+    def append(self, height, cells, merges):
+        self.row_idx += 1
+        self.ws.row_dimensions[self.row_idx].height = height
+        row = []
+        for value, style in cells:
+            cell = WriteOnlyCell(self.ws, value)
+            cell.style = style
+            row.append(cell)
+        self.ws.append(row)
+        # 書き出した行の高さは不要（残すと行数に比例してメモリが増える）
+        del self.ws.row_dimensions[self.row_idx]
+        for col, row_span in merges:
+            self.ws.merged_cells.add(CellRange(min_col=col, min_row=self.row_idx,
+                                               max_col=col, max_row=self.row_idx + row_span - 1))
+
+    def close(self):
+        self.ws.close()
+
+
+def _sheet_title(name, used):
+    """シート名（使えない文字を置き換え、31文字まで、重複しないように）"""
+    base = (str(name).translate(_INVALID_TITLE_CHARS) or 'Sheet')[:31]
+    title = base
+    n = 2
+    while title.lower() in used:
+        suffix = f"({n})"
+        title = base[:31 - len(suffix)] + suffix
+        n += 1
+    used.add(title.lower())
+    return title
+
+
+def write_excel_range(months, output, per_location=True):
+    """複数月のシフト表を1つのブックに書き出す（月ごとのシート＋拠点ごとのシート）
+
+    書き込み専用モードで1か月ずつ行を書き出すため、月数が増えてもメモリはほぼ一定
+
+    Args:
+        months: (年, 月, シフト, 例外日) のイテレータ（1か月ずつ読み込んでよい）
+        output: 保存先のファイル名またはファイルオブジェクト
+        per_location: Trueなら拠点ごとのシート（全月を縦に並べる）も作る
+
+    Returns:
+        書き出した月数
+    """
+    locations = get_locations()
+    staff_names = _staff_names(get_staff())
+
+    wb = Workbook(write_only=True)
+    _register_styles(wb)
+    used_titles = set()
+
+    location_sheets = []
+    month_count = 0
+    try:
+        for year, month, shift_data, month_exceptions in months:
+            calendar = get_calendar_columns(year, month, month_exceptions, locations)
+            assigned_names = _assigned_names(shift_data, staff_names)
+
+            sheet = _StreamSheet(wb, _sheet_title(f"{year}年{month}月", used_titles))
+            sheet.append(*_header_row())
+            for row in _month_rows(calendar, calendar['locations'], assigned_names):
+                sheet.append(*row)
+            sheet.close()
+            month_count += 1
+
+            if per_location:
+                if not location_sheets:
+                    location_sheets = [
+                        _StreamSheet(wb, _sheet_title(loc['name'], used_titles))
+                        for loc in calendar['locations']
+                    ]
+                for sheet, loc in zip(location_sheets, calendar['locations']):
+                    sheet.append(*_header_row(f"{year}年"))
+                    for row in _month_rows(calendar, [loc], assigned_names):
+                        sheet.append(*row)
+    except BaseException:
+        # 途中で止まったときは書きかけのシートを閉じておく
+        # （閉じないと、後で破棄されるときに閉じたファイルへ書き込もうとしてエラーになる）
+        for ws in wb.worksheets:
+            if not ws.closed:
+                try:
+                    ws.close()
+                except Exception:
+                    pass
+        raise
+
+    # 拠点ごとのシートは月ごとのシートの後ろに並べる
+    for sheet in location_sheets:
+        wb.move_sheet(sheet.ws.title, len(wb.worksheets) - 1 - wb.index(sheet.ws))
+    if not wb.worksheets:
+        _StreamSheet(wb, 'シフト表').append(*_header_row())
+    wb.save(output)
+    return month_count
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+出力ファイル（Excel・PDF）のディスクキャッシュ
+
+キーは出力内容に影響する入力（種類・年月・シフト・例外日・拠点・スタッフ名）のハッシュ。
+作り直すとファイル内の作成日時だけが変わる（バイト単位では一致しない）ため、
+キーは弱いETagとして使う
+
+- EXPORT_CACHE_DIR（空なら一時ディレクトリ）に保存する
+  （キーの形の名前のファイルだけを扱い、それ以外のファイルには触れない）
+- 合計が EXPORT_CACHE_MAX_MB を超えたら、最後に使われてから長いものから削除する
+- EXPORT_CACHE_MAX_MB が0ならディスクには保存しない（ETagによる304は使える）
+"""
+
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+import jpholiday
+
+from config import EXPORT_CACHE_DIR, EXPORT_CACHE_MAX_MB
+from models import get_locations, get_staff
+from .pdf_export import get_pdf_fonts
+
+
+# 出力のレイアウトを変えたら上げる
+CACHE_VERSION = 1
+
+_cache_dir = Path(EXPORT_CACHE_DIR or os.path.join(tempfile.gettempdir(), 'shiftmaker_exports'))
+_max_bytes = int(EXPORT_CACHE_MAX_MB * 1024 * 1024)
+
+# キャッシュのファイル名（sha256の16進数）
+_KEY_PATTERN = re.compile(r'[0-9a-f]{64}')
+
+# キー → ファイルサイズ（最後に使われた順）。初回利用時にディレクトリから読み込む
+_index = None
+_total_bytes = 0
+_lock = threading.Lock()
+_stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0, "not_modified": 0, "errors": 0}
+
+
+def export_key(kind, year, month, shift_data, month_exceptions, params=None):
+    """出力内容のハッシュ（ETagにも使う）"""
+    if kind == 'pdf':
+        # 使えるフォントによって出力が変わるため、キーに含める
+        params = dict(params or {}, fonts=list(get_pdf_fonts()))
+    payload = {
+        "version": CACHE_VERSION,
+        "holidays": getattr(jpholiday, '__version__', ''),
+        "kind": kind,
+        "params": params or {},
+        "year": year,
+        "month": month,
+        "shift": shift_data,
+        "exceptions": month_exceptions,
+        "locations": get_locations(),
+        "staff": [[s['id'], s['name']] for s in get_staff()],
+    }
+    text = json.dumps(payload, ensure_ascii=False, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def _load_index():
+    """保存済みのファイルを古い順に読み込む（_lock を持って呼ぶ）"""
+    global _index, _total_bytes
+    _index = OrderedDict()
+    _total_bytes = 0
+    if not _cache_dir.exists():
+        return
+    entries = []
+    for path in _cache_dir.iterdir():
+        if not _KEY_PATTERN.fullmatch(path.name) or not path.is_file():
+            continue
+        stat = path.stat()
+        entries.append((stat.st_mtime, path.name, stat.st_size))
+    for _, key, size in sorted(entries):
+        _index[key] = size
+        _total_bytes += size
+
+
+def _evict():
+    """上限を超えた分を古いものから削除（_lock を持って呼ぶ）"""
+    global _total_bytes
+    while _index and _total_bytes > _max_bytes:
+        key, size = _index.popitem(last=False)
+        _total_bytes -= size
+        (_cache_dir / key).unlink(missing_ok=True)
+        _stats['evictions'] += 1
+
+
+def open_cached_export(key):
+    """キャッシュしたファイルを開く（なければNone）
+
+    削除と競合しないよう、ロックを持ったまま開いたファイルを返す（閉じるのは呼び出し側）
+    """
+    global _total_bytes
+    if _max_bytes <= 0 or not _KEY_PATTERN.fullmatch(key):
+        return None
+    with _lock:
+        if _index is None:
+            _load_index()
+        if key not in _index:
+            _stats['misses'] += 1
+            return None
+        path = _cache_dir / key
+        try:
+            f = open(path, 'rb')
+            os.utime(path)
+        except FileNotFoundError:
+            # 別のプロセスが削除した
+            _total_bytes -= _index.pop(key)
+            _stats['misses'] += 1
+            return None
+        _index.move_to_end(key)
+        _stats['hits'] += 1
+        return f
+
+
+def store_export(key, data):
+    """出力したファイルの内容（bytes）を保存
+
+    Returns:
+        保存したか（ディスクに保存しない設定・大きすぎる・書き込み失敗ならFalse）
+    """
+    global _total_bytes
+    if _max_bytes <= 0 or len(data) > _max_bytes:
+        return False
+    try:
+        _cache_dir.mkdir(parents=True, exist_ok=True)
+        path = _cache_dir / key
+        tmp_path = path.with_name(f"{key}.{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"出力キャッシュ書き込みエラー: {e}")
+        _stats['errors'] += 1
+        return False
+    with _lock:
+        if _index is None:
+            _load_index()
+        _total_bytes -= _index.pop(key, 0)
+        _index[key] = len(data)
+        _total_bytes += len(data)
+        _stats['stores'] += 1
+        _evict()
+    return True
+
+
+def record_not_modified():
+    """If-None-Match が一致して304を返した（GET・HEADのみ）"""
+    _stats['not_modified'] += 1
+
+
+def get_export_cache_stats():
+    """キャッシュの件数・サイズ・ヒット率を取得"""
+    with _lock:
+        entries = len(_index) if _index is not None else None
+        total_bytes = _total_bytes
+    stats = dict(_stats)
+    total = stats['hits'] + stats['misses']
+    stats.update({
+        "hit_rate": round(stats['hits'] / total, 3) if total else 0.0,
+        "entries": entries,
+        "total_bytes": total_bytes,
+        "max_bytes": _max_bytes,
+        "dir": str(_cache_dir),
+    })
+    return stats
@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+"""
+出力ファイル（Excel・PDF）のバックグラウンド作成
+
+リクエストのスレッドで作成すると、その間gunicornのスレッドが1つ埋まるため、
+ジョブとして受け付けてワーカースレッドで作成し、結果は後から取りに来てもらう
+
+- 同時に作成するのは EXPORT_JOB_WORKERS 件まで（残りは順番待ち）
+- 待ち・作成中のジョブが EXPORT_JOB_MAX_PENDING 件あれば新しいジョブは受け付けない
+- 終わったジョブ（成功・失敗・取消）と作成したファイルは EXPORT_JOB_TTL 秒後に削除する
+- 1か月分の出力は出力キャッシュ（export_cache）を使う
+"""
+
+import atexit
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from io import BytesIO
+
+from config import EXPORT_JOB_WORKERS, EXPORT_JOB_MAX_PENDING, EXPORT_JOB_TTL
+from .excel_export import create_excel_shift, write_excel_range
+from .pdf_export import create_pdf_shift
+from .shift_generator import generate_shift, iter_month_shifts
+from .export_cache import export_key, open_cached_export, store_export
+
+
+XLSX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+# 種類 → (MIMEタイプ, 拡張子)
+EXPORT_KINDS = {
+    "excel": (XLSX_MIMETYPE, 'xlsx'),
+    "pdf": ('application/pdf', 'pdf'),
+    "excel_range": (XLSX_MIMETYPE, 'xlsx'),
+}
+
+_executor = None
+_executor_pid = None
+_jobs = {}
+_lock = threading.Lock()
+_stats = {"submitted": 0, "rejected": 0, "completed": 0, "failed": 0, "cancelled": 0, "expired": 0}
+
+
+class ExportCancelled(Exception):
+    """作成中に取り消された"""
+
+
+def render_export(kind, year, month, shift_data, month_exceptions):
+    """1か月分の出力ファイルの内容（bytes）を作る"""
+    if kind == 'excel':
+        output = BytesIO()
+        create_excel_shift(year, month, shift_data, month_exceptions).save(output)
+        return output.getvalue()
+    if kind == 'pdf':
+        return create_pdf_shift(year, month, shift_data, month_exceptions).getvalue()
+    raise ValueError(f"不明な出力形式です: {kind}")
+
+
+class _Job:
+    def __init__(self, kind, params):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.params = params
+        self.status = 'queued'
+        self.error = None
+        self.path = None
+        self.size = None
+        self.export_key = None  # 出力キャッシュに保存した1か月分の出力のキー
+        self.created_at = datetime.now().isoformat(timespec='seconds')
+        self.started_at = None
+        self.finished_at = None
+        self.finished = None  # 終了時の time.monotonic()（期限切れの判定用）
+        self.cancel_event = threading.Event()
+        self.future = None
+
+    @property
+    def filename(self):
+        ext = EXPORT_KINDS[self.kind][1]
+        if self.kind == 'excel_range':
+            return f"shift_{self.params['start']}_{self.params['end']}.{ext}"
+        return f"shift_{self.params['year']}_{self.params['month']:02d}.{ext}"
+
+    @property
+    def mimetype(self):
+        return EXPORT_KINDS[self.kind][0]
+
+    def to_dict(self):
+        data = {
+            "id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "filename": self.filename,
+        }
+        if self.error:
+            data["error"] = self.error
+        if self.status == 'done':
+            data["size"] = self.size
+            if self.export_key:
+                data["export_key"] = self.export_key
+            data["expires_in"] = max(0, round(EXPORT_JOB_TTL - (time.monotonic() - self.finished)))
+        return data
+
+
+def _get_executor():
+    """ワーカースレッドのプールを取得（_lock を持って呼ぶ）"""
+    global _executor, _executor_pid
+    if _executor is None or _executor_pid != os.getpid():
+        _executor = ThreadPoolExecutor(max_workers=max(1, EXPORT_JOB_WORKERS),
+                                       thread_name_prefix='export-job')
+        _executor_pid = os.getpid()
+    return _executor
+
+
+def _remove_file(job):
+    if job.path:
+        try:
+            os.unlink(job.path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f"出力ジョブのファイル削除エラー: {e}")
+        job.path = None
+
+
+def _finish(job, status, error=None):
+    """ジョブを終了状態にする（_lock を持って呼ぶ）"""
+    job.status = status
+    job.error = error
+    job.finished_at = datetime.now().isoformat(timespec='seconds')
+    job.finished = time.monotonic()
+    if status != 'done':
+        _remove_file(job)
+    _stats[{'done': 'completed', 'failed': 'failed', 'cancelled': 'cancelled'}[status]] += 1
+
+
+def _sweep():
+    """期限切れのジョブを削除（_lock を持って呼ぶ）"""
+    now = time.monotonic()
+    for job_id in [job_id for job_id, job in _jobs.items()
+                   if job.finished is not None and now - job.finished > EXPORT_JOB_TTL]:
+        _remove_file(_jobs.pop(job_id))
+        _stats['expired'] += 1
+
+
+def _check_cancelled(job, months):
+    """月ごとのイテレータ（取り消されたら途中で止める）"""
+    for item in months:
+        if job.cancel_event.is_set():
+            raise ExportCancelled()
+        yield item
+
+
+def _write_month(job, output):
+    """1か月分を書き出す（同じ内容を出力済みならキャッシュから）"""
+    params = job.params
+    year, month, month_exceptions = params['year'], params['month'], params['exceptions']
+    shift_data = params['shift_data']
+    if not shift_data:
+        shift_data = generate_shift(year, month, params['ng_days'], month_exceptions)['shift']
+    if job.cancel_event.is_set():
+        raise ExportCancelled()
+
+    key = export_key(job.kind, year, month, shift_data, month_exceptions)
+    cached = open_cached_export(key)
+    if cached is not None:
+        with cached:
+            shutil.copyfileobj(cached, output)
+        job.export_key = key
+        return
+    content = render_export(job.kind, year, month, shift_data, month_exceptions)
+    if store_export(key, content):
+        job.export_key = key
+    output.write(content)
+
+
+def _run(job):
+    with _lock:
+        if job.cancel_event.is_set():
+            return
+        job.status = 'running'
+        job.started_at = datetime.now().isoformat(timespec='seconds')
+
+    path = None
+    try:
+        fd, path = tempfile.mkstemp(prefix='shiftmaker_job_', suffix=f".{EXPORT_KINDS[job.kind][1]}")
+        with os.fdopen(fd, 'wb') as output:
+            if job.kind == 'excel_range':
+                months = _check_cancelled(job, iter_month_shifts(job.params['start'], job.params['end']))
+                write_excel_range(months, output, job.params['per_location'])
+            else:
+                _write_month(job, output)
+        size = os.path.getsize(path)
+    except ExportCancelled:
+        os.unlink(path)
+        return
+    except Exception as e:
+        print(f"出力ジョブエラー: {e}")
+        if path:
+            os.unlink(path)
+        with _lock:
+            if not job.cancel_event.is_set():
+                _finish(job, 'failed', str(e))
+        return
+
+    with _lock:
+        job.path = path
+        if job.cancel_event.is_set():
+            # 作成中に取り消された（取り消し時に終了状態にしてある）
+            _remove_file(job)
+            return
+        job.size = size
+        _finish(job, 'done')
+
+
+def submit_export_job(kind, params):
+    """出力ジョブを受け付ける
+
+    Args:
+        kind: "excel" / "pdf"（params: year, month, shift_data, ng_days, exceptions）
+              "excel_range"（params: start, end, per_location）
+    Returns:
+        ジョブの状態（待ちが多すぎて受け付けられなければNone）
+    """
+    if kind not in EXPORT_KINDS:
+        raise ValueError(f"不明な出力形式です: {kind}")
+    with _lock:
+        _sweep()
+        pending = sum(1 for job in _jobs.values() if job.status in ('queued', 'running'))
+        if pending >= EXPORT_JOB_MAX_PENDING:
+            _stats['rejected'] += 1
+            return None
+        job = _Job(kind, params)
+        _jobs[job.id] = job
+        _stats['submitted'] += 1
+        job.future = _get_executor().submit(_run, job)
+        return job.to_dict()
+
+
+def get_export_job(job_id):
+    """ジョブの状態（なければNone）"""
+    with _lock:
+        _sweep()
+        job = _jobs.get(job_id)
+        return job.to_dict() if job else None
+
+
+def get_export_job_file(job_id):
+    """作成済みのファイル (パス, MIMEタイプ, ファイル名)（ジョブがなければNone、未完了なら状態）"""
+    with _lock:
+        _sweep()
+        job = _jobs.get(job_id)
+        if job is None:
+            return None
+        if job.status != 'done':
+            return job.to_dict()
+        return job.path, job.mimetype, job.filename
+
+
+def cancel_export_job(job_id):
+    """ジョブを取り消す（終わっていればファイルごと削除する）
+
+    Returns:
+        取り消し後の状態（ジョブがなければNone）
+    """
+    with _lock:
+        _sweep()
+        job = _jobs.get(job_id)
+        if job is None:
+            return None
+        if job.finished is not None:
+            _remove_file(_jobs.pop(job_id))
+            data = job.to_dict()
+            data['status'] = 'deleted'
+            return data
+        job.cancel_event.set()
+        if job.future is not None:
+            job.future.cancel()
+        _finish(job, 'cancelled')
+        return job.to_dict()
+
+
+def get_export_job_stats():
+    """ジョブの件数"""
+    with _lock:
+        _sweep()
+        counts = {}
+        for job in _jobs.values():
+            counts[job.status] = counts.get(job.status, 0) + 1
+    stats = dict(_stats)
+    stats.update({
+        "jobs": counts,
+        "workers": EXPORT_JOB_WORKERS,
+        "max_pending": EXPORT_JOB_MAX_PENDING,
+        "ttl_seconds": EXPORT_JOB_TTL,
+    })
+    return stats
+
+
+def shutdown_export_jobs():
+    """ワーカーを止め、作成したファイルを削除"""
+    global _executor, _executor_pid
+    with _lock:
+        executor = _executor if _executor_pid == os.getpid() else None
+        _executor = None
+        _executor_pid = None
+        for job in _jobs.values():
+            job.cancel_event.set()
+            _remove_file(job)
+        _jobs.clear()
+    if executor is not None:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+atexit.register(shutdown_export_jobs)
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+シフト生成結果のキャッシュ
+
+入力（年月・生成に使う拠点とスタッフの項目・NG日・例外日）のハッシュをキーにする。
+設定が変わればキーも変わるため、古い結果が使われることはない
+
+- メモリ: LRU（GENERATION_CACHE_SIZE 件まで）
+- ディスク: GENERATION_CACHE_DIR を指定したときのみ（GENERATION_CACHE_DISK_ENTRIES 件まで）
+
+メモリには結果の複製をそのまま持つ。ディスクにはJSONで書き、読み込むときに
+拠点ID・スタッフIDのキーを数値に戻す（どちらから返しても生成直後と同じ形）
+"""
+
+import hashlib
+import json
+from copy import deepcopy
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+import jpholiday
+
+from config import GENERATION_CACHE_SIZE, GENERATION_CACHE_DIR, GENERATION_CACHE_DISK_ENTRIES
+
+
+# 生成アルゴリズムを変えたら上げる
+CACHE_VERSION = 2
+
+# 生成結果に影響する項目（名前などは含めない）
+LOCATION_KEYS = ('id', 'working_days', 'closed_days', 'work_on_holidays',
+                 'min_staff', 'max_staff', 'part_time_priority', 'flexible_staffing')
+STAFF_KEYS = ('id', 'type', 'max_days', 'assigned_locations')
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+_stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "evictions": 0, "disk_errors": 0}
+
+
+def _month_ng_days(ng_days_data, year, month):
+    """NG日のうち指定年月の日付だけ（生成で読むのはその月だけ）
+
+    画面は全期間のNG日を送ってくるため、他の月のNG日を変えてもキーが変わらないようにする
+    """
+    prefix = f"{year}-{month:02d}-"
+    month_days = {}
+    for staff_id, dates in (ng_days_data or {}).items():
+        dates = sorted({d for d in dates if isinstance(d, str) and d.startswith(prefix)})
+        if dates:
+            month_days[staff_id] = dates
+    return month_days
+
+
+def generation_key(kind, year, month, locations, staff_list, ng_days_data, month_exceptions,
+                   params=None):
+    """生成条件のハッシュ"""
+    payload = {
+        "version": CACHE_VERSION,
+        "holidays": getattr(jpholiday, '__version__', ''),
+        "kind": kind,
+        "params": params or {},
+        "year": year,
+        "month": month,
+        "locations": [{k: loc.get(k) for k in LOCATION_KEYS} for loc in locations],
+        # スタッフの並び順は同数のときの優先順位になるため、順番も含める
+        "staff": [{k: s.get(k) for k in STAFF_KEYS} for s in staff_list],
+        "ng_days": _month_ng_days(ng_days_data, year, month),
+        "exceptions": month_exceptions,
+    }
+    text = json.dumps(payload, ensure_ascii=False, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def _disk_path(key):
+    return Path(GENERATION_CACHE_DIR) / f"{key}.json"
+
+
+def _int_keys(mapping):
+    """JSONで文字列になった数値のキーを数値に戻す"""
+    return {int(k) if isinstance(k, str) and k.isdigit() else k: v for k, v in mapping.items()}
+
+
+def _restore_keys(result):
+    """ディスクから読んだ生成結果のキー（拠点ID・スタッフID）を数値に戻す"""
+    for item in [result] + result.get('candidates', []):
+        if 'shift' in item:
+            item['shift'] = {date_str: _int_keys(locs) for date_str, locs in item['shift'].items()}
+        if 'staff_counts' in item:
+            item['staff_counts'] = _int_keys(item['staff_counts'])
+    return result
+
+
+def _remember(key, result):
+    """メモリに保存（古いものから追い出す）"""
+    with _cache_lock:
+        _cache[key] = result
+        _cache.move_to_end(key)
+        while len(_cache) > GENERATION_CACHE_SIZE:
+            _cache.popitem(last=False)
+            _stats['evictions'] += 1
+
+
+def get_cached_generation(key):
+    """キャッシュした生成結果を取得（なければNone）"""
+    with _cache_lock:
+        result = _cache.get(key)
+        if result is not None:
+            _cache.move_to_end(key)
+    if result is not None:
+        _stats['memory_hits'] += 1
+        return deepcopy(result)
+
+    if GENERATION_CACHE_DIR:
+        try:
+            result = _restore_keys(json.loads(_disk_path(key).read_text(encoding='utf-8')))
+            _stats['disk_hits'] += 1
+            if GENERATION_CACHE_SIZE > 0:
+                _remember(key, deepcopy(result))
+            return result
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            print(f"生成キャッシュ読み込みエラー: {e}")
+            _stats['disk_errors'] += 1
+
+    _stats['misses'] += 1
+    return None
+
+
+def _prune_disk():
+    """ディスクのキャッシュを古いものから削除"""
+    paths = list(Path(GENERATION_CACHE_DIR).glob('*.json'))
+    if len(paths) <= GENERATION_CACHE_DISK_ENTRIES:
+        return
+    paths.sort(key=lambda p: p.stat().st_mtime)
+    for path in paths[:len(paths) - GENERATION_CACHE_DISK_ENTRIES]:
+        path.unlink(missing_ok=True)
+
+
+def store_generation(key, result):
+    """生成結果を保存し、そのまま返す（キャッシュには複製を持つ）"""
+    _stats['stores'] += 1
+    if GENERATION_CACHE_SIZE > 0:
+        _remember(key, deepcopy(result))
+    if GENERATION_CACHE_DIR:
+        try:
+            text = json.dumps(result, ensure_ascii=False, separators=(',', ':'))
+            path = _disk_path(key)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+            tmp_path.write_text(text, encoding='utf-8')
+            os.replace(tmp_path, path)
+            _prune_disk()
+        except OSError as e:
+            print(f"生成キャッシュ書き込みエラー: {e}")
+            _stats['disk_errors'] += 1
+    return result
+
+
+def clear_generation_cache():
+    """メモリのキャッシュを破棄"""
+    with _cache_lock:
+        _cache.clear()
+
+
+def get_generation_cache_stats():
+    """キャッシュの件数・ヒット率を取得"""
+    stats = dict(_stats)
+    hits = stats['memory_hits'] + stats['disk_hits']
+    total = hits + stats['misses']
+    stats.update({
+        "hit_rate": round(hits / total, 3) if total else 0.0,
+        "entries": len(_cache),
+        "max_entries": GENERATION_CACHE_SIZE,
+        "disk_enabled": bool(GENERATION_CACHE_DIR),
+    })
+    return stats
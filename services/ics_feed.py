@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+"""
+スタッフごとのカレンダー配信（iCalendar）
+
+カレンダーアプリは数分おきに取りに来るため、作った結果を使い回し、ETag・Last-Modified で304を返す
+
+- 保存済みシフトを月ごとに読み込み、スタッフごとの予定（VEVENT）を作っておく
+- 月の一覧（更新時刻）を ICS_REFRESH_SECONDS ごとに確認し、変わった月だけを読み直す
+  （このプロセスでの保存・削除はすぐに反映する）
+- 配信する内容は、そのスタッフの予定がある月とその予定が変わったときだけ作り直す
+- URLにはスタッフIDから作ったトークンを付ける（秘密鍵を変えると全員のURLが変わる）
+"""
+
+import hashlib
+import hmac
+import threading
+import time
+from datetime import date, datetime, timedelta, timezone
+
+from config import ICS_TOKEN_SECRET, ICS_REFRESH_SECONDS, ICS_PAST_MONTHS, SECRET_KEY
+from models import get_locations, get_staff, list_shifts, load_shift, add_shift_change_listener
+
+
+# 月ID（YYYY-MM）→ {"updated_at", "locations": 拠点名, "staff": {スタッフID: (ハッシュ, VEVENT)}}
+_months = {}
+# スタッフID → {"key", "body", "etag", "last_modified"}
+_feeds = {}
+# このプロセスで保存・削除された月（次の取得で読み直す）
+_dirty = set()
+_checked_at = None
+# 読み込みの順番（後から始めた読み込みの結果を古い結果で上書きしない）
+_refresh_seq = 0
+_applied_seq = 0
+_lock = threading.Lock()
+_stats = {"list_checks": 0, "month_builds": 0, "feed_builds": 0, "feed_hits": 0, "not_modified": 0}
+
+
+def ics_token(staff_id):
+    """配信URLのトークン"""
+    secret = (ICS_TOKEN_SECRET or SECRET_KEY).encode('utf-8')
+    return hmac.new(secret, f"ics:{staff_id}".encode('utf-8'), hashlib.sha256).hexdigest()[:32]
+
+
+def verify_ics_token(staff_id, token):
+    return bool(token) and hmac.compare_digest(ics_token(staff_id), str(token))
+
+
+def _on_shift_change(months):
+    with _lock:
+        _dirty.update(f"{year}-{month:02d}" for year, month in months)
+
+
+add_shift_change_listener(_on_shift_change)
+
+
+def _escape(text):
+    """TEXT値のエスケープ"""
+    return (str(text).replace('\\', '\\\\').replace(';', '\\;')
+            .replace(',', '\\,').replace('\n', '\\n'))
+
+
+def _fold(line):
+    """75オクテットごとに折り返す（マルチバイト文字の途中では切らない）"""
+    data = line.encode('utf-8')
+    if len(data) <= 75:
+        return line + "\r\n"
+    parts = []
+    current = ""
+    size = 0
+    limit = 75
+    for ch in line:
+        n = len(ch.encode('utf-8'))
+        if size + n > limit:
+            parts.append(current)
+            current = ""
+            size = 0
+            limit = 74  # 続きの行は先頭の空白の分だけ短い
+        current += ch
+        size += n
+    parts.append(current)
+    return "\r\n ".join(parts) + "\r\n"
+
+
+def _parse_time(value):
+    """保存時刻（ISO形式の文字列）をUTCのdatetimeに（読めなければNone）"""
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(str(value))
+    except ValueError:
+        return None
+    # タイムゾーンのない時刻（ローカル保存）はこのサーバーの時刻
+    return parsed.astimezone(timezone.utc)
+
+
+def _build_month(doc, location_names, updated_at):
+    """1か月分のスタッフごとの予定 {スタッフID: (ハッシュ, VEVENTの文字列)}"""
+    saved_at = _parse_time(updated_at) or datetime(1970, 1, 1, tzinfo=timezone.utc)
+    stamp = saved_at.strftime('%Y%m%dT%H%M%SZ')
+    events = {}
+    for date_str, locs in sorted((doc.get('shift_data') or {}).items()):
+        try:
+            day = date.fromisoformat(date_str)
+        except ValueError:
+            continue
+        start = day.strftime('%Y%m%d')
+        end = (day + timedelta(days=1)).strftime('%Y%m%d')
+        for loc_key, assigned_ids in sorted(locs.items()):
+            summary = _escape(location_names.get(str(loc_key), '勤務'))
+            for sid in assigned_ids:
+                if not sid:
+                    continue
+                events.setdefault(str(sid), []).append(
+                    "BEGIN:VEVENT\r\n"
+                    + _fold(f"UID:{date_str}-{loc_key}-{sid}@shiftmaker")
+                    + f"DTSTAMP:{stamp}\r\n"
+                    + f"DTSTART;VALUE=DATE:{start}\r\n"
+                    + f"DTEND;VALUE=DATE:{end}\r\n"
+                    + _fold(f"SUMMARY:{summary}")
+                    + "END:VEVENT\r\n"
+                )
+    result = {}
+    for sid, blocks in events.items():
+        text = "".join(blocks)
+        result[sid] = (hashlib.sha256(text.encode('utf-8')).hexdigest()[:16], text)
+    return result
+
+
+def _refresh():
+    """月の一覧を確認し、変わった月を読み直す（_lock を持たずに呼ぶ）
+
+    一覧・シフトの読み込みはロックの外で行い、読み込んだ結果を入れ替えるときだけロックを持つ
+    """
+    global _checked_at, _refresh_seq, _applied_seq
+    with _lock:
+        now = time.monotonic()
+        if not _dirty and _checked_at is not None and now - _checked_at < ICS_REFRESH_SECONDS:
+            return
+        dirty = set(_dirty)
+        _dirty.clear()
+        _checked_at = now
+        _refresh_seq += 1
+        seq = _refresh_seq
+        known = {month_id: (entry['updated_at'], entry['locations']) for month_id, entry in _months.items()}
+        _stats['list_checks'] += 1
+
+    try:
+        today = date.today()
+        past = today.year * 12 + today.month - 1 - ICS_PAST_MONTHS
+        oldest = f"{past // 12}-{past % 12 + 1:02d}"
+        listing = {s['id']: s for s in list_shifts() if s['id'] >= oldest}
+        location_names = {str(loc['id']): loc['name'] for loc in get_locations()}
+
+        built = {}
+        for month_id, info in listing.items():
+            if month_id not in dirty and known.get(month_id) == (info['updated_at'], location_names):
+                continue
+            doc = load_shift(info['year'], info['month'])
+            built[month_id] = None if doc is None else {
+                "updated_at": info['updated_at'],
+                "locations": location_names,
+                "staff": _build_month(doc, location_names, info['updated_at']),
+            }
+    except Exception:
+        # 次の取得で読み直す
+        with _lock:
+            _dirty.update(dirty)
+            _checked_at = None
+        raise
+
+    with _lock:
+        if seq < _applied_seq:
+            # 後から始めた読み込みが先に反映済み
+            return
+        _applied_seq = seq
+        for month_id in [month_id for month_id in _months if month_id not in listing]:
+            del _months[month_id]
+        for month_id, entry in built.items():
+            if entry is None:
+                _months.pop(month_id, None)
+                continue
+            _months[month_id] = entry
+            _stats['month_builds'] += 1
+
+
+def get_staff_feed(staff_id):
+    """スタッフのカレンダー
+
+    Returns:
+        {"body": iCalendar（bytes）, "etag", "last_modified": datetime}（スタッフがいなければNone）
+    """
+    _refresh()
+    staff_list = get_staff()
+    with _lock:
+        staff_ids = {str(s['id']) for s in staff_list}
+        for sid in [sid for sid in _feeds if sid not in staff_ids]:
+            del _feeds[sid]
+        staff = next((s for s in staff_list if str(s['id']) == str(staff_id)), None)
+        if staff is None:
+            return None
+
+        sid = str(staff['id'])
+        parts = [(month_id, entry['staff'][sid]) for month_id, entry in sorted(_months.items())
+                 if sid in entry['staff']]
+        key = (staff['name'], tuple((month_id, digest) for month_id, (digest, _) in parts))
+        feed = _feeds.get(sid)
+        if feed is not None and feed['key'] == key:
+            _stats['feed_hits'] += 1
+            return feed
+
+        body = (
+            "BEGIN:VCALENDAR\r\n"
+            "VERSION:2.0\r\n"
+            "PRODID:-//shiftmaker//shift feed//JA\r\n"
+            "CALSCALE:GREGORIAN\r\n"
+            "METHOD:PUBLISH\r\n"
+            + _fold(f"X-WR-CALNAME:{_escape(staff['name'])} シフト")
+            + "".join(text for _, (_, text) in parts)
+            + "END:VCALENDAR\r\n"
+        ).encode('utf-8')
+        # 変更時刻はこのスタッフの予定がある月の最後の保存時刻（作り直したときだけ変わる）。
+        # 予定がなくなった・名前の変更など保存時刻が進まない変更でも、前回より後の時刻にする
+        times = [t for t in (_parse_time(_months[month_id]['updated_at']) for month_id, _ in parts) if t]
+        last_modified = max(times) if times else datetime.now(timezone.utc)
+        if feed is not None:
+            last_modified = max(last_modified, feed['last_modified'] + timedelta(seconds=1))
+        feed = {
+            "key": key,
+            "body": body,
+            "etag": hashlib.sha256(body).hexdigest()[:32],
+            "last_modified": last_modified.replace(microsecond=0),
+        }
+        _feeds[sid] = feed
+        _stats['feed_builds'] += 1
+        return feed
+
+
+def record_ics_not_modified():
+    """If-None-Match / If-Modified-Since が一致して304を返した"""
+    _stats['not_modified'] += 1
+
+
+def get_ics_feed_stats():
+    """読み込んだ月・作った配信の件数"""
+    with _lock:
+        stats = dict(_stats, months=len(_months), feeds=len(_feeds))
+    stats["refresh_seconds"] = ICS_REFRESH_SECONDS
+    return stats
@@ -1,9 +1,25 @@
 # -*- coding: utf-8 -*-
 """
 PDF出力サービス
+
+日本語フォントは初回の出力時に1回だけ探して登録し、結果（失敗した場合も）をプロセス内で使い回す
+
+レイアウト:
+- 列の位置・行の高さは最初に1回だけ計算し、セルは塗りつぶし色・フォントごとにまとめて描く
+- 行が MIN_ROW_HEIGHT より低くなる場合はページを分ける
+  （週のまとまりごと。1週分も入らなければ拠点をいくつかずつに分ける）
+- ページは圧縮して出力する
+
+スタッフごとのPDF:
+- 同じレイアウトで、各日の行にその人の勤務先だけを書く
+- プロセスプールで並列に作り、できた順にZIPへ書き出して少しずつ返す
 """
 
 import os
+import re
+import threading
+import time
+import zipfile
 from io import BytesIO
 
 from reportlab.lib import colors
@@ -12,235 +28,461 @@ from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfbase.ttfonts import TTFont
 from reportlab.pdfgen import canvas
 
-from models import get_locations, get_staff
-from .calendar_service import get_calendar_data
+from models import get_staff
+from .calendar_service import get_calendar_columns, group_weeks
+from .process_pool import iter_parallel
+
+
+FONT_PATHS = [
+    # Linux (Docker/Cloud Run) - IPA fonts
+    '/usr/share/fonts/opentype/ipaexfont-gothic/ipaexg.ttf',
+    '/usr/share/fonts/truetype/ipaexfont-gothic/ipaexg.ttf',
+    '/usr/share/fonts/opentype/ipafont-gothic/ipag.ttf',
+    '/usr/share/fonts/truetype/fonts-japanese-gothic.ttf',
+    # Linux - Noto fonts
+    '/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc',
+    '/usr/share/fonts/noto-cjk/NotoSansCJK-Regular.ttc',
+    '/usr/share/fonts/truetype/noto/NotoSansCJK-Regular.ttc',
+    # Windows fonts
+    'C:/Windows/Fonts/msgothic.ttc',
+    'C:/Windows/Fonts/meiryo.ttc',
+    'C:/Windows/Fonts/YuGothM.ttc',
+]
+
+BOLD_FONT_PATHS = [
+    # Linux (Docker/Cloud Run) - IPA fonts (use same as regular)
+    '/usr/share/fonts/opentype/ipaexfont-gothic/ipaexg.ttf',
+    '/usr/share/fonts/truetype/ipaexfont-gothic/ipaexg.ttf',
+    '/usr/share/fonts/opentype/ipafont-gothic/ipag.ttf',
+    # Windows fonts
+    'C:/Windows/Fonts/meiryob.ttc',
+    'C:/Windows/Fonts/YuGothB.ttc',
+    'C:/Windows/Fonts/msgothic.ttc',
+]
+
+_fonts = None
+_fonts_lock = threading.Lock()
+_font_stats = {"font": None, "bold_font": None, "path": None, "bold_path": None,
+               "load_seconds": None, "error": None}
 
 
 def get_japanese_font():
     """日本語フォントを取得"""
-    font_paths = [
-        # Linux (Docker/Cloud Run) - IPA fonts
-        '/usr/share/fonts/opentype/ipaexfont-gothic/ipaexg.ttf',
-        '/usr/share/fonts/truetype/ipaexfont-gothic/ipaexg.ttf',
-        '/usr/share/fonts/opentype/ipafont-gothic/ipag.ttf',
-        '/usr/share/fonts/truetype/fonts-japanese-gothic.ttf',
-        # Linux - Noto fonts
-        '/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc',
-        '/usr/share/fonts/noto-cjk/NotoSansCJK-Regular.ttc',
-        '/usr/share/fonts/truetype/noto/NotoSansCJK-Regular.ttc',
-        # Windows fonts
-        'C:/Windows/Fonts/msgothic.ttc',
-        'C:/Windows/Fonts/meiryo.ttc',
-        'C:/Windows/Fonts/YuGothM.ttc',
-    ]
-    for font_path in font_paths:
+    for font_path in FONT_PATHS:
         if os.path.exists(font_path):
             return font_path
     return None
 
 
-def create_pdf_shift(year, month, shift_data, month_exceptions):
-    """PDF形式のシフト表を作成"""
-    locations = get_locations()
-    staff_list = get_staff()
-    staff_dict = {s['id']: s['name'] for s in staff_list}
-    cal_data = get_calendar_data(year, month, month_exceptions)
-    num_locations = len(locations)
-
-    output = BytesIO()
-    page_width, page_height = landscape(A4)
-
-    c = canvas.Canvas(output, pagesize=landscape(A4))
-
-    # 日本語フォント登録
-    font_path = get_japanese_font()
+def _register_fonts():
+    """日本語フォントを登録し、(通常, 太字) のフォント名を返す（見つからなければHelvetica）"""
+    started = time.perf_counter()
     font_name = 'Helvetica'
     font_name_bold = 'Helvetica-Bold'
+    font_path = get_japanese_font()
     if font_path:
         try:
             pdfmetrics.registerFont(TTFont('JapaneseFont', font_path))
             font_name = 'JapaneseFont'
-            bold_paths = [
-                # Linux (Docker/Cloud Run) - IPA fonts (use same as regular)
-                '/usr/share/fonts/opentype/ipaexfont-gothic/ipaexg.ttf',
-                '/usr/share/fonts/truetype/ipaexfont-gothic/ipaexg.ttf',
-                '/usr/share/fonts/opentype/ipafont-gothic/ipag.ttf',
-                # Windows fonts
-                'C:/Windows/Fonts/meiryob.ttc',
-                'C:/Windows/Fonts/YuGothB.ttc',
-                'C:/Windows/Fonts/msgothic.ttc',
-            ]
             font_name_bold = font_name
-            for bold_path in bold_paths:
-                if os.path.exists(bold_path):
-                    try:
-                        pdfmetrics.registerFont(TTFont('JapaneseFontBold', bold_path))
-                        font_name_bold = 'JapaneseFontBold'
-                        break
-                    except:
-                        pass
-        except:
+            _font_stats['path'] = font_path
+            for bold_path in BOLD_FONT_PATHS:
+                if not os.path.exists(bold_path):
+                    continue
+                if bold_path == font_path:
+                    # 通常と同じファイルなら読み込み直さない
+                    _font_stats['bold_path'] = bold_path
+                    break
+                try:
+                    pdfmetrics.registerFont(TTFont('JapaneseFontBold', bold_path))
+                    font_name_bold = 'JapaneseFontBold'
+                    _font_stats['bold_path'] = bold_path
+                    break
+                except Exception as e:
+                    print(f"PDF太字フォント登録エラー: {e}")
+        except Exception as e:
+            print(f"PDFフォント登録エラー: {e}")
+            _font_stats['error'] = str(e)
             font_name = 'Helvetica'
             font_name_bold = 'Helvetica-Bold'
 
-    # カレンダーデータを週単位でグループ化
-    weeks = []
-    current_week = [None] * 7
-    for day_info in cal_data:
-        weekday_jp = (day_info['weekday'] + 1) % 7
-        current_week[weekday_jp] = day_info
-        if weekday_jp == 6:
-            weeks.append(current_week)
-            current_week = [None] * 7
-    if any(d is not None for d in current_week):
-        weeks.append(current_week)
-
-    # レイアウト計算
+    _font_stats.update({
+        "font": font_name,
+        "bold_font": font_name_bold,
+        "load_seconds": round(time.perf_counter() - started, 4),
+    })
+    return font_name, font_name_bold
+
+
+def get_pdf_fonts():
+    """PDFで使う (通常, 太字) のフォント名（登録は初回だけ。失敗した結果も使い回す）"""
+    global _fonts
+    if _fonts is None:
+        with _fonts_lock:
+            if _fonts is None:
+                _fonts = _register_fonts()
+    return _fonts
+
+
+def get_pdf_font_stats():
+    """登録したフォントと、登録にかかった時間"""
+    return dict(_font_stats, loaded=_fonts is not None)
+
+
+# これより行が低くなる場合はページを分ける（ポイント）
+MIN_ROW_HEIGHT = 12
+
+WEEKDAY_HEADERS = ['', '日', '月', '火', '水', '木', '金', '土']
+HEADER_COLORS = ['#4472C4', '#dc3545'] + ['#4472C4'] * 5 + ['#0d6efd']
+
+
+def _balanced_chunks(count, max_size):
+    """0〜count を max_size 以下で、なるべく均等な (開始, 終了) に分ける"""
+    if count <= 0:
+        return [(0, 0)]
+    chunks = -(-count // max(1, max_size))
+    size = -(-count // chunks)
+    return [(start, min(start + size, count)) for start in range(0, count, size)]
+
+
+def paginate(num_weeks, num_locations, max_rows):
+    """ページごとの表の区切り
+
+    Returns:
+        [[(週の添字, 拠点の開始, 拠点の終了), ...], ...]（1ページ = 見出し行＋週のまとまり）
+    """
+    block_rows = 1 + num_locations
+    if 1 + block_rows <= max_rows:
+        weeks_per_page = (max_rows - 1) // block_rows
+        return [
+            [(week_idx, 0, num_locations) for week_idx in range(start, end)]
+            for start, end in _balanced_chunks(num_weeks, weeks_per_page)
+        ]
+    groups = _balanced_chunks(num_locations, max_rows - 2)
+    return [[(week_idx, start, end)] for week_idx in range(num_weeks) for start, end in groups]
+
+
+def _table_columns(table_x, table_width, first_col_width=40):
+    """見出し列＋7日分の列の (左端のx, 幅)"""
+    other_col_width = (table_width - first_col_width) / 7
+    col_widths = [first_col_width] + [other_col_width] * 7
+    col_x = [table_x]
+    for width in col_widths[:-1]:
+        col_x.append(col_x[-1] + width)
+    return col_x, col_widths
+
+
+def _add_date_cells(cells, row_idx, calendar, week):
+    """日付行のセル（祝日・日曜は赤、土曜は青）"""
+    for col_idx, i in enumerate(week):
+        col = col_idx + 1
+        if i is None:
+            cells.add(row_idx, col, "")
+            continue
+
+        day = calendar['days'][i]
+        is_holiday = calendar['holidays'][i]
+        holiday_name = calendar['holiday_names'][i]
+
+        cell_text = str(day)
+        if is_holiday and holiday_name:
+            cell_text = f"{day} {holiday_name}"
+
+        if is_holiday or col_idx == 0:
+            cells.add(row_idx, col, cell_text, bg_color='#ffe6e6', text_color='#dc3545')
+        elif col_idx == 6:
+            cells.add(row_idx, col, cell_text, bg_color='#e6f0ff', text_color='#0d6efd')
+        else:
+            cells.add(row_idx, col, cell_text)
+
+
+class _CellBatch:
+    """1ページ分のセルを集め、塗りつぶし色・フォントごとにまとめて描く"""
+
+    def __init__(self, col_x, col_widths, top, row_height, fonts, font_size):
+        self.col_x = col_x
+        self.col_widths = col_widths
+        self.top = top
+        self.row_height = row_height
+        self.fonts = fonts
+        self.font_size = font_size
+        self.fills = {}
+        self.borders = []
+        self.texts = {}
+
+    def add(self, row_idx, col_idx, text, bg_color=None, text_color='#000000', bold=False, row_span=1):
+        x = self.col_x[col_idx]
+        y = self.top - (row_idx + row_span) * self.row_height
+        w = self.col_widths[col_idx]
+        h = self.row_height * row_span
+
+        if bg_color:
+            self.fills.setdefault(bg_color, []).append((x, y, w, h))
+        self.borders.append((x, y, w, h))
+
+        if text:
+            text = str(text)
+            font = self.fonts[bold]
+            text_width = pdfmetrics.stringWidth(text, font, self.font_size)
+            text_x = x + (w - text_width) / 2
+            text_y = y + (h - self.font_size) / 2 + self.font_size * 0.2
+            self.texts.setdefault((font, text_color), []).append((text_x, text_y, text))
+
+    def draw(self, c):
+        for color, rects in self.fills.items():
+            c.setFillColor(colors.HexColor(color))
+            path = c.beginPath()
+            for rect in rects:
+                path.rect(*rect)
+            c.drawPath(path, fill=1, stroke=0)
+
+        c.setStrokeColor(colors.black)
+        c.setLineWidth(0.5)
+        path = c.beginPath()
+        for rect in self.borders:
+            path.rect(*rect)
+        c.drawPath(path, fill=0, stroke=1)
+
+        for (font, color), texts in self.texts.items():
+            c.setFont(font, self.font_size)
+            c.setFillColor(colors.HexColor(color))
+            for text_x, text_y, text in texts:
+                c.drawString(text_x, text_y, text)
+
+
+def create_pdf_shift(year, month, shift_data, month_exceptions):
+    """PDF形式のシフト表を作成"""
+    calendar = get_calendar_columns(year, month, month_exceptions)
+    locations = calendar['locations']
+    all_closed_mask = calendar['all_closed_mask']
+    staff_names = {}
+    for s in get_staff():
+        staff_names[s['id']] = staff_names[str(s['id'])] = s['name']
+
+    output = BytesIO()
+    page_width, page_height = landscape(A4)
+
+    c = canvas.Canvas(output, pagesize=landscape(A4), pageCompression=1)
+
+    # 日本語フォント（登録済みのものを使う）
+    font_name, font_name_bold = get_pdf_fonts()
+
+    # 日を週単位でグループ化
+    weeks = group_weeks(calendar)
+
+    # レイアウト計算（全ページ共通）
     margin = 10
     table_x = margin
     table_y = margin
     table_width = page_width - 2 * margin
     table_height = page_height - 2 * margin
 
-    first_col_width = 40
-    other_col_width = (table_width - first_col_width) / 7
-    col_widths = [first_col_width] + [other_col_width] * 7
+    col_x, col_widths = _table_columns(table_x, table_width)
 
-    num_rows = 1 + len(weeks) * (1 + num_locations)
+    pages = paginate(len(weeks), len(locations), int(table_height // MIN_ROW_HEIGHT))
+    num_rows = max(1 + sum(1 + end - start for _, start, end in page) for page in pages)
     row_height = table_height / num_rows
     font_size = min(10, row_height * 0.7)
 
-    weekday_headers = ['', '日', '月', '火', '水', '木', '金', '土']
+    for page_idx, page in enumerate(pages):
+        if page_idx:
+            c.showPage()
+        cells = _CellBatch(col_x, col_widths, page_height - table_y, row_height,
+                           (font_name, font_name_bold), font_size)
 
-    def get_col_x(col_idx):
-        x = table_x
-        for i in range(col_idx):
-            x += col_widths[i]
-        return x
+        # ヘッダー行
+        for col_idx, header in enumerate(WEEKDAY_HEADERS):
+            cells.add(0, col_idx, header, bg_color=HEADER_COLORS[col_idx], text_color='#ffffff')
 
-    def draw_cell(row_idx, col_idx, text, bg_color=None, text_color=None, bold=False, row_span=1):
-        x = get_col_x(col_idx)
-        y = page_height - table_y - (row_idx + row_span) * row_height
-        w = col_widths[col_idx]
-        h = row_height * row_span
+        # データ行
+        current_row = 1
+        for block_idx, (week_idx, loc_start, loc_end) in enumerate(page):
+            week = weeks[week_idx]
+            block_locations = locations[loc_start:loc_end]
 
-        if bg_color:
-            c.setFillColor(bg_color)
-            c.rect(x, y, w, h, fill=1, stroke=0)
+            month_text = f"{month}月" if block_idx == 0 else ""
+            cells.add(current_row, 0, month_text, bg_color='#f8f9fa')
 
-        c.setStrokeColor(colors.black)
-        c.setLineWidth(0.5)
-        c.rect(x, y, w, h, fill=0, stroke=1)
+            _add_date_cells(cells, current_row, calendar, week)
+            current_row += 1
+
+            all_closed_days = [i is not None and bool(all_closed_mask & (1 << i)) for i in week]
+            for col_idx, all_closed in enumerate(all_closed_days):
+                if all_closed:
+                    cells.add(current_row, col_idx + 1, "定休日", bg_color='#d3d3d3',
+                              row_span=len(block_locations))
+
+            for loc in block_locations:
+                cells.add(current_row, 0, loc['name'], bg_color='#f8f9fa')
+                loc_key = str(loc['id'])
+
+                for col_idx, i in enumerate(week):
+                    col = col_idx + 1
+                    if all_closed_days[col_idx]:
+                        continue
+                    if i is None:
+                        cells.add(current_row, col, "")
+                        continue
+
+                    bit = 1 << i
+                    if loc['closed_mask'] & bit or not loc['working_mask'] & bit:
+                        cells.add(current_row, col, "", bg_color='#d3d3d3')
+                        continue
+
+                    # 画面から送られたシフトは拠点IDが文字列、サーバーで生成したシフトは数値
+                    day_shift = shift_data.get(calendar['dates'][i], {})
+                    assigned_ids = day_shift.get(loc_key) or day_shift.get(loc['id'], [])
+                    names = [staff_names.get(sid, '?') for sid in assigned_ids if sid]
+                    if names:
+                        cells.add(current_row, col, "/".join(names), bold=True)
+                    else:
+                        cells.add(current_row, col, "-", bg_color='#e0e0e0')
+                current_row += 1
+
+        cells.draw(c)
+
+    c.save()
+    output.seek(0)
+    return output
+
+
+# 1タスクでまとめて作るスタッフ数の上限（プロセス間の受け渡しの回数を減らす）
+STAFF_PDF_BATCH = 8
+
+# ファイル名に使えない文字
+_INVALID_FILENAME_CHARS = re.compile(r'[\\/:*?"<>|\s]+')
 
-        if text:
-            use_font = font_name_bold if bold else font_name
-            c.setFont(use_font, font_size)
-            if text_color:
-                c.setFillColor(text_color)
-            else:
-                c.setFillColor(colors.black)
-            text_width = c.stringWidth(str(text), use_font, font_size)
-            text_x = x + (w - text_width) / 2
-            text_y = y + (h - font_size) / 2 + font_size * 0.2
-            c.drawString(text_x, text_y, str(text))
-
-    # ヘッダー行
-    for col_idx, header in enumerate(weekday_headers):
-        if col_idx == 0:
-            bg = colors.HexColor('#4472C4')
-        elif col_idx == 1:
-            bg = colors.HexColor('#dc3545')
-        elif col_idx == 7:
-            bg = colors.HexColor('#0d6efd')
-        else:
-            bg = colors.HexColor('#4472C4')
-        draw_cell(0, col_idx, header, bg_color=bg, text_color=colors.white)
 
-    # データ行
+def _staff_pdf(calendar, name, work_days):
+    """1人分のPDF（bytes）
+
+    Args:
+        work_days: {日の添字: [勤務先の拠点名, ...]}
+    """
+    year, month = calendar['year'], calendar['month']
+    all_closed_mask = calendar['all_closed_mask']
+
+    output = BytesIO()
+    page_width, page_height = landscape(A4)
+    c = canvas.Canvas(output, pagesize=landscape(A4), pageCompression=1)
+    font_name, font_name_bold = get_pdf_fonts()
+
+    weeks = group_weeks(calendar)
+
+    margin = 10
+    title_height = 30
+    table_x = margin
+    table_width = page_width - 2 * margin
+    table_height = page_height - 2 * margin - title_height
+    col_x, col_widths = _table_columns(table_x, table_width)
+
+    # 見出し行＋週ごとに日付行・勤務行
+    row_height = table_height / (1 + 2 * len(weeks))
+    font_size = min(12, row_height * 0.4)
+
+    c.setFont(font_name_bold, 14)
+    c.drawString(table_x, page_height - margin - 20,
+                 f"{year}年{month}月 シフト表　{name}（出勤 {len(work_days)}日）")
+
+    cells = _CellBatch(col_x, col_widths, page_height - margin - title_height, row_height,
+                       (font_name, font_name_bold), font_size)
+    for col_idx, header in enumerate(WEEKDAY_HEADERS):
+        cells.add(0, col_idx, header, bg_color=HEADER_COLORS[col_idx], text_color='#ffffff')
+
     current_row = 1
     for week_idx, week in enumerate(weeks):
-        all_closed_days = []
-        for day_info in week:
-            if day_info:
-                all_closed = all(loc_info.get('is_closed_day', False) for loc_info in day_info['locations'])
-                all_closed_days.append(all_closed)
-            else:
-                all_closed_days.append(False)
-
-        month_text = f"{month}月" if week_idx == 0 else ""
-        draw_cell(current_row, 0, month_text, bg_color=colors.HexColor('#f8f9fa'))
+        cells.add(current_row, 0, f"{month}月" if week_idx == 0 else "", bg_color='#f8f9fa')
+        _add_date_cells(cells, current_row, calendar, week)
+        current_row += 1
 
-        for col_idx, day_info in enumerate(week):
+        cells.add(current_row, 0, "勤務", bg_color='#f8f9fa')
+        for col_idx, i in enumerate(week):
             col = col_idx + 1
-            if day_info:
-                day = day_info['day']
-                weekday_jp = (day_info['weekday'] + 1) % 7
-                is_holiday = day_info.get('is_holiday', False)
-                holiday_name = day_info.get('holiday_name', '')
-
-                cell_text = str(day)
-                if is_holiday and holiday_name:
-                    cell_text = f"{day} {holiday_name}"
-
-                if is_holiday or weekday_jp == 0:
-                    bg = colors.HexColor('#ffe6e6')
-                    txt_color = colors.HexColor('#dc3545')
-                elif weekday_jp == 6:
-                    bg = colors.HexColor('#e6f0ff')
-                    txt_color = colors.HexColor('#0d6efd')
-                else:
-                    bg = None
-                    txt_color = colors.black
-                draw_cell(current_row, col, cell_text, bg_color=bg, text_color=txt_color)
+            if i is None:
+                cells.add(current_row, col, "")
+            elif i in work_days:
+                cells.add(current_row, col, "/".join(work_days[i]), bold=True)
+            elif all_closed_mask & (1 << i):
+                cells.add(current_row, col, "定休日", bg_color='#d3d3d3')
             else:
-                draw_cell(current_row, col, "")
+                cells.add(current_row, col, "")
         current_row += 1
 
-        first_loc_row = current_row
-        for col_idx, day_info in enumerate(week):
-            col = col_idx + 1
-            if day_info and all_closed_days[col_idx]:
-                draw_cell(first_loc_row, col, "定休日",
-                         bg_color=colors.HexColor('#d3d3d3'),
-                         row_span=num_locations)
+    cells.draw(c)
+    c.save()
+    return output.getvalue()
 
-        for loc_idx, loc in enumerate(locations):
-            draw_cell(current_row, 0, loc['name'], bg_color=colors.HexColor('#f8f9fa'))
 
-            for col_idx, day_info in enumerate(week):
-                col = col_idx + 1
-                if all_closed_days[col_idx]:
-                    continue
+def _staff_pdf_batch(calendar, batch):
+    """何人分かのPDFを作る（プロセスプールで実行）
 
-                if day_info:
-                    loc_info = next((l for l in day_info['locations'] if l['id'] == loc['id']), None)
-                    bg = None
-                    is_name = False
-
-                    if loc_info and loc_info.get('is_closed_day', False):
-                        cell_text = ""
-                        bg = colors.HexColor('#d3d3d3')
-                    elif loc_info and not loc_info['is_working']:
-                        cell_text = ""
-                        bg = colors.HexColor('#d3d3d3')
-                    else:
-                        assigned_ids = shift_data.get(day_info['date'], {}).get(str(loc['id']), [])
-                        if assigned_ids:
-                            names = [staff_dict.get(int(sid) if isinstance(sid, str) else sid, '?')
-                                   for sid in assigned_ids if sid]
-                            cell_text = "/".join(names) if names else "-"
-                            is_name = bool(names)
-                            if not names:
-                                bg = colors.HexColor('#e0e0e0')
-                        else:
-                            cell_text = "-"
-                            bg = colors.HexColor('#e0e0e0')
-
-                    draw_cell(current_row, col, cell_text, bg_color=bg, bold=is_name)
-                else:
-                    draw_cell(current_row, col, "")
-            current_row += 1
+    Returns:
+        [(ZIP内のファイル名, PDFの内容), ...]
+    """
+    return [(filename, _staff_pdf(calendar, name, work_days)) for filename, name, work_days in batch]
 
-    c.save()
-    output.seek(0)
-    return output
+
+class _ZipStream:
+    """ZIPの書き出し先（書かれた分を取り出して送る）"""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def iter_staff_pdf_zip(year, month, shift_data, month_exceptions):
+    """スタッフごとのPDFをまとめたZIPを少しずつ返す
+
+    スタッフと拠点は呼び出した時点で読み込む（返したイテレータはリクエスト外でも使える）。
+    PDFはプロセスプールで並列に作り、できた順にZIPへ追加する（作成中のものだけがメモリにある）
+
+    Returns:
+        ZIPの内容（bytes）のイテレータ
+    """
+    calendar = get_calendar_columns(year, month, month_exceptions)
+    staff_list = get_staff()
+    location_names = {str(loc['id']): loc['name'] for loc in calendar['locations']}
+    date_index = {date_str: i for i, date_str in enumerate(calendar['dates'])}
+
+    # スタッフID → {日の添字: [拠点名, ...]}
+    work_days = {str(s['id']): {} for s in staff_list}
+    for date_str, locs in shift_data.items():
+        i = date_index.get(date_str)
+        if i is None:
+            continue
+        for loc_key, assigned_ids in locs.items():
+            for sid in assigned_ids:
+                days = work_days.get(str(sid))
+                if days is not None:
+                    days.setdefault(i, []).append(location_names.get(str(loc_key), '?'))
+
+    items = []
+    for s in staff_list:
+        safe_name = _INVALID_FILENAME_CHARS.sub('_', str(s['name'])).strip('_') or 'staff'
+        filename = f"shift_{year}_{month:02d}_{s['id']}_{safe_name}.pdf"
+        items.append((filename, s['name'], work_days[str(s['id'])]))
+    batch_size = max(1, min(STAFF_PDF_BATCH, len(items) // 16))
+    batches = [(calendar, items[start:start + batch_size]) for start in range(0, len(items), batch_size)]
+
+    def generate():
+        stream = _ZipStream()
+        # PDFは圧縮済みなので、ZIPではそのまま格納する
+        with zipfile.ZipFile(stream, 'w', compression=zipfile.ZIP_STORED) as zf:
+            for _, results in iter_parallel(_staff_pdf_batch, batches):
+                for filename, content in results:
+                    zf.writestr(filename, content)
+                yield stream.pop()
+        yield stream.pop()
+
+    return generate()
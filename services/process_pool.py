@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+プロセスプール（シフト生成などの重い計算を並列に実行）
+
+- プールは初回利用時に作成し、プロセス内で使い回す
+- SHIFT_WORKERS が1以下、またはタスクが1つだけのときはその場で実行する
+- プールが使えなくなったら作り直し、今回はその場で実行する
+  （実行する関数の中で起きた例外はその場で実行し直さず、そのまま送出する）
+- iter_parallel() は終わった順に結果を返す（同時に投入する件数を絞り、メモリを一定に保つ）
+"""
+
+import atexit
+import multiprocessing
+import os
+import threading
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+from config import SHIFT_WORKERS
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def _mp_context():
+    # gunicornのスレッドを抱えたままforkしないよう、forkserver（なければspawn）を使う
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+
+
+def get_process_pool():
+    """プロセスプールを取得（プロセス内で共有）"""
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ProcessPoolExecutor(max_workers=SHIFT_WORKERS, mp_context=_mp_context())
+            _pool_pid = os.getpid()
+        return _pool
+
+
+def shutdown_process_pool():
+    """プロセスプールを終了"""
+    global _pool, _pool_pid
+    with _pool_lock:
+        pool = _pool if _pool_pid == os.getpid() else None
+        _pool = None
+        _pool_pid = None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+class _PoolUnavailable(Exception):
+    """プールを作れない・投入できない"""
+
+
+def _submit(fn, args):
+    """プールに投入（プールが使えなければ _PoolUnavailable）
+
+    関数の中で起きた例外は future.result() でそのまま送出され、ここでは扱わない
+    """
+    try:
+        return get_process_pool().submit(fn, *args)
+    except (BrokenProcessPool, OSError, RuntimeError) as e:
+        raise _PoolUnavailable(e) from e
+
+
+def run_parallel(fn, args_list):
+    """fn(*args) を args_list の各要素について実行し、結果を同じ順で返す
+
+    プールが使えなければその場で実行する（fn の中で起きた例外はそのまま送出する）
+    """
+    if SHIFT_WORKERS <= 1 or len(args_list) <= 1:
+        return [fn(*args) for args in args_list]
+    futures = []
+    try:
+        for args in args_list:
+            futures.append(_submit(fn, args))
+        return [future.result() for future in futures]
+    except (_PoolUnavailable, BrokenProcessPool) as e:
+        print(f"プロセスプールエラー: {e}")
+        shutdown_process_pool()
+        return [fn(*args) for args in args_list]
+    finally:
+        for future in futures:
+            future.cancel()
+
+
+def iter_parallel(fn, args_list, max_pending=None):
+    """fn(*args) を args_list の各要素について実行し、終わった順に (添字, 結果) を返す
+
+    同時に投入するのは max_pending 件（既定: ワーカー数の2倍）まで。
+    プールが使えなければ残りをその場で実行する（fn の中で起きた例外はそのまま送出する）
+    """
+    if SHIFT_WORKERS <= 1 or len(args_list) <= 1:
+        for idx, args in enumerate(args_list):
+            yield idx, fn(*args)
+        return
+
+    max_pending = max_pending or SHIFT_WORKERS * 2
+    done = set()
+    pending = {}
+    try:
+        next_idx = 0
+        while next_idx < len(args_list) or pending:
+            while next_idx < len(args_list) and len(pending) < max_pending:
+                pending[_submit(fn, args_list[next_idx])] = next_idx
+                next_idx += 1
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                idx = pending.pop(future)
+                result = future.result()
+                done.add(idx)
+                yield idx, result
+    except (_PoolUnavailable, BrokenProcessPool) as e:
+        print(f"プロセスプールエラー: {e}")
+        shutdown_process_pool()
+        for future in pending:
+            future.cancel()
+        pending.clear()
+        for idx, args in enumerate(args_list):
+            if idx not in done:
+                yield idx, fn(*args)
+    finally:
+        # 途中でやめた（クライアントが切断した・fn で例外が起きた など）ときは残りを取り消す
+        for future in pending:
+            future.cancel()
+
+
+atexit.register(shutdown_process_pool)
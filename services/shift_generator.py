@@ -1,117 +1,734 @@
 # -*- coding: utf-8 -*-
 """
 シフト生成アルゴリズム
+
+割り当てのルール（従来どおり）:
+- 拠点・日ごとに、出勤日数の少ない順（同数ならスタッフ一覧の順）に割り当てる
+- パートは所属拠点が指定されていればその拠点のみ
+- NG日・最大出勤日数・同じ日の他拠点への割り当てを除外
+- パート優先の拠点は「社員1人 → パート1人 → 最小人数まで社員」の順
+
+高速化のため、事前に次を作っておく
+- 拠点ごとの割り当て可能なスタッフ
+- 日付ごとのNGスタッフ
+- 出勤日数ごとのスタッフ一覧（出勤日数の少ない順に取り出すための優先度キュー）
+
+カレンダーは get_calendar_columns() の列形式（拠点ごとの勤務日ビットマスク）を使う
 """
 
-from models import get_locations, get_staff
-from .calendar_service import get_calendar_data
+import random
+from bisect import insort
+from statistics import pstdev
 
+from config import SHIFT_OPTIMIZE_TIME_BUDGET, SHIFT_WORKERS, SHIFT_CANDIDATES
+from models import (
+    get_locations, get_staff, get_month_ng_days, get_month_exceptions, save_shifts, load_shift
+)
+from .calendar_service import get_calendar_columns, month_range
+from .generation_cache import generation_key, get_cached_generation, store_generation
+from .process_pool import run_parallel
+from .shift_optimizer import optimize_shift
 
-def generate_shift(year, month, ng_days_data, month_exceptions):
-    """シフトを自動生成"""
-    locations = get_locations()
-    staff_list = get_staff()
-    cal_data = get_calendar_data(year, month, month_exceptions)
 
-    staff_counts = {s['id']: 0 for s in staff_list}
-    shift_result = {}
+PART_TIME = 'パート'
+REGULAR = '社員'
 
-    for day_info in cal_data:
-        date_str = day_info['date']
-        shift_result[date_str] = {}
+# 候補の評価: この日数を超えて連続出勤した日を数える
+CONSECUTIVE_DAYS_LIMIT = 5
+SCORE_WEIGHT_SHORTAGE = 100
+SCORE_WEIGHT_STDEV = 10
+SCORE_WEIGHT_CONSECUTIVE = 5
 
-        for loc_info in day_info['locations']:
-            loc_id = loc_info['id']
-            shift_result[date_str][loc_id] = []
 
-            if not loc_info['is_working']:
-                continue
+class _StaffIndex:
+    """スタッフの割り当て状況（スタッフ一覧の添字で管理）"""
 
-            min_required = loc_info['min_staff']
-            max_allowed = loc_info['max_staff']
-            assigned = []
+    def __init__(self, staff_list, ng_days_data, staff_counts, carried=None):
+        self.staff_list = staff_list
+        self.ids = [s['id'] for s in staff_list]
+        self.types = [s['type'] for s in staff_list]
+        self.max_days = [s['max_days'] for s in staff_list]
+        self.counts = staff_counts
+        # 前月までの出勤日数（並び順にだけ使い、最大出勤日数の判定には含めない）
+        carried = carried or {}
+        base = min(carried.values(), default=0)
+        self.carried = {staff_id: count - base for staff_id, count in carried.items()}
 
-            available_staff = []
-            for s in staff_list:
-                staff_id = s['id']
-                staff_id_str = str(staff_id)
+        self.indices_by_id = {}
+        for i, staff_id in enumerate(self.ids):
+            self.indices_by_id.setdefault(staff_id, []).append(i)
+        self.part_time_ids = {s['id'] for s in staff_list if s['type'] == PART_TIME}
 
-                # パートの場合、所属拠点チェック
-                if s['type'] == 'パート':
+        # 日付 → NGのスタッフ（添字）
+        self.ng_by_date = {}
+        for i, staff_id in enumerate(self.ids):
+            for date_str in ng_days_data.get(str(staff_id), []):
+                self.ng_by_date.setdefault(date_str, set()).add(i)
+
+        # 出勤日数 → スタッフ（添字の昇順）。最大出勤日数に達したスタッフは含めない
+        self.buckets = []
+        for i, staff_id in enumerate(self.ids):
+            self._insert(i, self.counts[staff_id])
+
+        self._eligible_by_location = {}
+
+    def _insert(self, i, count):
+        if count >= self.max_days[i]:
+            return
+        key = count + self.carried.get(self.ids[i], 0)
+        while len(self.buckets) <= key:
+            self.buckets.append([])
+        insort(self.buckets[key], i)
+
+    def eligible(self, loc_id):
+        """拠点に割り当て可能なスタッフ（添字）"""
+        eligible = self._eligible_by_location.get(loc_id)
+        if eligible is None:
+            eligible = set()
+            for i, s in enumerate(self.staff_list):
+                if s['type'] == PART_TIME:
                     assigned_locs = s.get('assigned_locations', [])
                     if assigned_locs and loc_id not in assigned_locs:
                         continue
+                eligible.add(i)
+            self._eligible_by_location[loc_id] = eligible
+        return eligible
+
+    def candidates(self, loc_id, excluded_ids, ng_today):
+        """割り当て可能なスタッフを出勤日数の少ない順に返す"""
+        eligible = self.eligible(loc_id)
+        ids = self.ids
+        for bucket in self.buckets:
+            for i in bucket:
+                if i in eligible and i not in ng_today and ids[i] not in excluded_ids:
+                    yield i
+
+    def assign(self, staff_id):
+        """出勤日数を1日増やす"""
+        count = self.counts[staff_id]
+        self.counts[staff_id] = count + 1
+        key = count + self.carried.get(staff_id, 0)
+        for i in self.indices_by_id.get(staff_id, ()):
+            if count < self.max_days[i]:
+                self.buckets[key].remove(i)
+                self._insert(i, count + 1)
+
+
+def _assign_location(index, loc_info, excluded_ids, ng_today, kept=()):
+    """1拠点・1日分の割り当て
+
+    kept はそのまま残すスタッフ（excluded_ids に含めておくこと）
+    """
+    loc_id = loc_info['id']
+    max_allowed = loc_info['max_staff']
+    min_required = loc_info['min_staff']
+    ids = index.ids
+    assigned = list(kept)
 
-                staff_ng_days = ng_days_data.get(staff_id_str, [])
-                if date_str in staff_ng_days:
-                    continue
-
-                if staff_counts[staff_id] >= s['max_days']:
-                    continue
-
-                already_assigned_today = False
-                for other_loc_id, other_assigned in shift_result[date_str].items():
-                    if staff_id in other_assigned:
-                        already_assigned_today = True
-                        break
-                if already_assigned_today:
-                    continue
-
-                available_staff.append(s)
-
-            if loc_info['part_time_priority']:
-                part_timers = [s for s in available_staff if s['type'] == 'パート']
-                regulars = [s for s in available_staff if s['type'] == '社員']
-
-                part_timers.sort(key=lambda s: staff_counts[s['id']])
-                regulars.sort(key=lambda s: staff_counts[s['id']])
-
-                # パート優先枠でも、まず社員を1人確保する
-                for s in regulars:
-                    if len(assigned) >= 1:
-                        break
-                    assigned.append(s['id'])
-                    staff_counts[s['id']] += 1
-
-                # パートは最大1人まで
-                for s in part_timers:
-                    if len(assigned) >= max_allowed:
-                        break
-                    assigned.append(s['id'])
-                    staff_counts[s['id']] += 1
+    if not loc_info['part_time_priority']:
+        if len(assigned) < max_allowed:
+            for i in index.candidates(loc_id, excluded_ids, ng_today):
+                assigned.append(ids[i])
+                if len(assigned) >= max_allowed:
                     break
+        for staff_id in assigned[len(kept):]:
+            index.assign(staff_id)
+        return assigned
 
-                # flexible_staffing: パートがいなければ最小人数を1に減らす
-                if loc_info['flexible_staffing']:
-                    part_count = len([sid for sid in assigned
-                                    if any(s['id'] == sid and s['type'] == 'パート' for s in staff_list)])
-                    if part_count == 0 and min_required > 1:
-                        min_required = 1
-
-                # 残りの枠を社員で埋める
-                for s in regulars:
-                    if len(assigned) >= max_allowed:
-                        break
-                    if len(assigned) >= min_required:
-                        break
-                    if s['id'] in assigned:
-                        continue
-                    assigned.append(s['id'])
-                    staff_counts[s['id']] += 1
-            else:
-                available_staff.sort(key=lambda s: staff_counts[s['id']])
+    # 必要な社員は最大で max(1, 最小人数) 人、パートは1人
+    regulars_needed = max(1, min_required)
+    regulars = []
+    regular_ids = set()
+    part_timer = None
+    for i in index.candidates(loc_id, excluded_ids, ng_today):
+        staff_type = index.types[i]
+        if staff_type == REGULAR:
+            if len(regular_ids) < regulars_needed:
+                regulars.append(i)
+                regular_ids.add(ids[i])
+        elif staff_type == PART_TIME:
+            if part_timer is None:
+                part_timer = i
+        if part_timer is not None and len(regular_ids) >= regulars_needed:
+            break
+
+    # パート優先枠でも、まず社員を1人確保する
+    if regulars and not assigned:
+        assigned.append(ids[regulars[0]])
+
+    # パートは最大1人まで
+    if (part_timer is not None and len(assigned) < max_allowed
+            and not any(staff_id in index.part_time_ids for staff_id in kept)):
+        assigned.append(ids[part_timer])
+
+    # flexible_staffing: パートがいなければ最小人数を1に減らす
+    if loc_info['flexible_staffing']:
+        if not any(staff_id in index.part_time_ids for staff_id in assigned) and min_required > 1:
+            min_required = 1
+
+    # 残りの枠を社員で埋める
+    for i in regulars:
+        if len(assigned) >= max_allowed or len(assigned) >= min_required:
+            break
+        if ids[i] in assigned:
+            continue
+        assigned.append(ids[i])
+
+    for staff_id in assigned[len(kept):]:
+        index.assign(staff_id)
+    return assigned
+
+
+def assign_shifts(calendar, staff_list, ng_days_data, carried=None):
+    """カレンダーに従ってスタッフを割り当てる
+
+    Args:
+        calendar: get_calendar_columns() の結果
+        carried: 前月までの出勤日数 {スタッフID: 日数}（少ない人を優先する）
+
+    Returns:
+        (shift_result, staff_counts)
+    """
+    staff_counts = {s['id']: 0 for s in staff_list}
+    index = _StaffIndex(staff_list, ng_days_data, staff_counts, carried)
+    shift_result = {}
+
+    locations = calendar['locations']
+    for i, date_str in enumerate(calendar['dates']):
+        bit = 1 << i
+        day_result = {}
+        shift_result[date_str] = day_result
+        assigned_today = set()
+        ng_today = index.ng_by_date.get(date_str, ())
+
+        for loc_info in locations:
+            loc_id = loc_info['id']
+            day_result[loc_id] = []
+
+            if not loc_info['working_mask'] & bit:
+                continue
+
+            assigned = _assign_location(index, loc_info, assigned_today, ng_today)
+            day_result[loc_id] = assigned
+            assigned_today.update(assigned)
+
+    return shift_result, staff_counts
+
+
+def _cell_key(date_str, loc_id):
+    return (date_str, str(loc_id))
+
+
+def find_affected_cells(calendar, staff_list, ng_days_data, shift_data, pinned=(), changed_dates=(),
+                        changed_staff=()):
+    """入力の変更で割り当てをやり直す必要がある枠を探す
+
+    調べるのは changed_dates の枠と、changed_staff（NG日・最大出勤日数などを変えたスタッフ）・
+    削除されたスタッフが入っている枠だけ。changed_dates 以外の空の枠は固定として扱う
+    （手で空けた枠を埋め直さない）
+
+    Returns:
+        {(日付, 拠点ID文字列): 残すスタッフ}  固定した枠は含めない
+    """
+    staff_by_id = {}
+    for s in staff_list:
+        staff_by_id.setdefault(s['id'], s)
+    pinned = set(pinned)
+    changed_dates = set(changed_dates) & set(calendar['dates'])
+    changed_staff = set(changed_staff)
+    loc_by_key = {str(loc['id']): loc for loc in calendar['locations']}
+    affected = {}
+
+    # 変更した日は固定した枠以外をすべて割り当て直す
+    for date_str in changed_dates:
+        for loc_key in loc_by_key:
+            if (date_str, loc_key) not in pinned:
+                affected[(date_str, loc_key)] = []
+
+    # 変更したスタッフ・削除されたスタッフの入っている枠
+    cells_by_staff = {}
+    for date_str, day_shift in shift_data.items():
+        for loc_key, current in day_shift.items():
+            for staff_id in current:
+                if staff_id in changed_staff or staff_id not in staff_by_id:
+                    cells_by_staff.setdefault(staff_id, []).append((date_str, loc_key))
+
+    def remove(key, staff_id):
+        kept = affected.get(key, shift_data[key[0]][key[1]])
+        affected[key] = [sid for sid in kept if sid != staff_id]
+
+    for staff_id, keys in cells_by_staff.items():
+        s = staff_by_id.get(staff_id)
+        ng_dates = set(ng_days_data.get(str(staff_id), []))
+        count = 0
+        kept_keys = []
+        assigned_dates = set()
+        # 日付順、同じ日は固定した枠を先に
+        for key in sorted(keys, key=lambda key: (key[0], key not in pinned)):
+            date_str, loc_key = key
+            if key in pinned:
+                count += 1
+                assigned_dates.add(date_str)
+                continue
+            if date_str in changed_dates:
+                continue
+            loc_info = loc_by_key.get(loc_key)
+            if (s is None or loc_info is None or date_str in assigned_dates or date_str in ng_dates
+                    or (s['type'] == PART_TIME and s.get('assigned_locations')
+                        and loc_info['id'] not in s['assigned_locations'])):
+                remove(key, staff_id)
+                continue
+            count += 1
+            assigned_dates.add(date_str)
+            kept_keys.append(key)
+
+        # 最大出勤日数を超えたら月末側の枠から外す
+        over = count - s['max_days'] if s is not None else 0
+        for key in reversed(kept_keys):
+            if over <= 0:
+                break
+            remove(key, staff_id)
+            over -= 1
+
+    return affected
 
-                for s in available_staff:
-                    if len(assigned) >= max_allowed:
-                        break
-                    assigned.append(s['id'])
-                    staff_counts[s['id']] += 1
 
-            shift_result[date_str][loc_id] = assigned
+def regenerate_shift(year, month, shift_data, ng_days_data, month_exceptions,
+                     pinned=(), changed_dates=(), changed_staff=()):
+    """既存のシフトを元に、変更の影響を受けた枠だけを割り当て直す
+
+    Args:
+        shift_data: 既存のシフト {日付: {拠点ID: [スタッフID, ...]}}
+        pinned: 変更しない枠 [(日付, 拠点ID), ...]
+        changed_dates: 全枠を割り当て直す日付（固定した枠は除く。例外日を変えた日もここに含める）
+        changed_staff: NG日・最大出勤日数などを変えたスタッフID（入っている枠を確認し直す）
+
+    Returns:
+        generate_shift と同じ形式に diff（変更した枠の一覧）を加えたもの
+    """
+    staff_list = get_staff()
+    calendar = get_calendar_columns(year, month, month_exceptions)
+    locations = calendar['locations']
+    shift_data = {
+        date_str: {str(loc_id): list(staff) for loc_id, staff in locs.items()}
+        for date_str, locs in (shift_data or {}).items()
+    }
+    pinned = {_cell_key(date_str, loc_id) for date_str, loc_id in pinned}
+    changed_staff = {str(staff_id) for staff_id in changed_staff}
+    changed_staff = {s['id'] for s in staff_list if str(s['id']) in changed_staff}
+
+    affected = find_affected_cells(calendar, staff_list, ng_days_data, shift_data,
+                                   pinned, changed_dates, changed_staff)
+
+    # 影響のない枠の出勤日数を引き継ぐ
+    staff_counts = {s['id']: 0 for s in staff_list}
+    for date_str, locs in shift_data.items():
+        for loc_key, staff in locs.items():
+            kept = affected.get((date_str, loc_key), staff)
+            for staff_id in kept:
+                if staff_id in staff_counts:
+                    staff_counts[staff_id] += 1
+
+    index = _StaffIndex(staff_list, ng_days_data, staff_counts)
+    affected_dates = {date_str for date_str, _ in affected}
+    shift_result = {}
+    diff = []
+
+    for i, date_str in enumerate(calendar['dates']):
+        bit = 1 << i
+        day_shift = shift_data.get(date_str, {})
+        day_result = {}
+        shift_result[date_str] = day_result
+        for loc_info in locations:
+            key = _cell_key(date_str, loc_info['id'])
+            day_result[loc_info['id']] = affected.get(key, day_shift.get(key[1], []))
+        if date_str not in affected_dates:
+            continue
+
+        assigned_today = set()
+        for assigned in day_result.values():
+            assigned_today.update(assigned)
+        ng_today = index.ng_by_date.get(date_str, ())
+
+        for loc_info in locations:
+            key = _cell_key(date_str, loc_info['id'])
+            if key not in affected:
+                continue
+            kept = affected[key]
+            if loc_info['working_mask'] & bit:
+                assigned = _assign_location(index, loc_info, assigned_today, ng_today, kept)
+            else:
+                assigned = []
+            day_result[loc_info['id']] = assigned
+            assigned_today.update(assigned)
+
+            before = day_shift.get(key[1], [])
+            if assigned != before:
+                diff.append({
+                    "date": date_str,
+                    "location_id": loc_info['id'],
+                    "before": before,
+                    "after": assigned
+                })
 
     return {
+        "year": year,
+        "month": month,
+        "shift": shift_result,
+        "staff_counts": staff_counts,
+        "mode": "incremental",
+        "diff": diff
+    }
+
+
+def generate_shift(year, month, ng_days_data, month_exceptions, mode='greedy', time_budget=None):
+    """シフトを自動生成
+
+    Args:
+        mode: "greedy"（従来の割り当て）/ "optimize"（貪欲法の結果を制限時間まで改善）
+        time_budget: optimize の制限時間（秒）。Noneなら設定値
+
+    greedy の結果は入力が同じならキャッシュから返す
+    """
+    staff_list = get_staff()
+    if month_exceptions is None:
+        month_exceptions = get_month_exceptions(year, month)
+
+    cache_key = None
+    if mode == 'greedy':
+        cache_key = generation_key('greedy', year, month, get_locations(), staff_list,
+                                   ng_days_data, month_exceptions)
+        cached = get_cached_generation(cache_key)
+        if cached is not None:
+            return cached
+
+    calendar = get_calendar_columns(year, month, month_exceptions)
+
+    shift_result, staff_counts = assign_shifts(calendar, staff_list, ng_days_data)
+
+    result = {
         "year": year,
         "month": month,
         "shift": shift_result,
         "staff_counts": staff_counts
     }
+    if mode == 'optimize':
+        if time_budget is None:
+            time_budget = SHIFT_OPTIMIZE_TIME_BUDGET
+        shift_result, staff_counts, objective = optimize_shift(
+            calendar, staff_list, ng_days_data, shift_result, staff_counts, time_budget
+        )
+        result.update({
+            "shift": shift_result,
+            "staff_counts": staff_counts,
+            "mode": mode,
+            "objective": objective
+        })
+    if cache_key:
+        return store_generation(cache_key, result)
+    return result
+
+
+# -----------------------------------------------------------------------------
+# 複数候補の生成
+# -----------------------------------------------------------------------------
+
+def score_shift(calendar, staff_list, shift_result, staff_counts):
+    """シフトの評価（score が小さいほど良い）
+
+    - shortage: 最小人数に足りない人数の合計（flexible_staffing の緩和を反映）
+    - stdev / spread: スタッフ間の出勤日数の標準偏差・最大と最小の差
+    - consecutive_excess: CONSECUTIVE_DAYS_LIMIT 日を超えて連続出勤した日数の合計
+    """
+    types = {s['id']: s['type'] for s in staff_list}
+    shortage = 0
+    consecutive_excess = 0
+    streaks = {}
+    for i, date_str in enumerate(calendar['dates']):
+        bit = 1 << i
+        day_shift = shift_result[date_str]
+        worked_today = set()
+        for loc_info in calendar['locations']:
+            assigned = day_shift[loc_info['id']]
+            worked_today.update(assigned)
+            if not loc_info['working_mask'] & bit:
+                continue
+            min_required = loc_info['min_staff']
+            if (loc_info['part_time_priority'] and loc_info['flexible_staffing']
+                    and not any(types.get(sid) == PART_TIME for sid in assigned)):
+                min_required = min(min_required, 1)
+            shortage += max(0, min_required - len(assigned))
+        streaks = {sid: streaks.get(sid, 0) + 1 for sid in worked_today}
+        consecutive_excess += sum(1 for streak in streaks.values() if streak > CONSECUTIVE_DAYS_LIMIT)
+
+    counts = [staff_counts[s['id']] for s in staff_list if s['max_days'] > 0]
+    stdev = pstdev(counts) if counts else 0.0
+    spread = max(counts) - min(counts) if counts else 0
+    score = (SCORE_WEIGHT_SHORTAGE * shortage + SCORE_WEIGHT_STDEV * stdev
+             + SCORE_WEIGHT_CONSECUTIVE * consecutive_excess)
+    return {
+        "score": round(score, 3),
+        "shortage": shortage,
+        "stdev": round(stdev, 3),
+        "spread": spread,
+        "consecutive_excess": consecutive_excess,
+    }
+
+
+def _generate_candidates(calendar, staff_list, ng_days_data, seeds):
+    """同数のときの並び順を変えて生成し、評価する（プロセスプールで実行）
+
+    seed 0 は従来どおりスタッフ一覧の順
+    """
+    candidates = []
+    for seed in seeds:
+        ordered = list(staff_list)
+        if seed:
+            random.Random(seed).shuffle(ordered)
+        shift_result, counts = assign_shifts(calendar, ordered, ng_days_data)
+        staff_counts = {s['id']: counts[s['id']] for s in staff_list}
+        candidates.append({
+            "seed": seed,
+            "metrics": score_shift(calendar, staff_list, shift_result, staff_counts),
+            "shift": shift_result,
+            "staff_counts": staff_counts
+        })
+    return candidates
+
+
+def generate_shift_candidates(year, month, ng_days_data, month_exceptions, count=None, top_k=3):
+    """複数の候補を生成し、評価の良い順に top_k 件を返す
+
+    先頭の候補を shift / staff_counts にも入れる（通常の生成結果と同じ形で使える）
+    """
+    staff_list = get_staff()
+    if month_exceptions is None:
+        month_exceptions = get_month_exceptions(year, month)
+    seeds = list(range(count or SHIFT_CANDIDATES))
+
+    cache_key = generation_key('candidates', year, month, get_locations(), staff_list,
+                               ng_days_data, month_exceptions, {"count": len(seeds), "top_k": top_k})
+    cached = get_cached_generation(cache_key)
+    if cached is not None:
+        return cached
+
+    calendar = get_calendar_columns(year, month, month_exceptions)
+
+    chunks = max(1, min(SHIFT_WORKERS, len(seeds)))
+    seed_chunks = [seeds[i::chunks] for i in range(chunks)]
+    results = run_parallel(_generate_candidates,
+                           [(calendar, staff_list, ng_days_data, chunk) for chunk in seed_chunks])
+
+    candidates = [candidate for chunk in results for candidate in chunk]
+    candidates.sort(key=lambda c: (c['metrics']['score'], c['seed']))
+    candidates = candidates[:max(1, top_k)]
+    for rank, candidate in enumerate(candidates, 1):
+        candidate['rank'] = rank
+
+    return store_generation(cache_key, {
+        "year": year,
+        "month": month,
+        "shift": candidates[0]['shift'],
+        "staff_counts": candidates[0]['staff_counts'],
+        "mode": "candidates",
+        "generated": len(seeds),
+        "candidates": candidates
+    })
+
+
+# -----------------------------------------------------------------------------
+# 複数月の一括生成
+# -----------------------------------------------------------------------------
+
+def split_independent_parts(calendar, staff_list):
+    """スタッフを共有しない拠点のグループに分ける
+
+    グループ同士は割り当てが影響し合わないため、別々に生成しても結果は同じ
+
+    Returns:
+        [(拠点IDの集合, スタッフ一覧), ...]（スタッフのいないグループは含めない）
+    """
+    loc_ids = [loc['id'] for loc in calendar['locations']]
+    if len({s['id'] for s in staff_list}) != len(staff_list):
+        # IDが重複していると出勤日数を共有するため分けない
+        return [(set(loc_ids), staff_list)]
+
+    parent = {loc_id: loc_id for loc_id in loc_ids}
+
+    def find(loc_id):
+        while parent[loc_id] != loc_id:
+            parent[loc_id] = parent[parent[loc_id]]
+            loc_id = parent[loc_id]
+        return loc_id
+
+    staff_locations = []
+    for s in staff_list:
+        locs = loc_ids
+        if s['type'] == PART_TIME and s.get('assigned_locations'):
+            locs = [loc_id for loc_id in loc_ids if loc_id in s['assigned_locations']]
+        staff_locations.append(locs)
+        for loc_id in locs[1:]:
+            parent[find(loc_id)] = find(locs[0])
+
+    groups = {}
+    for loc_id in loc_ids:
+        groups.setdefault(find(loc_id), (set(), []))[0].add(loc_id)
+    for s, locs in zip(staff_list, staff_locations):
+        if locs:
+            groups[find(locs[0])][1].append(s)
+    return [group for group in groups.values() if group[1]]
+
+
+def _filter_calendar(calendar, loc_ids):
+    """カレンダーを指定した拠点だけに絞る（プロセスプールには生成に使う列だけを渡す）"""
+    return {
+        "dates": calendar['dates'],
+        "locations": [loc for loc in calendar['locations'] if loc['id'] in loc_ids]
+    }
+
+
+def _generate_part(months, staff_list):
+    """1グループ分の連続した月を生成（プロセスプールで実行）
+
+    Args:
+        months: [(calendar, ng_days_data), ...]
+
+    Returns:
+        [(shift_result, staff_counts), ...]
+    """
+    carried = {}
+    results = []
+    for calendar, ng_days_data in months:
+        shift_result, staff_counts = assign_shifts(calendar, staff_list, ng_days_data, carried)
+        results.append((shift_result, staff_counts))
+        for staff_id, count in staff_counts.items():
+            carried[staff_id] = carried.get(staff_id, 0) + count
+    return results
+
+
+def _generate_parts(tasks):
+    """複数グループをまとめて生成（プロセスプールに渡す単位）"""
+    return [_generate_part(months, staff_list) for months, staff_list in tasks]
+
+
+def _chunk_tasks(tasks, chunks):
+    """タスクをスタッフ数がなるべく均等になるように chunks 個に分ける"""
+    bins = [[] for _ in range(max(1, min(chunks, len(tasks))))]
+    loads = [0] * len(bins)
+    order = sorted(range(len(tasks)), key=lambda i: -len(tasks[i][1]))
+    for i in order:
+        target = loads.index(min(loads))
+        bins[target].append(i)
+        loads[target] += len(tasks[i][1])
+    return bins
+
+
+def _json_keys(mapping):
+    """辞書のキーを文字列にする（Firestore・JSONと同じ形にそろえる）"""
+    return {str(key): value for key, value in mapping.items()}
+
+
+def generate_shift_range(start, end, ng_days_by_month=None, exceptions_by_month=None, persist=False):
+    """連続した複数月のシフトを生成（出勤日数の偏りを月をまたいでならす）
+
+    Args:
+        start, end: "YYYY-MM"（両端を含む）
+        ng_days_by_month: {"YYYY-MM": NG日}（ない月は保存済みのNG日）
+        exceptions_by_month: {"YYYY-MM": 例外日}（ない月は保存済みの例外日）
+        persist: Trueなら全月のシフトを1回のバッチで保存
+    """
+    ng_days_by_month = ng_days_by_month or {}
+    exceptions_by_month = exceptions_by_month or {}
+    staff_list = get_staff()
+
+    months = []
+    for year, month in month_range(start, end):
+        key = f"{year}-{month:02d}"
+        month_exceptions = exceptions_by_month.get(key)
+        if month_exceptions is None:
+            month_exceptions = get_month_exceptions(year, month)
+        ng_days_data = ng_days_by_month.get(key)
+        if ng_days_data is None:
+            ng_days_data = get_month_ng_days(year, month)
+        calendar = get_calendar_columns(year, month, month_exceptions)
+        months.append((year, month, calendar, ng_days_data, month_exceptions))
+    if not months:
+        return {"start": start, "end": end, "months": [], "staff_counts": {}, "parts": 0}
+
+    # 独立したグループごとに全月分をまとめて生成
+    parts = split_independent_parts(months[0][2], staff_list)
+    tasks = [
+        ([(_filter_calendar(calendar, loc_ids), ng_days_data)
+          for _, _, calendar, ng_days_data, _ in months], part_staff)
+        for loc_ids, part_staff in parts
+    ]
+    bins = _chunk_tasks(tasks, SHIFT_WORKERS)
+    bin_results = run_parallel(_generate_parts, [([tasks[i] for i in indices],) for indices in bins])
+    part_results = [None] * len(tasks)
+    for indices, results in zip(bins, bin_results):
+        for i, part_result in zip(indices, results):
+            part_results[i] = part_result
+
+    total_counts = {s['id']: 0 for s in staff_list}
+    month_results = []
+    for i, (year, month, calendar, _, _) in enumerate(months):
+        shift_result = {
+            date_str: {loc['id']: [] for loc in calendar['locations']}
+            for date_str in calendar['dates']
+        }
+        staff_counts = {s['id']: 0 for s in staff_list}
+        for results in part_results:
+            part_shift, part_counts = results[i]
+            for date_str, locs in part_shift.items():
+                shift_result[date_str].update(locs)
+            staff_counts.update(part_counts)
+        for staff_id, count in staff_counts.items():
+            total_counts[staff_id] += count
+        month_results.append({
+            "year": year,
+            "month": month,
+            "shift": shift_result,
+            "staff_counts": staff_counts
+        })
+
+    result = {
+        "start": start,
+        "end": end,
+        "months": month_results,
+        "staff_counts": total_counts,
+        "parts": len(parts)
+    }
+
+    if persist:
+        shift_docs = [
+            {
+                "year": item['year'],
+                "month": item['month'],
+                "shift_data": {date_str: _json_keys(locs) for date_str, locs in item['shift'].items()},
+                "staff_counts": _json_keys(item['staff_counts']),
+                "ng_days": ng_days_data,
+                "exceptions": month_exceptions,
+            }
+            for item, (_, _, _, ng_days_data, month_exceptions) in zip(month_results, months)
+        ]
+        result['saved'] = save_shifts(shift_docs)
+    return result
+
+
+def iter_month_shifts(start, end):
+    """start〜end の各月のシフトを1か月ずつ返す（保存済みのシフト、なければ生成した結果）
+
+    Yields:
+        (年, 月, シフト {日付: {拠点ID: [スタッフID, ...]}}, 例外日)
+    """
+    for year, month in month_range(start, end):
+        saved = load_shift(year, month)
+        if saved and saved.get('shift_data'):
+            month_exceptions = saved.get('exceptions')
+            if month_exceptions is None:
+                month_exceptions = get_month_exceptions(year, month)
+            yield year, month, saved['shift_data'], month_exceptions
+            continue
+        month_exceptions = get_month_exceptions(year, month)
+        result = generate_shift(year, month, get_month_ng_days(year, month), month_exceptions)
+        yield year, month, result['shift'], month_exceptions
@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+"""
+シフトの最適化（局所探索）
+
+貪欲法の結果から始めて、制約を守ったまま割り当てを入れ替え、
+評価値（コスト）が下がる変更だけを採用する。制限時間に達するか、
+一定回数（枠の数に比例）続けて改善しなくなったら、それまでで最良の結果を返す
+
+制約（必ず守る）:
+- NG日・最大出勤日数・パートの所属拠点
+- 1日1拠点まで、各拠点の最大人数まで
+- パート優先の拠点はパート1人まで（社員・パート以外は割り当てない）
+
+コスト（小さいほど良い）:
+- 最小人数に足りない人数（flexible_staffing でパートがいなければ最小人数は1）
+- 目標人数に足りない人数（通常の拠点は最大人数、パート優先の拠点は最小人数）
+- パート優先の拠点に社員がいない
+- 出勤日数の偏り（出勤日数の2乗の合計）
+"""
+
+import math
+import random
+import time
+
+PART_TIME = 'パート'
+REGULAR = '社員'
+
+WEIGHT_SHORTAGE = 1000
+WEIGHT_UNFILLED = 100
+WEIGHT_NO_REGULAR = 50
+WEIGHT_FAIRNESS = 1
+
+# この回数（枠1つあたり・最低回数）続けてコストが下がらなければ収束したとみなす
+STALL_MOVES_PER_SLOT = 200
+MIN_STALL_MOVES = 5000
+
+
+class _Slot:
+    """1拠点・1日分の枠"""
+
+    __slots__ = ('date', 'loc_id', 'min_staff', 'max_staff', 'priority', 'flexible', 'staff')
+
+    def __init__(self, date_str, loc_info, staff):
+        self.date = date_str
+        self.loc_id = loc_info['id']
+        self.min_staff = loc_info['min_staff']
+        self.max_staff = loc_info['max_staff']
+        self.priority = loc_info['part_time_priority']
+        self.flexible = loc_info['flexible_staffing']
+        self.staff = staff
+
+
+class _Problem:
+    """制約と評価値の計算"""
+
+    def __init__(self, calendar, staff_list, ng_days_data):
+        self.staff_by_id = {}
+        for s in staff_list:
+            self.staff_by_id.setdefault(s['id'], s)
+        self.types = {sid: s['type'] for sid, s in self.staff_by_id.items()}
+        self.max_days = {sid: s['max_days'] for sid, s in self.staff_by_id.items()}
+        self.ng = {sid: set(ng_days_data.get(str(sid), [])) for sid in self.staff_by_id}
+
+        self.eligible_by_location = {}
+        for loc_info in calendar['locations']:
+            loc_id = loc_info['id']
+            if loc_id in self.eligible_by_location:
+                continue
+            self.eligible_by_location[loc_id] = [
+                sid for sid, s in self.staff_by_id.items()
+                if not (s['type'] == PART_TIME and s.get('assigned_locations')
+                        and loc_id not in s['assigned_locations'])
+            ]
+        self.eligible_sets = {
+            loc_id: set(sids) for loc_id, sids in self.eligible_by_location.items()
+        }
+
+    def slot_terms(self, slot, staff):
+        """枠の (最小人数の不足, 目標人数の不足, 社員不在) """
+        count = len(staff)
+        min_required = slot.min_staff
+        no_regular = 0
+        if slot.priority:
+            has_part = any(self.types.get(sid) == PART_TIME for sid in staff)
+            if slot.flexible and not has_part and min_required > 1:
+                min_required = 1
+            if count and not any(self.types.get(sid) == REGULAR for sid in staff):
+                no_regular = 1
+            target = min_required
+        else:
+            target = slot.max_staff
+        return (max(0, min_required - count),
+                max(0, min(target, slot.max_staff) - count),
+                no_regular)
+
+    def slot_cost(self, slot, staff):
+        """枠のコスト"""
+        shortage, unfilled, no_regular = self.slot_terms(slot, staff)
+        return (WEIGHT_SHORTAGE * shortage + WEIGHT_UNFILLED * unfilled
+                + WEIGHT_NO_REGULAR * no_regular)
+
+    def fits(self, slot, staff):
+        """枠の割り当てが拠点の制約を満たすか（人数・パート優先）"""
+        if len(staff) > slot.max_staff:
+            return False
+        if slot.priority:
+            parts = 0
+            for sid in staff:
+                staff_type = self.types.get(sid)
+                if staff_type == PART_TIME:
+                    parts += 1
+                elif staff_type != REGULAR:
+                    return False
+            if parts > 1:
+                return False
+        return True
+
+    def can_work(self, sid, slot, counts, day_assigned):
+        """スタッフをその枠に追加できるか（所属拠点・NG日・出勤日数・同日の割り当て）"""
+        return (sid not in day_assigned[slot.date]
+                and slot.date not in self.ng[sid]
+                and counts[sid] < self.max_days[sid])
+
+
+def evaluate(slots, counts, problem):
+    """評価値の内訳"""
+    shortage = unfilled = no_regular = 0
+    for slot in slots:
+        terms = problem.slot_terms(slot, slot.staff)
+        shortage += terms[0]
+        unfilled += terms[1]
+        no_regular += terms[2]
+    fairness = sum(c * c for c in counts.values())
+    return {
+        "cost": (WEIGHT_SHORTAGE * shortage + WEIGHT_UNFILLED * unfilled
+                 + WEIGHT_NO_REGULAR * no_regular + WEIGHT_FAIRNESS * fairness),
+        "shortage": shortage,
+        "unfilled": unfilled,
+        "no_regular": no_regular,
+        "fairness": fairness,
+    }
+
+
+def optimize_shift(calendar, staff_list, ng_days_data, shift_result, staff_counts,
+                   time_budget, seed=0):
+    """貪欲法の結果を局所探索で改善
+
+    Args:
+        calendar: get_calendar_columns() の結果
+
+    Returns:
+        (shift_result, staff_counts, objective)
+    """
+    problem = _Problem(calendar, staff_list, ng_days_data)
+    rng = random.Random(seed)
+
+    counts = {sid: 0 for sid in staff_counts}
+    day_assigned = {}
+    slots = []
+    for i, date_str in enumerate(calendar['dates']):
+        bit = 1 << i
+        day_assigned[date_str] = {}
+        for loc_info in calendar['locations']:
+            if not loc_info['working_mask'] & bit:
+                continue
+            staff = list(shift_result[date_str][loc_info['id']])
+            slot = _Slot(date_str, loc_info, staff)
+            slots.append(slot)
+            for sid in staff:
+                counts[sid] = counts.get(sid, 0) + 1
+                day_assigned[date_str][sid] = slot
+
+    start_objective = evaluate(slots, counts, problem)
+    if not slots or not problem.staff_by_id:
+        return shift_result, staff_counts, dict(start_objective, iterations=0,
+                                                initial_cost=start_objective['cost'])
+
+    slots_by_date = {}
+    for slot in slots:
+        slots_by_date.setdefault(slot.date, []).append(slot)
+
+    def fairness_delta(sid, change):
+        c = counts[sid]
+        return WEIGHT_FAIRNESS * ((c + change) ** 2 - c * c)
+
+    def try_add(slot):
+        """空いている枠にスタッフを追加（コストが下がればTrue）"""
+        candidates = problem.eligible_by_location[slot.loc_id]
+        sid = candidates[rng.randrange(len(candidates))]
+        if not problem.can_work(sid, slot, counts, day_assigned):
+            return
+        new_staff = slot.staff + [sid]
+        if not problem.fits(slot, new_staff):
+            return
+        delta = (problem.slot_cost(slot, new_staff) - problem.slot_cost(slot, slot.staff)
+                 + fairness_delta(sid, 1))
+        if delta < 0:
+            slot.staff = new_staff
+            counts[sid] += 1
+            day_assigned[slot.date][sid] = slot
+            return True
+        return False
+
+    def try_replace(slot):
+        """割り当て済みのスタッフを別のスタッフに交代（コストが下がればTrue）"""
+        pos = rng.randrange(len(slot.staff))
+        old = slot.staff[pos]
+        candidates = problem.eligible_by_location[slot.loc_id]
+        sid = candidates[rng.randrange(len(candidates))]
+        if sid == old or not problem.can_work(sid, slot, counts, day_assigned):
+            return
+        new_staff = slot.staff[:pos] + [sid] + slot.staff[pos + 1:]
+        if not problem.fits(slot, new_staff):
+            return
+        delta = (problem.slot_cost(slot, new_staff) - problem.slot_cost(slot, slot.staff)
+                 + fairness_delta(sid, 1) + fairness_delta(old, -1))
+        if delta < 0 or (delta == 0 and rng.random() < 0.1):
+            slot.staff = new_staff
+            counts[sid] += 1
+            counts[old] -= 1
+            day_assigned[slot.date].pop(old, None)
+            day_assigned[slot.date][sid] = slot
+        return delta < 0
+
+    def try_transfer(slot):
+        """同じ日の別の拠点からスタッフを移す（コストが下がればTrue）"""
+        others = [s for s in slots_by_date[slot.date] if s is not slot and s.staff]
+        if not others:
+            return
+        source = others[rng.randrange(len(others))]
+        pos = rng.randrange(len(source.staff))
+        sid = source.staff[pos]
+        if sid not in problem.eligible_sets[slot.loc_id]:
+            return
+        new_staff = slot.staff + [sid]
+        new_source = source.staff[:pos] + source.staff[pos + 1:]
+        if not problem.fits(slot, new_staff) or not problem.fits(source, new_source):
+            return
+        delta = (problem.slot_cost(slot, new_staff) - problem.slot_cost(slot, slot.staff)
+                 + problem.slot_cost(source, new_source) - problem.slot_cost(source, source.staff))
+        if delta < 0:
+            slot.staff = new_staff
+            source.staff = new_source
+            day_assigned[slot.date][sid] = slot
+            return True
+        return False
+
+    # 不正な制限時間（NaN・無限大）で止まらなくならないように
+    if not math.isfinite(time_budget):
+        time_budget = 0
+    deadline = time.monotonic() + time_budget
+    stall_limit = max(MIN_STALL_MOVES, STALL_MOVES_PER_SLOT * len(slots))
+    iterations = 0
+    stalled = 0
+    converged = False
+    while True:
+        if iterations % 256 == 0 and time.monotonic() >= deadline:
+            break
+        if stalled >= stall_limit:
+            converged = True
+            break
+        iterations += 1
+        stalled += 1
+        slot = slots[rng.randrange(len(slots))]
+        if not problem.eligible_by_location[slot.loc_id]:
+            continue
+        move = rng.random()
+        if not slot.staff or move < 0.4:
+            improved = try_add(slot)
+        elif move < 0.8:
+            improved = try_replace(slot)
+        else:
+            improved = try_transfer(slot)
+        if improved:
+            stalled = 0
+
+    optimized = {date_str: dict(locs) for date_str, locs in shift_result.items()}
+    for slot in slots:
+        optimized[slot.date][slot.loc_id] = slot.staff
+    objective = evaluate(slots, counts, problem)
+    objective.update({
+        "initial_cost": start_objective['cost'],
+        "iterations": iterations,
+        "converged": converged,
+    })
+    return optimized, counts, objective